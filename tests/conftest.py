@@ -0,0 +1,36 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+from wrecksys import model_maker
+from wrecksys.data import sources
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+
+def _ratings(num_users=300, num_works=200):
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(4, 12, num_users)
+    return pa.table({'user_id': np.repeat(np.arange(1, num_users + 1), lengths).astype(np.int32),
+                     'work_id': rng.integers(1, num_works, lengths.sum()).astype(np.int32),
+                     'rating': rng.integers(1, 6, lengths.sum()).astype(np.int8),
+                     'timestamp': np.arange(lengths.sum(), dtype=np.int64)})
+
+
+@pytest.fixture
+def make_model(tmp_path, monkeypatch):
+    monkeypatch.setenv(model_maker.ENV_ROOT, str(tmp_path))
+    for config in (model_maker.CONFIG_FILE.data, sources.config_file.data):
+        for key, value in {'vocab_size': 201, 'embedding_dimensions': 8, 'rnn_dimensions': 8, 'num_predictions': 10,
+                           'batch_size': 16, 'num_shards': 2, 'checkpoint_interval': 3,
+                           'checkpoint_max_to_keep': 2}.items():
+            monkeypatch.setattr(config, key, value)
+
+    def make(name='model'):
+        functional_model = model_maker.FunctionalModel(name, tmp_path, tf.distribute.get_strategy())
+        if not functional_model.data.files['ratings'].exists():
+            feather.write_feather(_ratings(), functional_model.data.files['ratings'])
+        keras.utils.set_random_seed(0)
+        return functional_model.load()
+    return make
@@ -0,0 +1,68 @@
+import time
+
+from wrecksys.data.cache import ArtifactCache
+
+
+def _store(cache, key, size):
+    cache.path(key).mkdir(parents=True, exist_ok=True)
+    (cache.path(key) / 'data.bin').write_bytes(b'x' * size)
+    cache.commit(key, {'key': key})
+    # last_used only has to order the entries, and some clocks don't tick between commits.
+    time.sleep(.01)
+
+
+def test_fingerprint_follows_params_and_inputs():
+    key = ArtifactCache.fingerprint('clean', {'a': 1, 'b': [1, 2]}, ['x'])
+    assert key == ArtifactCache.fingerprint('clean', {'b': [1, 2], 'a': 1}, ['x'])
+    assert key.startswith('clean-')
+    assert key != ArtifactCache.fingerprint('clean', {'a': 2, 'b': [1, 2]}, ['x'])
+    assert key != ArtifactCache.fingerprint('clean', {'a': 1, 'b': [1, 2]}, ['y'])
+
+
+def test_uncommitted_artifacts_are_not_read_back(tmp_path):
+    cache = ArtifactCache(tmp_path)
+    cache.path('partial').mkdir()
+    assert not cache.exists('partial')
+
+
+def test_evicts_least_recently_used_first(tmp_path):
+    cache = ArtifactCache(tmp_path, budget=250)
+    for key in ('a', 'b', 'c'):
+        _store(cache, key, 100)
+    cache.metadata('a')
+
+    cache.evict()
+    assert [cache.exists(key) for key in 'abc'] == [True, False, True]
+    assert not cache.path('b').exists()
+    # The index is written through, so a new cache over the directory sees the same entries.
+    assert set(ArtifactCache(tmp_path).index) == {'a', 'c'}
+
+
+def test_evict_spares_kept_keys(tmp_path):
+    cache = ArtifactCache(tmp_path, budget=150)
+    for key in ('a', 'b', 'c'):
+        _store(cache, key, 100)
+
+    cache.evict(keep={'a'})
+    assert [cache.exists(key) for key in 'abc'] == [True, False, False]
+
+
+def test_no_budget_keeps_everything(tmp_path):
+    cache = ArtifactCache(tmp_path)
+    for key in ('a', 'b'):
+        _store(cache, key, 100)
+
+    cache.evict()
+    assert cache.exists('a') and cache.exists('b')
+
+
+def test_update_tracks_the_new_size(tmp_path):
+    cache = ArtifactCache(tmp_path, budget=150)
+    _store(cache, 'a', 100)
+    _store(cache, 'b', 10)
+    (cache.path('b') / 'more.bin').write_bytes(b'x' * 100)
+
+    cache.update('b', rows=5)
+    assert cache.metadata('b') == {'rows': 5}
+    cache.evict()
+    assert [cache.exists(key) for key in 'ab'] == [False, True]
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+from wrecksys.data import datasets, prepare
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+MIN_LENGTH, MAX_LENGTH = 3, 10
+FORMATS = {
+    'protobuf': lambda input_file, output_dir, split_by: datasets.ProtobufDataset(
+        input_file, output_dir, MIN_LENGTH, MAX_LENGTH, num_shards=3, workers=1, split_by=split_by,
+        deterministic=True),
+    'numpy': lambda input_file, output_dir, split_by: datasets.NumpyDataset(
+        input_file, output_dir, MIN_LENGTH, MAX_LENGTH, split_by=split_by),
+    'memmap': lambda input_file, output_dir, split_by: datasets.MemmapDataset(
+        input_file, output_dir, MIN_LENGTH, MAX_LENGTH, shard_size=2000, read_size=256, split_by=split_by),
+    'timeline': lambda input_file, output_dir, split_by: datasets.TimelineDataset(
+        input_file, output_dir, MIN_LENGTH, MAX_LENGTH, read_size=256, split_by=split_by),
+}
+
+
+@pytest.fixture
+def ratings_file(tmp_path):
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 30, 500)
+    size = lengths.sum()
+    # Timestamps rise within each user, as they do in the clean data.
+    table = pa.table({'user_id': np.repeat(np.arange(1, len(lengths) + 1), lengths).astype(np.int32),
+                      # Like the clean data, no user rates a work twice.
+                      'work_id': np.concatenate([rng.choice(np.arange(1, 1000), n, replace=False) for n in lengths])
+                      .astype(np.int32),
+                      'rating': rng.integers(1, 6, size).astype(np.int8),
+                      'timestamp': np.sort(rng.integers(0, 1 << 20, size)).astype(np.int64)})
+    feather.write_feather(table, tmp_path / 'ratings.feather', chunksize=1000)
+    return tmp_path / 'ratings.feather'
+
+
+def _examples(dataset: tf.data.Dataset) -> np.ndarray:
+    # Every example as one row, sorted, so datasets that order them differently still compare equal.
+    rows = np.concatenate([np.concatenate([x['context_id'].numpy(), x['context_rating'].numpy(), y.numpy()], axis=1)
+                           for x, y in dataset.batch(4096)])
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def _expected(ratings_file, split, spec) -> np.ndarray:
+    windows = list(datasets.iter_windows(ratings_file, MIN_LENGTH, MAX_LENGTH, split=split, spec=spec))
+    return _examples(tf.data.Dataset.from_tensor_slices(
+        ({'context_id': np.concatenate([w.context_id for w in windows]),
+          'context_rating': np.concatenate([w.context_rating for w in windows])},
+         np.concatenate([w.label_id for w in windows]))))
+
+
+@pytest.mark.parametrize('split_by', ['user', 'time'])
+def test_protobuf_build_writes_every_split(ratings_file, tmp_path, split_by):
+    dataset = datasets.ProtobufDataset(ratings_file, tmp_path / 'dataset', MIN_LENGTH, MAX_LENGTH, num_shards=3,
+                                       workers=1, split_by=split_by, deterministic=True)
+    size = dataset.build()
+
+    spec = datasets.SplitSpec(split_by).with_cutoffs(ratings_file)
+    expected = {name: _expected(ratings_file, split, spec) for split, name in enumerate(datasets.SPLITS)}
+    assert size == sum(len(e) for e in expected.values())
+    for name in datasets.SPLITS:
+        np.testing.assert_array_equal(_examples(dataset.load(name)), expected[name])
+    assert not [p for p in dataset.output_dir.iterdir() if p.is_dir() or p.suffix == '.partial']
+
+
+def _delta(ratings_file) -> pd.DataFrame:
+    # New ratings for some users, an edited rating for others, and a few new users.
+    ratings = feather.read_table(ratings_file).to_pandas()
+    last = ratings.groupby('user_id').last()
+    appended = last.sample(40, random_state=0).reset_index()
+    appended['timestamp'] += 1
+    appended['work_id'] = 1000
+    edited = ratings.groupby('user_id').first().sample(10, random_state=1).reset_index()
+    edited['rating'] = 6 - edited['rating']
+    added = pd.DataFrame({'user_id': np.repeat(np.arange(501, 511), 8),
+                          'work_id': np.tile(np.arange(10, 18), 10),
+                          'rating': 3,
+                          'timestamp': np.tile(np.arange(8), 10) + (1 << 20)})
+    return pd.concat([appended, edited, added])[ratings.columns].astype(ratings.dtypes.to_dict())
+
+
+@pytest.mark.parametrize('split_by', ['user', 'time'])
+@pytest.mark.parametrize('name', list(FORMATS))
+def test_build_loads_the_windows_of_each_split(ratings_file, tmp_path, name, split_by):
+    dataset = FORMATS[name](ratings_file, tmp_path / name, split_by)
+    dataset.build()
+
+    spec = datasets.SplitSpec(split_by).with_cutoffs(ratings_file)
+    for split, split_name in enumerate(datasets.SPLITS):
+        np.testing.assert_array_equal(_examples(dataset.load(split_name)), _expected(ratings_file, split, spec))
+
+
+@pytest.mark.parametrize('split_by', ['user', 'time'])
+@pytest.mark.parametrize('name', [name for name in FORMATS if name != 'numpy'])
+def test_update_matches_a_rebuild(ratings_file, tmp_path, name, split_by):
+    dataset = FORMATS[name](ratings_file, tmp_path / name, split_by)
+    dataset.build()
+    # Updates keep the split cutoffs of the build.
+    spec = datasets.SplitSpec(split_by).with_cutoffs(ratings_file)
+    delta = _delta(ratings_file)
+    prepare.merge_ratings(ratings_file, delta)
+
+    dataset.update(delta['user_id'].unique())
+    for split, split_name in enumerate(datasets.SPLITS):
+        np.testing.assert_array_equal(_examples(dataset.load(split_name)), _expected(ratings_file, split, spec))
+
+
+def test_numpy_dataset_has_no_update(ratings_file, tmp_path):
+    dataset = FORMATS['numpy'](ratings_file, tmp_path / 'numpy', 'user')
+    dataset.build()
+    with pytest.raises(NotImplementedError):
+        dataset.update(np.array([1]))
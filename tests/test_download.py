@@ -0,0 +1,178 @@
+import functools
+import gzip
+import http.server
+import json
+import os
+import threading
+import time
+
+import aiohttp
+import fsspec
+import pyarrow.feather as feather
+import pytest
+
+from wrecksys.data import download
+from wrecksys.data.download import ChunkedDownload
+
+FILE_SIZE = 64 << 20
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files with single byte-range support, and counts the requests that get a 206. Ranges starting at or after
+    fail_from are refused, as if the connection had gone down partway through a download.
+    """
+    ranged_requests = 0
+    fail_from = None
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start, end = range_header.removeprefix('bytes=').split('-')
+        start, end = int(start), min(int(end or size - 1), size - 1)
+        if self.fail_from is not None and start >= self.fail_from:
+            self.send_error(503)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        type(self).ranged_requests += 1
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, '_remaining', None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(remaining))
+
+    def log_message(self, *args):
+        pass
+
+
+class NoRangeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Ignores Range and answers every GET with the whole file, like some static file servers do. Counts the bytes it
+    actually managed to send.
+    """
+    bytes_sent = 0
+
+    def copyfile(self, source, outputfile):
+        try:
+            while chunk := source.read(1 << 16):
+                outputfile.write(chunk)
+                type(self).bytes_sent += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def source(tmp_path):
+    directory = tmp_path / 'served'
+    directory.mkdir()
+    file = directory / 'source.json.gz'
+    file.write_bytes(os.urandom(1 << 20) * (FILE_SIZE >> 20))
+    return file
+
+
+def _serve(handler, directory):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def range_server(source):
+    RangeHandler.ranged_requests = 0
+    RangeHandler.fail_from = None
+    server = _serve(RangeHandler, source.parent)
+    yield f'http://127.0.0.1:{server.server_port}/{source.name}'
+    server.shutdown()
+
+
+@pytest.fixture
+def no_range_server(source):
+    NoRangeHandler.bytes_sent = 0
+    server = _serve(NoRangeHandler, source.parent)
+    yield f'http://127.0.0.1:{server.server_port}/{source.name}'
+    server.shutdown()
+
+
+def _download(url, file, chunk_size=8 << 20):
+    fs = fsspec.filesystem('http', skip_instance_cache=True)
+    return ChunkedDownload(fs, url, file, fs.info(url)['size'], chunk_size, connections=4)
+
+
+def test_range_server_is_downloaded_in_chunks(source, range_server, tmp_path):
+    download = _download(range_server, tmp_path / 'download.json.gz')
+
+    assert download.supports_ranges()
+    assert download.run().read_bytes() == source.read_bytes()
+    assert RangeHandler.ranged_requests == 1 + download.num_chunks
+
+
+def test_interrupted_download_only_fetches_missing_chunks(source, range_server, tmp_path):
+    file = tmp_path / 'download.json.gz'
+    RangeHandler.fail_from = 3 * (8 << 20)
+    with pytest.raises(aiohttp.ClientResponseError):
+        _download(range_server, file).run()
+    assert not file.exists()
+
+    RangeHandler.fail_from = None
+    RangeHandler.ranged_requests = 0
+    resumed = _download(range_server, file)
+    assert resumed.completed_bytes == 3 * (8 << 20)
+    assert resumed.run().read_bytes() == source.read_bytes()
+    assert RangeHandler.ranged_requests == resumed.num_chunks - 3
+    # Only the finished file is left, without the partial file or its manifest.
+    assert [p.name for p in tmp_path.iterdir() if p.is_file()] == [file.name]
+
+
+def test_probe_does_not_read_a_server_that_ignores_ranges(no_range_server, tmp_path):
+    download = _download(no_range_server, tmp_path / 'download.json.gz')
+
+    assert not download.supports_ranges()
+    # The server stops once the probe hangs up, instead of sending the whole file.
+    time.sleep(.5)
+    assert NoRangeHandler.bytes_sent < FILE_SIZE // 2
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_download_all_converts_every_source(tmp_path, pipelined):
+    directory = tmp_path / 'served'
+    directory.mkdir()
+    records = {name: [{'id': i, 'name': f'{name} {i}'} for i in range(1000 * (n + 1))]
+               for n, name in enumerate(['authors', 'series'])}
+    for name, rows in records.items():
+        (directory / f'{name}.json.gz').write_bytes(gzip.compress(''.join(json.dumps(r) + '\n' for r in rows).encode()))
+    server = _serve(RangeHandler, directory)
+
+    sources = [download.FileManager(f'http://127.0.0.1:{server.server_port}/{name}.json.gz',
+                                    name,
+                                    tmp_path / f'examples/{name}_example.json',
+                                    tmp_path / f'raw/{name}.feather',
+                                    block_size=16 << 10,
+                                    chunk_size=8 << 10,
+                                    pipelined=pipelined)
+               for name in records]
+    try:
+        download.download_all(sources, max_workers=2)
+    finally:
+        server.shutdown()
+
+    for source, rows in zip(sources, records.values()):
+        assert source.exists
+        assert feather.read_table(source.output_file).to_pylist() == rows
+    assert sorted(p.name for p in (tmp_path / 'raw').iterdir()) == ['authors.feather', 'series.feather']
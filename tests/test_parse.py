@@ -0,0 +1,41 @@
+import json
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from wrecksys.data import parse
+
+
+def _block(*records):
+    return ''.join(json.dumps(r) + '\n' for r in records).encode()
+
+
+def test_blocks_with_drifting_types_are_unified(tmp_path):
+    output_file = tmp_path / 'shelves.feather'
+    blocks = [_block({'id': 1, 'shelves': [], 'score': 1}),
+              _block({'id': 2, 'shelves': ['to-read'], 'score': 1.5, 'note': 'x'}),
+              _block({'id': 3, 'shelves': [], 'score': 2})]
+
+    parse.blocks_to_feather(blocks, output_file)
+
+    table = feather.read_table(output_file)
+    assert table.schema.field('shelves').type == pa.list_(pa.string())
+    assert table.schema.field('score').type == pa.float64()
+    assert table.to_pydict() == {'id': [1, 2, 3],
+                                 'shelves': [[], ['to-read'], []],
+                                 'score': [1., 1.5, 2.],
+                                 'note': [None, 'x', None]}
+    assert [p.name for p in tmp_path.iterdir()] == [output_file.name]
+
+
+def test_user_ids_are_encoded_across_drifting_blocks(tmp_path):
+    output_file = tmp_path / 'goodreads_reviews_fantasy_paranormal.feather'
+    blocks = [_block({'user_id': 'a', 'book_id': '1', 'rating': 5, 'n_votes': 0, 'n_comments': 0, 'tags': []}),
+              _block({'user_id': 'b', 'book_id': '2', 'rating': 4, 'n_votes': 1, 'n_comments': 0, 'tags': ['t']},
+                     {'user_id': 'a', 'book_id': '3', 'rating': 3, 'n_votes': 0, 'n_comments': 2, 'tags': []})]
+
+    parse.blocks_to_feather(blocks, output_file)
+
+    table = feather.read_table(output_file)
+    assert table.column('user_id').to_pylist() == ['a', 'b', 'a']
+    assert table.column('tags').to_pylist() == [[], ['t'], []]
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pyarrow as pa
+import pytest
+
+from wrecksys.data import prepare
+
+
+@pytest.fixture
+def works():
+    # Out of order, to check the table comes out keyed by work_index.
+    return pa.table({'work_index': pa.array([3, 1, 2], pa.int32()),
+                     'work_id': pa.array([30, 10, 20], pa.int64()),
+                     'book_id': pa.array([300, 100, 200], pa.int64()),
+                     'author_id': pa.array([7, 8, 7], pa.int32()),
+                     'title': ['The Name of the Wind', 'Mistborn', "The Wise Man's Fear"],
+                     'author_name': ['Patrick Rothfuss', 'Brandon Sanderson', 'Patrick Rothfuss'],
+                     'average_rating': pa.array([4.5, 4.4, 4.6], pa.float32())})
+
+
+def test_catalog_schema_and_lookups(works, tmp_path):
+    database = tmp_path / 'app.db'
+    prepare.export_catalog(works, database)
+
+    with sqlite3.connect(database) as con:
+        columns = {name: (data_type, primary_key)
+                   for _, name, data_type, _, _, primary_key in con.execute('PRAGMA table_info(books)')}
+        assert list(columns)[0] == 'work_index'
+        assert columns['work_index'] == ('INTEGER', 1)
+        assert columns['work_id'][0] == 'INTEGER'
+        assert columns['average_rating'][0] == 'REAL'
+        assert columns['title'][0] == 'TEXT'
+        indexes = {row[1] for row in con.execute('PRAGMA index_list(books)')}
+        assert {'books_work_id', 'books_book_id', 'books_author_id'} <= indexes
+
+        assert con.execute('SELECT title FROM books WHERE work_index >= 2 LIMIT 2').fetchall() == \
+            [("The Wise Man's Fear",), ('The Name of the Wind',)]
+        plan = ' '.join(row[-1] for row in con.execute('EXPLAIN QUERY PLAN SELECT * FROM books WHERE work_id = 20'))
+        assert 'books_work_id' in plan
+    assert [p.name for p in tmp_path.iterdir()] == ['app.db']
+
+
+def test_full_text_search(works, tmp_path):
+    database = tmp_path / 'app.db'
+    prepare.export_catalog(works, database, full_text=True)
+
+    with sqlite3.connect(database) as con:
+        try:
+            con.execute('SELECT * FROM books_search LIMIT 0')
+        except sqlite3.OperationalError:
+            pytest.skip("This SQLite build doesn't support FTS5.")
+        query = ("SELECT b.work_index FROM books_search s JOIN books b ON b.work_index = s.rowid "
+                 "WHERE books_search MATCH ? ORDER BY s.rank")
+        assert sorted(row[0] for row in con.execute(query, ('rothfuss',))) == [2, 3]
+        assert con.execute(query, ('mistborn',)).fetchall() == [(1,)]
+        assert con.execute(query, ('wise',)).fetchall() == [(2,)]
+
+
+def test_catalog_without_full_text_search(works, tmp_path):
+    database = tmp_path / 'app.db'
+    prepare.export_catalog(works, database)
+
+    with sqlite3.connect(database) as con:
+        assert not con.execute("SELECT name FROM sqlite_master WHERE name = 'books_search'").fetchall()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from wrecksys.model import retrieval
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+K = 20
+
+
+def _catalog(num_items=2000, dimensions=16, num_queries=64):
+    rng = np.random.default_rng(0)
+    # Clustered items, with one oversized cluster, so the lists come out uneven.
+    centers = rng.normal(0, 3, (20, dimensions))
+    sizes = np.r_[num_items // 2, np.full(19, num_items // 2 // 19)]
+    items = np.concatenate([c + rng.normal(0, .5, (n, dimensions)) for c, n in zip(centers, sizes)])
+    queries = rng.normal(0, 3, (num_queries, dimensions))
+    return items.astype(np.float32), queries.astype(np.float32)
+
+
+def _exact_top_k(items, queries, k):
+    return np.argsort(-(queries @ items.T), axis=1, kind='stable')[:, :k]
+
+
+def test_probing_every_list_is_exact():
+    items, queries = _catalog()
+    index = retrieval.IVFIndex.build(items, 32, 32, K)
+
+    _, ids = index.search(tf.constant(queries), K)
+    assert retrieval.recall_at_k(ids.numpy(), _exact_top_k(items, queries, K)) == 1.0
+
+
+def test_recall_grows_with_probes():
+    items, queries = _catalog()
+    exact = _exact_top_k(items, queries, K)
+    recalls = []
+    for num_probes in (4, 8, 16):
+        _, ids = retrieval.IVFIndex.build(items, 16, num_probes, K).search(tf.constant(queries), K)
+        recalls.append(retrieval.recall_at_k(ids.numpy(), exact))
+
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+
+
+def test_benchmark_with_default_probes():
+    # The default num_lists of benchmark_retrieval, 4 * sqrt(num_items), makes lists too small for the first probe
+    # counts to hold 3 * K items.
+    items, queries = _catalog()
+    num_lists = int(4 * len(items) ** .5)
+    results = retrieval.benchmark(items, queries, 3 * K, num_lists, repeats=1)
+
+    assert results[0]['num_probes'] is None
+    assert [r['num_probes'] for r in results[1:]] == [1, 2, 4, 8, 16, 32]
+    skipped = [r for r in results[1:] if r['recall'] is None]
+    assert skipped and all(f'fewer than {3 * K} items' in r['error'] for r in skipped)
+    assert results[-1]['recall'] is not None
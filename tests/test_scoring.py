@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from wrecksys.model import evaluation, losses, metrics, models
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+VOCAB_SIZE = 50
+
+
+def _dense_loss(columns, logits):
+    return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=tf.one_hot(columns, logits.shape[1]),
+                                                                  logits=logits))
+
+
+def _sorted_ranks(columns, scores):
+    # The position of each label when its row is sorted, ties going to the lower column.
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.argmax(order == columns[:, None], axis=1)
+
+
+@pytest.fixture
+def model():
+    model = models.WreckSys({'vocab_size': VOCAB_SIZE,
+                             'embedding_dimensions': 8,
+                             'rnn_dimensions': 8,
+                             'num_predictions': 10})
+    model.compile(optimizer=keras.optimizers.Adam(), loss=losses.GlobalSoftmax())
+    return model
+
+
+def test_sparse_loss_matches_dense_loss():
+    logits = tf.random.stateless_normal([32, VOCAB_SIZE], seed=[0, 1])
+    columns = np.r_[0, VOCAB_SIZE - 1, np.random.default_rng(0).integers(0, VOCAB_SIZE, 30)]
+
+    sparse = losses.GlobalSoftmax().call(tf.constant(columns[:, None]), logits)
+    np.testing.assert_allclose(sparse, _dense_loss(columns, logits), rtol=1e-5)
+
+
+def test_label_ranks_match_sorting():
+    # Rounding the scores makes ties, which have to break the same way top_k does.
+    scores = np.round(np.random.default_rng(0).normal(size=(32, VOCAB_SIZE)), 1).astype(np.float32)
+    columns = np.r_[0, VOCAB_SIZE - 1, np.random.default_rng(1).integers(0, VOCAB_SIZE, 30)]
+
+    ranks = metrics._label_ranks(tf.constant(scores), tf.constant(columns))
+    np.testing.assert_array_equal(ranks, _sorted_ranks(columns, scores))
+
+
+def test_every_label_id_has_a_column(model):
+    rng = np.random.default_rng(0)
+    x = {'context_id': tf.constant(rng.integers(1, VOCAB_SIZE + 1, (4, 10)), tf.int32),
+         'context_rating': tf.constant(rng.integers(1, 6, (4, 10)), tf.float32)}
+    label_ids = np.array([1, 2, VOCAB_SIZE - 1, VOCAB_SIZE])
+
+    scores = model(x, training=False)
+    assert scores.shape == (4, VOCAB_SIZE)
+    results = model.test_step((x, tf.constant(label_ids[:, None], tf.int32)))
+    np.testing.assert_allclose(results[model.loss.name], _dense_loss(label_ids - 1, scores), rtol=1e-5)
+
+    ranks = _sorted_ranks(label_ids - 1, scores.numpy())
+    assert float(results['Global_Recall/Top_1']) == pytest.approx(np.mean(ranks < 1))
+    assert float(results['Global_Recall/Top_100']) == 1.0
+
+
+def test_unrankable_labels_count_as_misses():
+    items = np.eye(4, dtype=np.float32)
+    contexts = items[[0, 1, 2, 3, 0]]
+    label_ids = np.array([[1], [2], [3], [4], [VOCAB_SIZE]])
+
+    report = evaluation.evaluate(lambda x: x, items, tf.data.Dataset.from_tensor_slices((contexts, label_ids)).batch(2),
+                                 top_k=(1,), workers=2)
+    assert report['examples'] == 5
+    assert report['skipped_labels'] == 1
+    assert report['recall']['1'] == pytest.approx(.8)
+
+
+def test_scores_are_float32_under_mixed_precision():
+    keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    try:
+        model = models.WreckSys({'vocab_size': VOCAB_SIZE,
+                                 'embedding_dimensions': 8,
+                                 'rnn_dimensions': 8,
+                                 'num_predictions': 10})
+        rng = np.random.default_rng(0)
+        x = {'context_id': tf.constant(rng.integers(1, VOCAB_SIZE + 1, (4, 10)), tf.int32),
+             'context_rating': tf.constant(rng.integers(1, 6, (4, 10)), tf.float32)}
+        scores = model(x, training=True)
+    finally:
+        keras.mixed_precision.set_global_policy('float32')
+
+    # Both encoders keep float32 tables, and only the GRU's output is rounded to bfloat16.
+    assert all(w.dtype == tf.float32 for w in model.weights)
+    contexts = model.encode_contexts(x)
+    items = model.cache_item_embeddings()
+    assert scores.dtype == tf.float32
+    np.testing.assert_allclose(scores, contexts.numpy() @ items.numpy().T, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('unigrams', [None, list(range(1, VOCAB_SIZE + 1))])
+def test_sampled_softmax_never_samples_padding(unigrams):
+    # Sampling all but one of the label_ids would be sure to reach row 0 if it could, and a padding row that scores
+    # far above every other would then dominate the loss.
+    rng = np.random.default_rng(0)
+    table = rng.normal(size=(VOCAB_SIZE + 1, 8)).astype(np.float32)
+    contexts = tf.constant(rng.normal(size=(16, 8)), tf.float32)
+    labels = tf.constant(rng.integers(1, VOCAB_SIZE + 1, 16))
+
+    def loss(padding):
+        tf.random.set_seed(0)
+        return losses.sampled_softmax(contexts, tf.constant(np.r_[padding[None], table[1:]]), labels, VOCAB_SIZE - 1,
+                                      unigrams)
+    np.testing.assert_allclose(loss(table[0]), loss(np.full(8, 1e3, np.float32)))
+
+
+def test_serve_after_fit_reads_the_cached_embeddings(model):
+    rng = np.random.default_rng(0)
+    x = {'context_id': rng.integers(1, VOCAB_SIZE + 1, (64, 10)).astype(np.int32),
+         'context_rating': rng.integers(1, 6, (64, 10)).astype(np.float32)}
+    model.fit(tf.data.Dataset.from_tensor_slices((x, rng.integers(1, VOCAB_SIZE + 1, (64, 1)))).batch(16), verbose=0)
+
+    query = {name: tf.constant(values[:1]) for name, values in x.items()}
+    expected = model.serve(**query)
+    # Changing the label table behind the cache's back only shows if serve rebuilds the label matrix.
+    [table] = [w for w in model.weights if 'label_embedding' in w.name]
+    table.assign(tf.zeros_like(table))
+    np.testing.assert_array_equal(model.serve(**query)['recommendation_ids'], expected['recommendation_ids'])
+    np.testing.assert_array_equal(model.serve(**query)['recommendation_scores'], expected['recommendation_scores'])
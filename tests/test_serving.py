@@ -0,0 +1,96 @@
+import asyncio
+
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from wrecksys import serving
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+
+class RecordingPredictor(object):
+    """
+    Answers with each instance's context_id sum, and records the size of every batch it's given.
+    """
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, inputs):
+        self.batch_sizes.append(len(inputs['context_id']))
+        return {'total': inputs['context_id'].sum(axis=1)}
+
+
+def _instance(value, length=10):
+    return {'context_id': np.full(length, value, np.int32), 'context_rating': np.ones(length, np.float32)}
+
+
+async def _submit_all(batcher, instances):
+    await batcher.start()
+    try:
+        return await asyncio.gather(*(batcher.submit(instance) for instance in instances))
+    finally:
+        await batcher.stop()
+
+
+def test_concurrent_requests_share_batches():
+    predictor = RecordingPredictor()
+    results = asyncio.run(_submit_all(serving.MicroBatcher(predictor, max_batch_size=8, max_wait=.05),
+                                      [_instance(i) for i in range(20)]))
+
+    assert [r['total'] for r in results] == [10 * i for i in range(20)]
+    assert sum(predictor.batch_sizes) == 20
+    assert max(predictor.batch_sizes) == 8
+    assert len(predictor.batch_sizes) == 3
+
+
+def test_instances_of_different_shapes_run_apart():
+    predictor = RecordingPredictor()
+    instances = [_instance(1), _instance(2, length=5), _instance(3), _instance(4, length=5)]
+    results = asyncio.run(_submit_all(serving.MicroBatcher(predictor, max_batch_size=8, max_wait=.05), instances))
+
+    assert [r['total'] for r in results] == [10, 10, 30, 20]
+    assert sorted(predictor.batch_sizes) == [2, 2]
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def failing(inputs):
+        raise ValueError('bad batch')
+
+    batcher = serving.MicroBatcher(failing, max_batch_size=8, max_wait=.05)
+    with pytest.raises(ValueError, match='bad batch'):
+        asyncio.run(_submit_all(batcher, [_instance(1), _instance(2)]))
+
+
+def test_predict_endpoint_matches_the_model(make_model):
+    functional_model = make_model()
+    rng = np.random.default_rng(0)
+    context_id = rng.integers(1, 201, (6, 10)).astype(np.int32)
+    context_rating = rng.integers(1, 6, (6, 10)).astype(np.float32)
+    # Calling the model builds it, which it has to be before it's exported.
+    expected = functional_model.model.serve_batch(context_id, context_rating)
+    functional_model.export_as_saved_model()
+
+    async def _requests():
+        app = serving.create_app(functional_model.export_dir, 'books', max_batch_size=4, max_wait=.05)
+        async with TestClient(TestServer(app)) as client:
+            status = await (await client.get('/v1/models/books')).json()
+            rows = await asyncio.gather(*(
+                client.post('/v1/models/books:predict', json={'instances': [{
+                    'context_id': context_id[i].tolist(), 'context_rating': context_rating[i].tolist()}]})
+                for i in range(len(context_id))))
+            columnar = await client.post('/v1/models/books:predict', json={'inputs': {
+                'context_id': context_id.tolist(), 'context_rating': context_rating.tolist()}})
+            missing = await client.post('/v1/models/books:predict', json={'instances': [{'context_id': [1] * 10}]})
+            unknown = await client.get('/v1/models/other')
+            return (status, [await r.json() for r in rows], await columnar.json(), missing.status,
+                    unknown.status)
+
+    status, rows, columnar, missing, unknown = asyncio.run(_requests())
+    assert status['model_version_status'][0]['state'] == 'AVAILABLE'
+    ids = np.array([row['predictions'][0]['recommendation_ids'] for row in rows])
+    np.testing.assert_array_equal(ids, expected['recommendation_ids'])
+    np.testing.assert_array_equal(columnar['outputs']['recommendation_ids'], expected['recommendation_ids'])
+    np.testing.assert_allclose(columnar['outputs']['recommendation_scores'], expected['recommendation_scores'],
+                               rtol=1e-6)
+    assert (missing, unknown) == (400, 404)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from wrecksys.model import callbacks
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+STEPS = 4
+CALLBACK_LIST = callbacks.callback_list
+
+
+def _patch_callbacks(monkeypatch, early_stopping=None, extra=()):
+    # The TensorBoard logs aren't under test, so they're left out.
+    def patched(*args):
+        use_callbacks = [c for c in CALLBACK_LIST(*args) if not isinstance(c, keras.callbacks.TensorBoard)]
+        if early_stopping is not None:
+            use_callbacks = [early_stopping if isinstance(c, keras.callbacks.EarlyStopping) else c
+                             for c in use_callbacks]
+        return use_callbacks + list(extra)
+    monkeypatch.setattr(callbacks, 'callback_list', patched)
+
+
+def _weights(model):
+    return np.concatenate([w.numpy().ravel() for w in model.weights])
+
+
+def test_early_stopping_stops_a_resumable_run(make_model, monkeypatch):
+    # With a min_delta no loss can beat, the first epoch sets the best and the second runs out of patience.
+    _patch_callbacks(monkeypatch,
+                     keras.callbacks.EarlyStopping(monitor='Global_Softmax_Cross_Entropy', patience=1, min_delta=1e9))
+
+    functional_model = make_model().train_and_eval(epochs=5, limit=STEPS)
+    assert int(functional_model.model.optimizer.iterations.numpy()) == 2 * STEPS
+
+
+def test_resumed_run_matches_an_uninterrupted_one(make_model, monkeypatch):
+    _patch_callbacks(monkeypatch)
+    expected = _weights(make_model('uninterrupted').train_and_eval(epochs=3, limit=STEPS).model)
+
+    class Interrupt(keras.callbacks.Callback):
+        def on_train_batch_end(self, batch, logs=None):
+            if int(self.model.optimizer.iterations.numpy()) == STEPS + 2:
+                raise KeyboardInterrupt
+    _patch_callbacks(monkeypatch, extra=[Interrupt()])
+    interrupted = make_model('interrupted')
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.train_and_eval(epochs=3, limit=STEPS)
+    interrupted.checkpoints.checkpoint.sync()
+    _patch_callbacks(monkeypatch)
+
+    # Checkpoints are written every 3 steps, so the run carries on from step 6, partway through the second epoch.
+    resumed = make_model('interrupted').train_and_eval(epochs=3, limit=STEPS)
+    assert int(resumed.model.optimizer.iterations.numpy()) == 3 * STEPS
+    np.testing.assert_array_equal(_weights(resumed.model), expected)
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import pathlib
+import shutil
+import time
+
+from wrecksys import utils
+from wrecksys.config import NamespaceDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactCache(object):
+    """
+    Stores derived data under a fingerprint of the stage, its parameters and its inputs.
+
+    Each artifact is a directory named after its key. An index file records which keys finished building, their
+    size, metadata and when they were last used, and the least recently used entries are evicted once the cache
+    grows past its disk budget.
+    """
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    def __init__(self, directory: pathlib.Path, budget: int | None = None):
+        self.directory = pathlib.Path(directory)
+        self.budget = budget
+        self.index_file = self.directory / 'index.json'
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index = self._read_index()
+
+    @staticmethod
+    def fingerprint(stage: str, params: dict, inputs: list[str] | None = None) -> str:
+        payload = json.dumps({'stage': stage, 'params': params, 'inputs': inputs or []},
+                             sort_keys=True,
+                             cls=NamespaceDecoder)
+        return f"{stage}-{hashlib.sha256(payload.encode()).hexdigest()[:16]}"
+
+    def path(self, key: str) -> pathlib.Path:
+        return self.directory / key
+
+    def exists(self, key: str) -> bool:
+        return key in self.index and self.path(key).exists()
+
+    def metadata(self, key: str) -> dict:
+        self.touch(key)
+        return self.index[key]['metadata']
+
+    def touch(self, key: str) -> None:
+        if key in self.index:
+            self.index[key]['last_used'] = time.time()
+            self._write_index()
+
+    def commit(self, key: str, params: dict, **metadata) -> None:
+        """
+        Marks an artifact as complete. Nothing is read back from the cache until its key is committed.
+        """
+        size = sum(f.stat().st_size for f in self.path(key).rglob('*') if f.is_file())
+        self.index[key] = {
+            'params': json.loads(json.dumps(params, cls=NamespaceDecoder)),
+            'metadata': metadata,
+            'size': size,
+            'created': time.time(),
+            'last_used': time.time()
+        }
+        self._write_index()
+        self._class_logger.info(f" Cached {key} ({utils.display_size(size)})")
+
+    def update(self, key: str, **metadata) -> None:
+        self.index[key]['metadata'].update(metadata)
+        self.index[key]['size'] = sum(f.stat().st_size for f in self.path(key).rglob('*') if f.is_file())
+        self.touch(key)
+
+    def evict(self, keep: set[str] = frozenset()) -> None:
+        """
+        Removes the least recently used artifacts, other than those in keep, until the cache fits its budget.
+        """
+        if self.budget is None:
+            return
+
+        used = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if used <= self.budget:
+                break
+            if key in keep:
+                continue
+            used -= self.index[key]['size']
+            self.remove(key)
+
+    def remove(self, key: str) -> None:
+        shutil.rmtree(self.path(key), ignore_errors=True)
+        self.index.pop(key, None)
+        self._write_index()
+        self._class_logger.info(f" Evicted {key}")
+
+    def _read_index(self) -> dict:
+        if not self.index_file.exists():
+            return {}
+        with self.index_file.open('r') as f:
+            return json.load(f)
+
+    def _write_index(self) -> None:
+        temp_file = self.index_file.with_name(f"{self.index_file.name}.tmp")
+        with temp_file.open('w') as f:
+            json.dump(self.index, f, indent=4)
+        temp_file.replace(self.index_file)
@@ -1,12 +1,22 @@
 import abc
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import shutil
 import sys
+import tempfile
+import time
 import typing
+from concurrent import futures
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 from tqdm.auto import tqdm
 
 from wrecksys.utils import import_tensorflow
@@ -19,10 +29,366 @@ def sample_record(dataset: tf.data.Dataset):
     return {k: v[0] for k, v in sample.items()}
 
 
-class SingleExample(typing.NamedTuple):
-    ids: list[int]
-    ratings: list[int]
-    label: list[int]
+SPLITS = ('train', 'validation', 'test')
+
+
+class Windows(typing.NamedTuple):
+    context_id: np.ndarray
+    context_rating: np.ndarray
+    label_id: np.ndarray
+
+
+class SplitSpec(typing.NamedTuple):
+    """
+    How examples are assigned to SPLITS when a dataset is built.
+
+    By 'user', all of a user's examples go to one split, picked from the high bits of the hash user_shards takes the
+    low bits of, so every shard holds all three splits in proportion. By 'time', an example's split depends on the
+    timestamp of its label: fraction of the ratings are later than cutoffs[1] and go to test, the fraction before
+    that to validation, and the rest to train. Contexts can reach back across the cutoffs, as they would in serving.
+    """
+    by: str = 'user'
+    fraction: float = .1
+    cutoffs: tuple[int, int] | None = None
+
+    @property
+    def columns(self) -> list[str]:
+        return ['timestamp'] if self.by == 'time' else []
+
+    def with_cutoffs(self, input_file: str | os.PathLike) -> 'SplitSpec':
+        if self.by != 'time' or self.cutoffs is not None:
+            return self
+        timestamps = _timestamps(feather.read_table(input_file, columns=['timestamp'], memory_map=True))
+        cutoffs = np.quantile(timestamps, [1 - 2 * self.fraction, 1 - self.fraction], method='higher')
+        return self._replace(cutoffs=(int(cutoffs[0]), int(cutoffs[1])))
+
+    def assign(self, user_ids: np.ndarray, timestamps: np.ndarray | None = None) -> np.ndarray:
+        """
+        The index into SPLITS of each interaction's example, if it's a label.
+        """
+        if self.by == 'user':
+            hashed = (user_ids.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+            position = hashed.astype(np.float64) / 2 ** 32
+            return np.where(position < self.fraction, 2, np.where(position < 2 * self.fraction, 1, 0)).astype(np.int8)
+        if self.by == 'time':
+            return np.where(timestamps >= self.cutoffs[1], 2, np.where(timestamps >= self.cutoffs[0], 1, 0)) \
+                .astype(np.int8)
+        raise ValueError(f"Can't split examples by {self.by}, expected 'user' or 'time'.")
+
+    def to_dict(self) -> dict:
+        return {'by': self.by, 'fraction': self.fraction, 'cutoffs': self.cutoffs}
+
+    @classmethod
+    def from_dict(cls, spec: dict) -> 'SplitSpec':
+        cutoffs = spec.get('cutoffs')
+        return cls(spec['by'], spec['fraction'], tuple(cutoffs) if cutoffs is not None else None)
+
+
+def _timestamps(batch: pa.RecordBatch | pa.Table) -> np.ndarray:
+    # Timestamps as integers in the file's own unit. Missing ones sort first, into train.
+    timestamps = batch.column('timestamp')
+    if pa.types.is_timestamp(timestamps.type):
+        timestamps = timestamps.cast(pa.int64())
+    return pc.fill_null(timestamps, 0).to_numpy().astype(np.int64)
+
+
+def build_windows(user_ids: np.ndarray,
+                  work_ids: np.ndarray,
+                  ratings: np.ndarray,
+                  min_length: int,
+                  max_length: int,
+                  first_label: int = 1,
+                  keep: np.ndarray | None = None) -> Windows:
+    """
+    Builds every sliding-window example from timelines that are contiguous by user.
+
+    Each interaction after the first is a label, and its context is the (up to) max_length interactions before it,
+    right-padded with zeros. Windows with fewer than min_length context items are dropped, as are labels before
+    position first_label in their timeline, and labels where keep is False.
+    """
+    size = len(user_ids)
+    labels, lengths = window_labels(user_ids, min_length, max_length, first_label, keep)
+
+    offsets = np.arange(max_length)
+    mask = offsets < lengths[:, None]
+    index = np.minimum((labels - lengths)[:, None] + offsets, size - 1)
+
+    return Windows(
+        context_id=np.where(mask, work_ids[index], 0).astype(np.int32),
+        context_rating=np.where(mask, ratings[index], 0).astype(np.float32),
+        label_id=work_ids[labels].astype(np.int32)[:, None]
+    )
+
+
+def window_labels(user_ids: np.ndarray,
+                  min_length: int,
+                  max_length: int,
+                  first_label: int = 1,
+                  keep: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The positions of the labels build_windows makes examples of, and the length of each one's context.
+    """
+    size = len(user_ids)
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]])
+    position = np.arange(size) - np.repeat(starts, np.diff(np.r_[starts, size]))
+
+    lengths = np.minimum(position, max_length)
+    is_label = (position >= max(first_label, 1)) & (lengths >= min_length)
+    if keep is not None:
+        is_label &= keep
+    labels = np.flatnonzero(is_label)
+    return labels, lengths[labels]
+
+
+def user_shards(user_ids: np.ndarray, num_shards: int) -> np.ndarray:
+    """
+    Assigns users to shards with a multiplicative hash, so every process agrees on the split.
+    """
+    hashed = (user_ids.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+    return (hashed % np.uint64(num_shards)).astype(np.int32)
+
+
+def timeline_digest(work_ids: np.ndarray, ratings: np.ndarray) -> int:
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(work_ids.astype(np.int32).tobytes())
+    digest.update(ratings.astype(np.int8).tobytes())
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def user_manifest(user_ids: np.ndarray, work_ids: np.ndarray, ratings: np.ndarray, num_shards: int) -> pa.Table:
+    """
+    Summarizes user-contiguous timelines as one row per user: their shard, timeline length and timeline digest.
+    """
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else np.array([], int)
+    ends = np.r_[starts[1:], len(user_ids)].astype(int)
+    users = user_ids[starts].astype(np.int32)
+    return pa.table({
+        'user_id': users,
+        'shard': user_shards(users, num_shards),
+        'length': (ends - starts).astype(np.int64),
+        'digest': np.array([timeline_digest(work_ids[a:b], ratings[a:b]) for a, b in zip(starts, ends)], np.int64)
+    })
+
+
+def diff_timelines(known: pd.DataFrame,
+                   user_ids: np.ndarray,
+                   work_ids: np.ndarray,
+                   ratings: np.ndarray,
+                   num_shards: int = 1) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """
+    Compares the new timelines of some users to their rows of a user_manifest, indexed by user_id.
+
+    Returns the users' new manifest rows, where each timeline starts in the arrays, and the old length of each
+    timeline if it's an unchanged prefix of the new one, or -1 if it was edited, back-dated or shortened. Users that
+    weren't in the manifest have an empty old timeline.
+    """
+    changes = user_manifest(user_ids, work_ids, ratings, num_shards).to_pandas().set_index('user_id')
+    starts = np.searchsorted(user_ids, changes.index.to_numpy())
+    old_lengths = np.full(len(changes), -1, dtype=np.int64)
+    for i, (user, change) in enumerate(changes.iterrows()):
+        old_length, old_digest = (known.at[user, 'length'], known.at[user, 'digest']) \
+            if user in known.index else (0, timeline_digest(work_ids[:0], ratings[:0]))
+        prefix = slice(starts[i], starts[i] + old_length)
+        if change.length >= old_length and timeline_digest(work_ids[prefix], ratings[prefix]) == old_digest:
+            old_lengths[i] = old_length
+    return changes, starts, old_lengths
+
+
+def timeline_windows(arrays: list[np.ndarray],
+                     start: int,
+                     length: int,
+                     old_length: int,
+                     min_length: int,
+                     max_length: int,
+                     spec: SplitSpec) -> dict[int, Windows]:
+    """
+    The windows of one user's timeline whose labels come after its first old_length interactions, by split. arrays
+    are the user_id, work_id, rating and timestamp columns from read_timelines.
+    """
+    context = max(0, old_length - max_length)
+    timeline = slice(start + context, start + length)
+    user_ids, work_ids, ratings, timestamps = [a[timeline] for a in arrays]
+    splits = spec.assign(user_ids, timestamps)
+    return {
+        int(split): build_windows(user_ids, work_ids, ratings, min_length, max_length,
+                                  first_label=old_length - context, keep=splits == split)
+        for split in np.unique(splits)
+    }
+
+
+def read_timelines(input_file: str | os.PathLike,
+                   users: np.ndarray | None = None,
+                   timestamps: bool = False) -> list[np.ndarray]:
+    """
+    Reads the user_id, work_id and rating columns of a ratings file, optionally only for the given users, followed by
+    the timestamps if they're asked for.
+    """
+    columns = ['user_id', 'work_id', 'rating']
+    value_set = None if users is None else pa.array(users, pa.int32())
+    arrays = [[] for _ in range(len(columns) + timestamps)]
+
+    with pa.memory_map(str(input_file)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if value_set is not None:
+                batch = batch.filter(pc.is_in(batch.column('user_id').cast(pa.int32()), value_set=value_set))
+            for array, column in zip(arrays, columns):
+                array.append(batch.column(column).to_numpy(zero_copy_only=False))
+            if timestamps:
+                arrays[-1].append(_timestamps(batch))
+
+    return [np.concatenate(a) if a else np.array([], np.int32) for a in arrays]
+
+
+def iter_windows(input_file: str | os.PathLike,
+                 min_length: int,
+                 max_length: int,
+                 shard: int | None = None,
+                 num_shards: int = 1,
+                 split: int | None = None,
+                 spec: SplitSpec | None = None,
+                 with_users: bool = False,
+                 with_splits: bool = False) -> typing.Iterator[Windows | tuple[Windows, np.ndarray, ...]]:
+    """
+    Streams build_windows over the record batches of a user-sorted ratings file.
+
+    The last user of every batch is held back and joined to the next one, since their timeline may continue there.
+    With a shard, only the users that user_shards assigns to it are included, and with a split, only the examples
+    that spec assigns to SPLITS[split]. With with_users, each Windows comes with the user_id of every example, and
+    with with_splits, with the index into SPLITS of every example, after the user_ids if both are asked for.
+    """
+    spec = spec or SplitSpec()
+    by_time = (split is not None or with_splits) and spec.by == 'time'
+    columns = ['user_id', 'work_id', 'rating']
+    carry = None
+
+    def _build(arrays: list[np.ndarray]) -> Windows | tuple[Windows, np.ndarray, ...]:
+        keep = spec.assign(arrays[0], arrays[3]) == split if by_time and split is not None else None
+        windows = build_windows(*arrays[:3], min_length, max_length, keep=keep)
+        if not (with_users or with_splits):
+            return windows
+        labels = window_labels(arrays[0], min_length, max_length, keep=keep)[0]
+        extras = [arrays[0][labels]] if with_users else []
+        if with_splits:
+            extras.append(spec.assign(arrays[0][labels], arrays[3][labels] if by_time else None))
+        return windows, *extras
+
+    with pa.memory_map(str(input_file)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            arrays = [batch.column(c).to_numpy(zero_copy_only=False) for c in columns]
+            if by_time:
+                arrays.append(_timestamps(batch))
+            keep = None
+            if shard is not None:
+                keep = user_shards(arrays[0], num_shards) == shard
+            if split is not None and spec.by == 'user':
+                in_split = spec.assign(arrays[0]) == split
+                keep = in_split if keep is None else keep & in_split
+            if keep is not None:
+                arrays = [a[keep] for a in arrays]
+            if carry is not None:
+                arrays = [np.concatenate([c, a]) for c, a in zip(carry, arrays)]
+            if len(arrays[0]) == 0:
+                continue
+
+            users = arrays[0]
+            last_user = users[::-1] == users[-1]
+            tail = len(users) - (np.argmin(last_user) if not last_user.all() else len(users))
+            carry = [a[tail:] for a in arrays]
+            if tail > 0:
+                yield _build([a[:tail] for a in arrays])
+
+    if carry is not None and len(carry[0]) > 0:
+        yield _build(carry)
+
+
+def _encode_messages(message_type: str, fields: list[str], values: list) -> tf.Tensor:
+    # Encodes one message per row, with every field of a row holding all of the row's values.
+    sizes = np.array([[np.shape(v)[1] for v in values]], np.int32).repeat(len(values[0]), axis=0)
+    return tf.io.encode_proto(sizes, values, fields, message_type)
+
+
+def serialize_examples(windows: Windows) -> np.ndarray:
+    """
+    Serializes windows as tf.train.Example protos, all at once rather than one by one in Python. The protos are
+    built from the inside out, each level encoding a batch of the messages the next one nests.
+    """
+    def _feature(key: str, kind: str, values: np.ndarray) -> tf.Tensor:
+        value_list = _encode_messages(f'tensorflow.{kind.title()}List', ['value'], [values])
+        feature = _encode_messages('tensorflow.Feature', [f'{kind}_list'], [value_list[:, None]])
+        return _encode_messages('tensorflow.Features.FeatureEntry', ['key', 'value'],
+                                [tf.fill([len(values), 1], key), feature[:, None]])
+
+    entries = tf.stack([_feature('context_id', 'int64', windows.context_id.astype(np.int64)),
+                        _feature('context_rating', 'float', windows.context_rating.astype(np.float32)),
+                        _feature('label_id', 'int64', windows.label_id.astype(np.int64))], axis=1)
+    features = _encode_messages('tensorflow.Features', ['feature'], [entries])
+    return _encode_messages('tensorflow.Example', ['features'], [features[:, None]]).numpy()
+
+
+def partition_timelines(input_file: pathlib.Path,
+                        output_files: list[pathlib.Path],
+                        columns: list[str]) -> None:
+    """
+    Splits a user-sorted ratings file into one file per user_shards shard, in a single pass over it. Each keeps its
+    users in the order of the input, so their timelines stay contiguous.
+    """
+    columns = ['user_id', 'work_id', 'rating', *columns]
+    with pa.memory_map(str(input_file)) as source:
+        reader = pa.ipc.open_file(source)
+        schema = pa.schema([reader.schema.field(c) for c in columns])
+        writers = [pa.ipc.new_file(str(f), schema) for f in output_files]
+        try:
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i).select(columns)
+                shards = user_shards(batch.column('user_id').to_numpy(zero_copy_only=False), len(output_files))
+                # A stable sort by shard groups each shard's rows without reordering them.
+                batch = batch.take(pa.array(np.argsort(shards, kind='stable')))
+                ends = np.cumsum(np.bincount(shards, minlength=len(output_files)))
+                for writer, start, end in zip(writers, np.r_[0, ends[:-1]], ends):
+                    if end > start:
+                        writer.write_batch(batch.slice(start, end - start))
+        finally:
+            for writer in writers:
+                writer.close()
+
+
+def write_tfrecord_shards(input_file: pathlib.Path,
+                          output_files: list[pathlib.Path],
+                          min_length: int,
+                          max_length: int,
+                          shard: int | None = None,
+                          num_shards: int = 1,
+                          spec: SplitSpec | None = None) -> list[int]:
+    """
+    Builds the examples of one user-hash shard, a record batch at a time, and writes those of each split to its
+    own file of output_files, in the order of SPLITS. Without a shard, the input is taken to be one already.
+    Returns the number of records in each file.
+    """
+    partial_files = [f.with_name(f"{f.name}.partial") for f in output_files]
+    sizes = [0] * len(SPLITS)
+
+    writers = [tf.io.TFRecordWriter(str(f)) for f in partial_files]
+    try:
+        for windows, splits in iter_windows(input_file, min_length, max_length, shard, num_shards,
+                                            spec=spec, with_splits=True):
+            examples = serialize_examples(windows)
+            for split, writer in enumerate(writers):
+                for example in examples[splits == split]:
+                    writer.write(example)
+                sizes[split] += int((splits == split).sum())
+    finally:
+        for writer in writers:
+            writer.close()
+
+    for partial_file, output_file, size in zip(partial_files, output_files, sizes):
+        partial_file.replace(output_file)
+        logger.debug(f"Wrote {size:,} records to {output_file}")
+    return sizes
+
 
 class WrecksysDataset(abc.ABC):
     @abc.abstractmethod
@@ -38,9 +404,40 @@ class WrecksysDataset(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def load(self) -> tf.data.Dataset:
+    def load(self, split: str | None = None, num_pipelines: int = 1, pipeline_id: int = 0) -> tf.data.Dataset:
+        """
+        The examples of one of SPLITS, or of all of them.
+
+        With more than one pipeline, only every num_pipelines-th piece of the data starting at pipeline_id is read,
+        so each worker of a distributed run reads its own disjoint share instead of reading everything and
+        discarding the rest.
+        """
         pass
 
+    def update(self, users: np.ndarray) -> int:
+        raise NotImplementedError(f"{type(self).__name__} doesn't support incremental builds.")
+
+
+def throughput(dataset: tf.data.Dataset, limit: int | None = None) -> float:
+    """
+    Examples per second read from an unbatched dataset, counting the first batch of work in the timing.
+    """
+    if limit is not None:
+        dataset = dataset.take(limit)
+    count = 0
+    start = time.perf_counter()
+    for batch in dataset.batch(1 << 12).prefetch(1):
+        count += int(tf.shape(batch[1])[0])
+    return count / (time.perf_counter() - start)
+
+
+def _split_names(split: str | None) -> tuple[str, ...]:
+    if split is None:
+        return SPLITS
+    if split not in SPLITS:
+        raise ValueError(f"Unknown split {split}, expected one of {', '.join(SPLITS)}.")
+    return split,
+
 class ProtobufDataset(WrecksysDataset):
     _class_logger = logging.getLogger(__name__).getChild(__qualname__)
     def __init__(self,
@@ -50,15 +447,30 @@ class ProtobufDataset(WrecksysDataset):
                  max_length: int = 10,
                  num_shards: int = 10,
                  file_names: str = 'goodreads',
+                 workers: int | None = None,
+                 split_by: str = 'user',
+                 split_fraction: float = .1,
+                 read_size: int = 1 << 10,
+                 deterministic: bool = False,
+                 cache: bool = False,
                  **kwargs):
 
         self.input_file = pathlib.Path(input_file)
         self.output_dir = pathlib.Path(output_dir)
-        self.file_template = f'{file_names}{{:02}}.tfrecord'
+        self.file_names = file_names
+        self.file_template = f'{file_names}.{{}}{{:02}}.tfrecord'
+        self.manifest_file = self.output_dir / f'{file_names}.users.feather'
+        self.split_file = self.output_dir / f'{file_names}.split.json'
+        self.sizes_file = self.output_dir / f'{file_names}.sizes.json'
 
         self.min_length = min_length
         self.max_length = max_length
         self.num_shards = num_shards
+        self.workers = workers
+        self.split_spec = SplitSpec(split_by, split_fraction)
+        self.read_size = read_size
+        self.deterministic = deterministic
+        self.cache = cache
         self.size = -1
 
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -70,35 +482,126 @@ class ProtobufDataset(WrecksysDataset):
             self._class_logger.debug("Dataset already built.")
             return
 
-        records = []
-
-        df = pd.read_feather(self.input_file, dtype_backend='pyarrow')
-
-        with tqdm(total=len(df.user_id.unique()),
-                  desc="Building user timelines ",
-                  file=sys.stdout,
-                  unit=' users') as timeline_progress:
-            for _, group in df.groupby('user_id', observed=True):
-                books: list = group['work_id'].tolist()
-                ratings: list = group['rating'].tolist()
-
-                if len(books) >= self.min_length:
-                    user_examples = self._build_single_examples(books, ratings)
-                    records.extend(user_examples)
-
-                timeline_progress.update(1)
-
-        del df
-
-        self.size = len(records)
-        n = self.size // self.num_shards
-        chunks = [records[x:x+n] for x in range(0, self.size, n)]
-        for i in range(self.num_shards):
-            self._write_tf_records(chunks[i], i)
-
-        self._class_logger.info(f"Successfully created {self.size} training examples in {len(chunks)} files.")
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        spec = self.split_spec.with_cutoffs(self.input_file)
+        with self.split_file.open('w') as f:
+            json.dump(spec.to_dict(), f, indent=4)
+
+        # The input is read once to split it by shard, and each worker then reads only its shard, building every
+        # window once and writing it to the file of its split.
+        sizes = {}
+        with tempfile.TemporaryDirectory(dir=self.output_dir) as temp_dir:
+            partitions = [pathlib.Path(temp_dir) / f'{shard:02}.arrow' for shard in range(self.num_shards)]
+            partition_timelines(self.input_file, partitions, spec.columns)
+
+            context = multiprocessing.get_context('spawn')
+            with futures.ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+                jobs = {
+                    pool.submit(write_tfrecord_shards,
+                                partition,
+                                [self.output_dir / self.file_template.format(name, shard) for name in SPLITS],
+                                self.min_length,
+                                self.max_length,
+                                spec=spec): shard
+                    for shard, partition in enumerate(partitions)
+                }
+                for job in tqdm(futures.as_completed(jobs),
+                                total=len(jobs),
+                                desc="Creating TFRecords ",
+                                file=sys.stdout,
+                                unit=' shards'):
+                    sizes.update({self.file_template.format(name, jobs[job]): size
+                                  for name, size in zip(SPLITS, job.result())})
+
+        feather.write_feather(user_manifest(*read_timelines(self.input_file), self.num_shards), self.manifest_file)
+        self._write_sizes(sizes)
+
+        self.size = sum(sizes.values())
+        self._class_logger.info(f"Successfully created {self.size} training examples in {len(sizes)} files.")
         return self.size
 
+    def update(self, users: np.ndarray) -> int:
+        """
+        Rewrites the examples of the given users after their timelines changed in the input file.
+
+        Users whose old timeline is an unchanged prefix of their new one only gain windows, which are appended to
+        their shard of each split. Any other change (edited or back-dated interactions) rebuilds the shards those
+        users live in. The split cutoffs stay where the build put them. Returns the number of examples written.
+        """
+        if not self.exists() or not self.manifest_file.exists():
+            return self.build()
+
+        with self.split_file.open('r') as f:
+            spec = SplitSpec.from_dict(json.load(f))
+
+        users = np.unique(np.asarray(users, dtype=np.int32))
+        manifest = feather.read_table(self.manifest_file)
+        known = manifest.filter(pc.is_in(manifest.column('user_id'), value_set=pa.array(users))).to_pandas()
+        known = known.set_index('user_id')
+
+        arrays = read_timelines(self.input_file, users, timestamps=True)
+        changes, starts, old_lengths = diff_timelines(known, *arrays[:3], self.num_shards)
+
+        appended = {}
+        dirty = set()
+        for change, start, old_length in zip(changes.itertuples(), starts, old_lengths):
+            if old_length < 0:
+                dirty.add(change.shard)
+                continue
+            windows = timeline_windows(arrays, start, change.length, old_length,
+                                       self.min_length, self.max_length, spec)
+            for split, split_windows in windows.items():
+                appended.setdefault((split, change.shard), []).append(split_windows)
+
+        # Users that vanished from the input still have windows in their shard.
+        dirty.update(known.loc[known.index.difference(changes.index), 'shard'])
+
+        size = 0
+        sizes = self._read_sizes()
+        for (split, shard), windows in appended.items():
+            if shard not in dirty:
+                written = self._append_tf_records(Windows(*[np.concatenate(a) for a in zip(*windows)]), split, shard)
+                if sizes is not None:
+                    sizes[self.file_template.format(SPLITS[split], shard)] += written
+                size += written
+        for shard in sorted(dirty):
+            written = write_tfrecord_shards(self.input_file,
+                                            [self.output_dir / self.file_template.format(name, shard)
+                                             for name in SPLITS],
+                                            self.min_length,
+                                            self.max_length,
+                                            shard,
+                                            self.num_shards,
+                                            spec)
+            if sizes is not None:
+                sizes.update({self.file_template.format(name, shard): n for name, n in zip(SPLITS, written)})
+            size += sum(written)
+        if sizes is not None:
+            self._write_sizes(sizes)
+
+        manifest = manifest.filter(pc.invert(pc.is_in(manifest.column('user_id'), value_set=pa.array(users))))
+        manifest = pa.concat_tables([manifest, pa.Table.from_pandas(changes.reset_index(), preserve_index=False)
+                                    .cast(manifest.schema)])
+        manifest = manifest.sort_by('user_id')
+        feather.write_feather(manifest, self.manifest_file)
+
+        lengths = manifest.column('length').to_numpy()
+        self.size = int(np.maximum(np.minimum(lengths - 1, lengths - self.min_length), 0).sum())
+        self._class_logger.info(f"Updated {len(users)} users: wrote {size} examples, rebuilt {len(dirty)} shards.")
+        return size
+
+    def _append_tf_records(self, windows: Windows, split: int, shard: int) -> int:
+        # Uncompressed TFRecord files are plain sequences of framed records, so appending one to another is valid.
+        shard_file = self.output_dir / self.file_template.format(SPLITS[split], shard)
+        delta_file = shard_file.with_name(f"{shard_file.name}.delta")
+        with tf.io.TFRecordWriter(str(delta_file)) as f:
+            for example in serialize_examples(windows):
+                f.write(example)
+        with shard_file.open('ab') as out, delta_file.open('rb') as delta:
+            shutil.copyfileobj(delta, out)
+        delta_file.unlink()
+        return len(windows.label_id)
+
     def delete(self) -> None:
         for file in self.output_dir.iterdir():
             file.unlink()
@@ -106,15 +609,88 @@ class ProtobufDataset(WrecksysDataset):
         self._class_logger.info(f"Removed {self.output_dir}.")
 
     def exists(self) -> bool:
-        return self.num_shards == len([f for f in self.output_dir.glob('*.tfrecord')])
+        return self.num_shards * len(SPLITS) == len([f for f in self.output_dir.glob('*.tfrecord')])
 
-    def load(self) -> tf.data.Dataset:
+    def load(self, split: str | None = None, num_pipelines: int = 1, pipeline_id: int = 0) -> tf.data.Dataset:
+        """
+        Reads the shards of a split in parallel, interleaving their records, and parses them read_size at a time.
+
+        Records come out in whatever order the readers produce them unless the dataset is deterministic, which is
+        fine for training and evaluation alike since both batch examples independently. Parsed examples are only
+        cached in memory if asked to, since the whole dataset doesn't fit on every machine.
+        """
         if not self.exists():
             self.build()
 
+        files = self._files(split)
+        # Pipelines split the files between them when each gets as many, and the records otherwise, so that no
+        # worker reads a file more than the others. The shards of a split hold about the same number of records.
+        by_file = len(files) % num_pipelines == 0
+        if by_file:
+            files = files[pipeline_id::num_pipelines]
+        d = tf.data.Dataset.from_tensor_slices(files)
+        # Sharding records by position only splits them between pipelines if every pipeline sees the same order.
+        d = d.interleave(tf.data.TFRecordDataset,
+                         cycle_length=len(files),
+                         num_parallel_calls=tf.data.AUTOTUNE,
+                         deterministic=self.deterministic or not by_file)
+        if not by_file:
+            d = d.shard(num_pipelines, pipeline_id)
+        d = d.batch(self.read_size)
+        d = d.map(self._parse_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=self.deterministic)
+        d = d.unbatch()
+
+        sizes = self._read_sizes()
+        if sizes is not None:
+            size = sum(sizes[pathlib.Path(f).name] for f in files)
+            if not by_file:
+                size = size // num_pipelines + (pipeline_id < size % num_pipelines)
+            d = d.apply(tf.data.experimental.assert_cardinality(size))
+        if self.cache:
+            d = d.cache()
+        return d
+
+    def benchmark(self, split: str | None = None, limit: int | None = None) -> dict[str, float]:
+        """
+        Records per second through a sequential reader parsing one record at a time, and through load().
+        """
+        if not self.exists():
+            self.build()
+
+        def _parse(example):
+            features = tf.io.parse_single_example(example, self._feature_description())
+            features['context_id'] = tf.cast(features['context_id'], tf.int32)
+            features['label_id'] = tf.cast(features['label_id'], tf.int32)
+            return features, features['label_id']
+
+        sequential = tf.data.TFRecordDataset(self._files(split)).map(_parse, num_parallel_calls=tf.data.AUTOTUNE)
+        results = {
+            'sequential': throughput(sequential, limit),
+            'parallel': throughput(self.load(split), limit)
+        }
+        self._class_logger.info(f"Sequential: {results['sequential']:,.0f} records/s, "
+                                f"parallel: {results['parallel']:,.0f} records/s "
+                                f"({results['parallel'] / results['sequential']:.1f}x)")
+        return results
+
+    def _read_sizes(self) -> dict[str, int] | None:
+        # The number of records in each file, which datasets built before it was recorded don't have.
+        if not self.sizes_file.exists():
+            return None
+        with self.sizes_file.open('r') as f:
+            return json.load(f)
+
+    def _write_sizes(self, sizes: dict[str, int]) -> None:
+        with self.sizes_file.open('w') as f:
+            json.dump(dict(sorted(sizes.items())), f, indent=4)
+
+    def _files(self, split: str | None) -> list[str]:
         # Sadly, TensorFlow doesn't like Path objects.
-        files = [str(f) for f in self.output_dir.glob('*.tfrecord')]
-        feature_description = {
+        return sorted(str(f) for name in _split_names(split)
+                      for f in self.output_dir.glob(f'{self.file_names}.{name}[0-9][0-9].tfrecord'))
+
+    def _feature_description(self) -> dict[str, tf.io.FixedLenFeature]:
+        return {
             'context_id': tf.io.FixedLenFeature(
                 [self.max_length], tf.int64, default_value=[0 for _ in range(self.max_length)]),
             'context_rating': tf.io.FixedLenFeature(
@@ -122,167 +698,559 @@ class ProtobufDataset(WrecksysDataset):
             'label_id': tf.io.FixedLenFeature([1], tf.int64, default_value=[0])
         }
 
-        def _parse(example):
-            features = tf.io.parse_single_example(example, feature_description)
-            features['context_id'] = tf.cast(features['context_id'], tf.int32)
-            features['label_id'] = tf.cast(features['label_id'], tf.int32)
-            return features, features['label_id']
+    def _parse_batch(self, examples: tf.Tensor) -> tuple[dict[str, tf.Tensor], tf.Tensor]:
+        features = tf.io.parse_example(examples, self._feature_description())
+        features['context_id'] = tf.cast(features['context_id'], tf.int32)
+        features['label_id'] = tf.cast(features['label_id'], tf.int32)
+        return features, features['label_id']
 
-        d = tf.data.TFRecordDataset(files)
-        d = d.map(_parse, num_parallel_calls=tf.data.AUTOTUNE)
-        d = d.cache()
-        return d
-
-    def _build_single_examples(self, books: list[int], ratings: list[int]) -> list[SingleExample]:
-        examples = []
+class NumpyDataset(WrecksysDataset):
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+    def __init__(self,
+                 input_file: str | os.PathLike,
+                 output_dir: str | os.PathLike,
+                 min_length: int = 3,
+                 max_length: int = 10,
+                 split_by: str = 'user',
+                 split_fraction: float = .1,
+                 **kwargs):
 
-        for label in range(1, len(books)):
-            pos = max(0, label - self.max_length)
-            length = label - pos
+        self.input_file = pathlib.Path(input_file)
+        self.output_files = {name: pathlib.Path(output_dir) / f'goodreads.{name}.npz' for name in SPLITS}
+        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-            if length >= self.min_length:
-                dif = self.max_length - length
-                pad = [0 for _ in range(dif)]
+        self.min_length = min_length
+        self.max_length = max_length
+        self.split_spec = SplitSpec(split_by, split_fraction)
+        self.size = -1
 
-                context_id = books[pos:label] + pad
-                context_rating = ratings[pos:label] + pad
-                label_id = [books[label]]
+        self._class_logger.debug(f"Input file: {self.input_file}")
+        self._class_logger.debug(f"Output directory: {output_dir}")
 
-                examples.append(SingleExample(context_id, context_rating, label_id))
+    def build(self) -> int | None:
+        if self.exists():
+            self._class_logger.debug("Dataset already built.")
+            return
 
-        return examples
+        spec = self.split_spec.with_cutoffs(self.input_file)
+        self.size = 0
+        for split, name in enumerate(SPLITS):
+            windows = [w for w in tqdm(iter_windows(self.input_file, self.min_length, self.max_length,
+                                                    split=split, spec=spec),
+                                       desc=f"Building {name} timelines ",
+                                       file=sys.stdout,
+                                       unit=' batches')]
+            context_ids, context_ratings, label_ids = [np.concatenate(arrays) for arrays in zip(*windows)]
+            del windows
+
+            self.size += len(label_ids)
+            with open(self.output_files[name], 'wb') as f:
+                np.savez_compressed(f,
+                                    context_id=context_ids,
+                                    context_rating=context_ratings,
+                                    label_id=label_ids
+                                    )
+
+        self._class_logger.info(f"Successfully saved {self.size} training examples to "
+                                f"{self.output_files['train'].parent}")
+        return self.size
 
+    def delete(self) -> None:
+        for file in self.output_files.values():
+            file.unlink(missing_ok=True)
+        self._class_logger.info(f"Removed {', '.join(f.name for f in self.output_files.values())}.")
 
-    def _write_tf_records(self, examples, file_num) -> None:
+    def exists(self) -> bool:
+        return all(file.exists() for file in self.output_files.values())
 
-        filename = str(self.output_dir / self.file_template.format(file_num))
-        logger.debug(f"Writing {len(examples):,} records to {filename}")
-        tf_examples = []
+    def load(self, split: str | None = None, num_pipelines: int = 1, pipeline_id: int = 0) -> tf.data.Dataset:
+        if not self.exists():
+            self.build()
 
-        def _create_tf_example(context_id, context_rating, label_id):
-            return tf.train.Example(
-                features=tf.train.Features(
-                    feature={
-                        "context_id": tf.train.Feature(int64_list=tf.train.Int64List(value=context_id)),
-                        "context_rating": tf.train.Feature(float_list=tf.train.FloatList(value=context_rating)),
-                        "label_id": tf.train.Feature(int64_list=tf.train.Int64List(value=label_id))
-                    }
-                )
-            )
+        d = None
+        for name in _split_names(split):
+            with open(self.output_files[name], 'rb') as f:
+                npz = np.load(f)
+                labels = npz['label_id']
+                logger.debug(f"Loaded {self.output_files[name].name}")
+                part = tf.data.Dataset.from_tensor_slices((dict(npz), labels))
+            d = part if d is None else d.concatenate(part)
+        return d.shard(num_pipelines, pipeline_id) if num_pipelines > 1 else d
 
-        with tqdm(total=len(examples),
-                  desc=f"Creating TFRecords ({file_num+1}/{self.num_shards}): ",
-                  file=sys.stdout,
-                  unit=' examples') as conversion_progress:
-            for example in examples:
-                tf_examples.append(_create_tf_example(*example))
-                conversion_progress.update(1)
 
-        with tf.io.TFRecordWriter(filename) as f:
-            for example in tf_examples:
-                f.write(example.SerializeToString())
 
+class MemmapDataset(WrecksysDataset):
+    """
+    Stores examples as uncompressed, fixed-dtype .npy shards that are memory-mapped at load time.
 
-class NumpyDataset(WrecksysDataset):
+    Nothing is decompressed or copied up front. The loader reads slices of the shards inside the tf.data pipeline,
+    and the page cache is shared between every process reading the same files. Each shard also keeps the user_id of
+    its examples, in sorted order, which update() uses to find a user's examples without reading the others.
+    """
     _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+    fields = {
+        'context_id': np.int32,
+        'context_rating': np.int8,
+        'label_id': np.int32
+    }
+
     def __init__(self,
                  input_file: str | os.PathLike,
                  output_dir: str | os.PathLike,
                  min_length: int = 3,
                  max_length: int = 10,
+                 shard_size: int = 1 << 20,
+                 read_size: int = 1 << 14,
+                 file_names: str = 'goodreads',
+                 split_by: str = 'user',
+                 split_fraction: float = .1,
                  **kwargs):
 
         self.input_file = pathlib.Path(input_file)
-        self.output_file = pathlib.Path(output_dir) / 'goodreads.npz'
-        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.output_dir = pathlib.Path(output_dir)
+        self.file_names = file_names
+        self.manifest_file = self.output_dir / f'{file_names}.json'
+        self.users_file = self.output_dir / f'{file_names}.users.feather'
+        self.file_template = f'{file_names}.{{}}{{:02}}.{{}}.npy'
 
         self.min_length = min_length
         self.max_length = max_length
+        self.shard_size = shard_size
+        self.read_size = read_size
+        self.split_spec = SplitSpec(split_by, split_fraction)
         self.size = -1
 
+        self.output_dir.mkdir(parents=True, exist_ok=True)
         self._class_logger.debug(f"Input file: {self.input_file}")
-        self._class_logger.debug(f"Output file: {self.output_file}")
+        self._class_logger.debug(f"Output directory: {self.output_dir}")
 
     def build(self) -> int | None:
         if self.exists():
             self._class_logger.debug("Dataset already built.")
             return
 
-        context_ids = []
-        context_ratings = []
-        label_ids = []
+        spec = self.split_spec.with_cutoffs(self.input_file)
+        shards = {name: self._build_split(split, spec) for split, name in enumerate(SPLITS)}
+
+        self.size = sum(sum(sizes) for sizes in shards.values())
+        manifest = {
+            'size': self.size,
+            'max_length': self.max_length,
+            'min_length': self.min_length,
+            'split': spec.to_dict(),
+            'shards': shards
+        }
+        with self.manifest_file.open('w') as f:
+            json.dump(manifest, f, indent=4)
+        feather.write_feather(user_manifest(*read_timelines(self.input_file), 1), self.users_file)
+
+        self._class_logger.info(f"Successfully created {self.size} training examples in "
+                                f"{sum(len(sizes) for sizes in shards.values())} shards.")
+        return self.size
 
-        df = pd.read_feather(self.input_file, dtype_backend='pyarrow')
+    def _build_split(self, split: int, spec: SplitSpec) -> list[int]:
+        name = SPLITS[split]
+        shards = []
+        pending = []
+        pending_size = 0
+
+        for windows, users in tqdm(iter_windows(self.input_file, self.min_length, self.max_length,
+                                                split=split, spec=spec, with_users=True),
+                                   desc=f"Building {name} timelines ",
+                                   file=sys.stdout,
+                                   unit=' batches'):
+            pending.append((*windows, users))
+            pending_size += len(users)
+            while pending_size >= self.shard_size:
+                records = [np.concatenate(arrays) for arrays in zip(*pending)]
+                shard = [a[:self.shard_size] for a in records]
+                shards.append(self._write_shard(Windows(*shard[:3]), shard[3], name, len(shards)))
+                pending = [[a[self.shard_size:] for a in records]]
+                pending_size -= self.shard_size
+
+        if pending_size > 0:
+            records = [np.concatenate(arrays) for arrays in zip(*pending)]
+            shards.append(self._write_shard(Windows(*records[:3]), records[3], name, len(shards)))
+        return shards
+
+    def update(self, users: np.ndarray) -> int:
+        """
+        Replaces the examples of the given users after their timelines changed in the input file.
+
+        Users whose old timeline is an unchanged prefix of their new one only gain windows. Any other change
+        (edited, back-dated or removed interactions) drops all of the user's examples from the shards holding them,
+        which are rewritten, and builds them again. The new windows of a split go to one new shard. Since every shard
+        is sorted by user, finding a user's examples is a binary search, so the cost follows the size of the delta
+        and not of the dataset. The split cutoffs stay where the build put them. Returns the number of examples
+        written.
+        """
+        if not self.exists() or not self.users_file.exists():
+            # Built before the user manifest was kept, so there's nothing to compare the new timelines to.
+            self.delete()
+            return self.build()
+
+        with self.manifest_file.open('r') as f:
+            manifest = json.load(f)
+        spec = SplitSpec.from_dict(manifest['split'])
+
+        users = np.unique(np.asarray(users, dtype=np.int32))
+        user_table = feather.read_table(self.users_file)
+        known = user_table.filter(pc.is_in(user_table.column('user_id'), value_set=pa.array(users)))
+        known = known.to_pandas().set_index('user_id')
+
+        arrays = read_timelines(self.input_file, users, timestamps=True)
+        changes, starts, old_lengths = diff_timelines(known, *arrays[:3])
+        replaced = np.union1d(changes.index[old_lengths < 0], known.index.difference(changes.index))
+
+        # changes is sorted by user, so the new shards are too.
+        added = {split: [] for split in range(len(SPLITS))}
+        for user, change, start, old_length in zip(changes.index, changes.itertuples(), starts, old_lengths):
+            windows = timeline_windows(arrays, start, change.length, max(old_length, 0),
+                                       self.min_length, self.max_length, spec)
+            for split, split_windows in windows.items():
+                added[split].append((*split_windows, np.full(len(split_windows.label_id), user, np.int32)))
+
+        size = 0
+        rewritten = 0
+        for split, name in enumerate(SPLITS):
+            sizes = manifest['shards'][name]
+            for shard in range(len(sizes)):
+                remaining = self._drop_users(name, shard, replaced.astype(np.int32))
+                if remaining is not None:
+                    sizes[shard] = remaining
+                    rewritten += 1
+            if added[split]:
+                records = [np.concatenate(arrays) for arrays in zip(*added[split])]
+                sizes.append(self._write_shard(Windows(*records[:3]), records[3], name, len(sizes)))
+                size += sizes[-1]
+
+        self.size = manifest['size'] = sum(sum(sizes) for sizes in manifest['shards'].values())
+        with self.manifest_file.open('w') as f:
+            json.dump(manifest, f, indent=4)
+
+        user_table = user_table.filter(pc.invert(pc.is_in(user_table.column('user_id'), value_set=pa.array(users))))
+        user_table = pa.concat_tables([user_table, pa.Table.from_pandas(changes.reset_index(), preserve_index=False)
+                                      .cast(user_table.schema)])
+        feather.write_feather(user_table.sort_by('user_id'), self.users_file)
+
+        self._class_logger.info(f"Updated {len(users)} users: wrote {size} examples, rewrote {rewritten} shards.")
+        return size
+
+    def _drop_users(self, split: str, shard: int, users: np.ndarray) -> int | None:
+        # Rewrites a shard without the examples of the given users, and returns its new size, or None if it had
+        # none of them. Each user's examples are one range of the sorted user_ids.
+        shard_users = np.load(self._shard_file(split, shard, 'user_id'), mmap_mode='r')
+        begins = np.searchsorted(shard_users, users, side='left')
+        ends = np.searchsorted(shard_users, users, side='right')
+        if not (ends > begins).any():
+            return None
+
+        edges = np.zeros(len(shard_users) + 1, dtype=np.int64)
+        np.add.at(edges, begins, 1)
+        np.add.at(edges, ends, -1)
+        keep = np.cumsum(edges[:-1]) == 0
+        records = Windows(*[np.load(self._shard_file(split, shard, field))[keep] for field in self.fields])
+        return self._write_shard(records, shard_users[keep], split, shard)
 
-        with tqdm(total=len(df.user_id.unique()),
-                  desc="Building user timelines ",
-                  file=sys.stdout,
-                  unit=' users') as timeline_progress:
-            for _, group in df.groupby('user_id', observed=True):
-                books: list = group['work_id'].tolist()
-                ratings: list = group['rating'].tolist()
+    def delete(self) -> None:
+        for file in self.output_dir.glob(f'{self.file_names}.*[0-9][0-9].*.npy'):
+            file.unlink()
+        self.manifest_file.unlink(missing_ok=True)
+        self.users_file.unlink(missing_ok=True)
+        self._class_logger.info(f"Removed {self.manifest_file.stem} shards from {self.output_dir}.")
 
-                if len(books) >= self.min_length:
-                    books, ratings, labels = self._build_user_data(books, ratings)
-                    context_ids.extend(books)
-                    context_ratings.extend(ratings)
-                    label_ids.extend(labels)
+    def exists(self) -> bool:
+        return self.manifest_file.exists()
 
-                timeline_progress.update(1)
+    def load(self, split: str | None = None, num_pipelines: int = 1, pipeline_id: int = 0) -> tf.data.Dataset:
+        if not self.exists():
+            self.build()
 
-        del df
+        with self.manifest_file.open('r') as f:
+            manifest = json.load(f)
+        self.size = manifest['size']
+
+        sizes = [(name, i, size) for name in _split_names(split) for i, size in enumerate(manifest['shards'][name])]
+        shards = [
+            {field: np.load(self._shard_file(name, i, field), mmap_mode='r') for field in self.fields}
+            for name, i, _ in sizes
+        ]
+        slices = np.array([
+            (i, start, min(start + self.read_size, size))
+            for i, (_, _, size) in enumerate(sizes)
+            for start in range(0, size, self.read_size)
+        ], dtype=np.int64).reshape(-1, 3)[pipeline_id::num_pipelines]
+
+        def _read(shard, start, stop):
+            return tuple(np.asarray(shards[shard][field][start:stop]) for field in self.fields)
+
+        def _format(context_id, context_rating, label_id):
+            context_id.set_shape([None, self.max_length])
+            context_rating.set_shape([None, self.max_length])
+            label_id.set_shape([None, 1])
+            features = {
+                'context_id': context_id,
+                'context_rating': tf.cast(context_rating, tf.float32),
+                'label_id': label_id
+            }
+            return features, label_id
+
+        d = tf.data.Dataset.from_tensor_slices(slices)
+        d = d.map(lambda s: tf.numpy_function(_read, [s[0], s[1], s[2]], [tf.int32, tf.int8, tf.int32]),
+                  num_parallel_calls=tf.data.AUTOTUNE)
+        d = d.map(_format)
+        d = d.unbatch()
+        d = d.apply(tf.data.experimental.assert_cardinality(int((slices[:, 2] - slices[:, 1]).sum())))
+        logger.debug(f"Mapped {len(shards)} shards from {self.output_dir}")
+        return d
 
-        self.size = len(label_ids)
-        with open(self.output_file, 'wb') as f:
-            np.savez_compressed(f,
-                                context_id=np.array(context_ids),
-                                context_rating=np.array(context_ratings),
-                                label_id=np.array(label_ids)
-                                )
+    def _shard_file(self, split: str, shard: int, field: str) -> pathlib.Path:
+        return self.output_dir / self.file_template.format(split, shard, field)
+
+    def _write_shard(self, records: Windows, users: np.ndarray, split: str, shard: int) -> int:
+        arrays = {field: array.astype(dtype) for (field, dtype), array in zip(self.fields.items(), records)}
+        arrays['user_id'] = np.asarray(users, dtype=np.int32)
+        for field, array in arrays.items():
+            # Written beside the shard and moved over it, since readers may have the old one memory-mapped.
+            file = self._shard_file(split, shard, field)
+            partial_file = file.with_name(f"{file.name}.partial")
+            with partial_file.open('wb') as f:
+                np.save(f, array)
+            partial_file.replace(file)
+        logger.debug(f"Wrote {len(records.label_id):,} records to {split} shard {shard:02}")
+        return len(records.label_id)
+
+
+class TimelineDataset(WrecksysDataset):
+    """
+    Stores each user's timeline once, as flat work_id/rating arrays plus CSR-style user offsets.
+
+    Windows are gathered from the timelines inside the tf.data graph, so min_length and max_length can change
+    without a rebuild and no interaction is stored more than once. Within a timeline, the labels of each split are a
+    contiguous range, since timelines are sorted by time, so the splits are stored as two boundaries per user.
+    """
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
 
-        self._class_logger.info(f"Successfully saved {self.size} training examples to {self.output_file}")
+    def __init__(self,
+                 input_file: str | os.PathLike,
+                 output_dir: str | os.PathLike,
+                 min_length: int = 3,
+                 max_length: int = 10,
+                 read_size: int = 1 << 12,
+                 file_names: str = 'timeline',
+                 split_by: str = 'user',
+                 split_fraction: float = .1,
+                 **kwargs):
+
+        if min_length > max_length:
+            raise ValueError(f"min_length ({min_length}) can't be longer than max_length ({max_length}).")
+
+        self.input_file = pathlib.Path(input_file)
+        self.output_dir = pathlib.Path(output_dir)
+        self.files = {
+            'work_id': self.output_dir / f'{file_names}.work_id.npy',
+            'rating': self.output_dir / f'{file_names}.rating.npy',
+            'offsets': self.output_dir / f'{file_names}.offsets.npy',
+            'splits': self.output_dir / f'{file_names}.splits.npy',
+            'user_id': self.output_dir / f'{file_names}.user_id.npy',
+            'spec': self.output_dir / f'{file_names}.split.json'
+        }
+
+        self.min_length = min_length
+        self.max_length = max_length
+        self.read_size = read_size
+        self.split_spec = SplitSpec(split_by, split_fraction)
+        self.size = -1
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._class_logger.debug(f"Input file: {self.input_file}")
+        self._class_logger.debug(f"Output directory: {self.output_dir}")
+
+    def build(self) -> int | None:
+        if self.exists():
+            self._class_logger.debug("Dataset already built.")
+            return
+
+        spec = self.split_spec.with_cutoffs(self.input_file)
+        table = feather.read_table(self.input_file,
+                                   columns=['user_id', 'work_id', 'rating'] + spec.columns,
+                                   memory_map=True)
+        users = table.column('user_id').to_numpy()
+        offsets, boundaries = self._timeline_splits(users, _timestamps(table) if spec.by == 'time' else None, spec)
+
+        with self.files['spec'].open('w') as f:
+            json.dump(spec.to_dict(), f, indent=4)
+        self._save(work_id=table.column('work_id').to_numpy(),
+                   rating=table.column('rating').to_numpy(),
+                   offsets=offsets,
+                   splits=boundaries,
+                   user_id=users[offsets[:-1]])
+        del table, users
+
+        self.size = self._count_windows(*self._label_ranges(offsets, boundaries))
+        self._class_logger.info(f"Successfully saved {len(offsets) - 1} user timelines "
+                                f"({self.size} training examples) to {self.output_dir}")
         return self.size
 
+    def update(self, users: np.ndarray) -> int:
+        """
+        Replaces the timelines of the given users after they changed in the input file.
+
+        Only those users are read from the input file. Their new timelines are spliced in between the runs of
+        untouched users, which are copied across as they are, and the offsets and split boundaries are shifted to
+        match. The split cutoffs stay where the build put them. Returns the number of examples in the new timelines.
+        """
+        if not self.exists():
+            # Built before user ids and the split were kept, so the timelines can't be matched to users.
+            self.delete()
+            return self.build()
+
+        with self.files['spec'].open('r') as f:
+            spec = SplitSpec.from_dict(json.load(f))
+
+        users = np.unique(np.asarray(users, dtype=np.int32))
+        user_ids, work_ids, ratings, timestamps = read_timelines(self.input_file, users, timestamps=True)
+        new_offsets, new_boundaries = self._timeline_splits(user_ids, timestamps, spec)
+        new_users = user_ids[new_offsets[:-1]]
+
+        old_users = np.load(self.files['user_id'])
+        offsets = np.load(self.files['offsets'])
+        boundaries = np.load(self.files['splits'])
+        old_work_ids = np.load(self.files['work_id'], mmap_mode='r')
+        old_ratings = np.load(self.files['rating'], mmap_mode='r')
+
+        # Pieces of the new arrays, in user order: runs of untouched old timelines, and the new timelines. Each is
+        # (arrays, user_ids, lengths, boundaries relative to the timeline's start).
+        pieces = []
+        cursor = 0
+        replaced = np.searchsorted(old_users, users)
+        found = np.isin(users, old_users)
+        for user, index, is_old in zip(users, replaced, found):
+            if index > cursor:
+                run = slice(offsets[cursor], offsets[index])
+                pieces.append(((old_work_ids[run], old_ratings[run]),
+                               old_users[cursor:index],
+                               np.diff(offsets[cursor:index + 1]),
+                               boundaries[cursor:index] - offsets[cursor:index, np.newaxis]))
+            new = np.searchsorted(new_users, user)
+            if new < len(new_users) and new_users[new] == user:
+                timeline = slice(new_offsets[new], new_offsets[new + 1])
+                pieces.append(((work_ids[timeline], ratings[timeline]),
+                               new_users[new:new + 1],
+                               np.diff(new_offsets[new:new + 2]),
+                               new_boundaries[new:new + 1] - new_offsets[new]))
+            cursor = max(cursor, index + 1 if is_old else index)
+        if cursor < len(old_users):
+            run = slice(offsets[cursor], offsets[-1])
+            pieces.append(((old_work_ids[run], old_ratings[run]),
+                           old_users[cursor:],
+                           np.diff(offsets[cursor:]),
+                           boundaries[cursor:] - offsets[cursor:-1, np.newaxis]))
+
+        lengths = np.concatenate([piece[2] for piece in pieces])
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        boundaries = np.concatenate([piece[3] for piece in pieces]) + offsets[:-1, np.newaxis]
+        self._save(work_id=np.concatenate([piece[0][0] for piece in pieces]),
+                   rating=np.concatenate([piece[0][1] for piece in pieces]),
+                   offsets=offsets,
+                   splits=boundaries,
+                   user_id=np.concatenate([piece[1] for piece in pieces]))
+        del old_work_ids, old_ratings
+
+        self.size = self._count_windows(*self._label_ranges(offsets, boundaries))
+        size = self._count_windows(*self._label_ranges(new_offsets, new_boundaries))
+        self._class_logger.info(f"Updated {len(users)} users: {size} examples in their new timelines.")
+        return size
+
+    @staticmethod
+    def _timeline_splits(users: np.ndarray,
+                         timestamps: np.ndarray | None,
+                         spec: SplitSpec) -> tuple[np.ndarray, np.ndarray]:
+        # The offsets of user-contiguous timelines, and where each one's validation and test labels begin.
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.array([], np.int64)
+        offsets = np.r_[starts, len(users)].astype(np.int64)
+
+        # Each user's train labels end where validation begins, and validation ends where test begins.
+        splits = spec.assign(users, timestamps)
+        timeline = np.repeat(np.arange(len(starts)), np.diff(offsets))
+        counts = np.bincount(timeline * len(SPLITS) + splits, minlength=len(starts) * len(SPLITS))
+        boundaries = offsets[:-1, np.newaxis] + np.cumsum(counts.reshape(-1, len(SPLITS))[:, :-1], axis=1)
+        return offsets, boundaries.astype(np.int64)
+
+    def _save(self, **arrays: np.ndarray) -> None:
+        dtypes = {'work_id': np.int32, 'rating': np.int8, 'offsets': np.int64, 'splits': np.int64, 'user_id': np.int32}
+        for name, array in arrays.items():
+            # Written beside the old file and moved over it, since readers may have the old one memory-mapped.
+            partial_file = self.files[name].with_name(f"{self.files[name].name}.partial")
+            with partial_file.open('wb') as f:
+                np.save(f, np.asarray(array).astype(dtypes[name]))
+            partial_file.replace(self.files[name])
+
     def delete(self) -> None:
-        self.output_file.unlink()
-        self._class_logger.info(f"Removed {self.output_file}.")
+        for file in self.files.values():
+            file.unlink(missing_ok=True)
+        self._class_logger.info(f"Removed timelines from {self.output_dir}.")
 
     def exists(self) -> bool:
-        return self.output_file.exists()
+        return all(file.exists() for file in self.files.values())
 
-    def load(self) -> tf.data.Dataset:
+    def load(self, split: str | None = None, num_pipelines: int = 1, pipeline_id: int = 0) -> tf.data.Dataset:
         if not self.exists():
             self.build()
 
-        with open(self.output_file, 'rb') as f:
-            npz = np.load(f)
-            labels = npz['label_id']
-            logger.debug(f"Loaded {self.output_file.name}")
-            return tf.data.Dataset.from_tensor_slices((dict(npz), labels))
-
-    def _build_user_data(self,
-                         books: list[int],
-                         ratings: list[int]) -> tuple[list[np.ndarray], list[np.ndarray], list[np.ndarray]]:
-        user_context_ids = []
-        user_context_ratings = []
-        user_label_ids = []
-
-        for label in range(1, len(books)):
-            pos = max(0, label - self.max_length)
-            length = label - pos
-
-            if length >= self.min_length:
-                context_id = np.array(books[pos:label], dtype=np.int32)
-                context_id.resize(self.max_length)
-                context_rating = np.array(ratings[pos:label], dtype=np.float32)
-                context_rating.resize(self.max_length)
-                label_id = np.array([books[label]], dtype=np.int32)
-
-                user_context_ids.append(context_id)
-                user_context_ratings.append(context_rating)
-                user_label_ids.append(label_id)
-
-        return user_context_ids, user_context_ratings, user_label_ids
+        offsets = np.load(self.files['offsets'])
+        boundaries = np.load(self.files['splits'])
+        work_ids = tf.convert_to_tensor(np.load(self.files['work_id'], mmap_mode='r'))
+        ratings = tf.convert_to_tensor(np.load(self.files['rating'], mmap_mode='r'))
+        self.size = self._count_windows(*self._label_ranges(offsets, boundaries))
+        starts, begins, ends = [a[pipeline_id::num_pipelines] for a in self._label_ranges(offsets, boundaries, split)]
+
+        max_length = self.max_length
+
+        def _labels(start, begin, end):
+            return tf.data.Dataset.range(begin, end).map(lambda label: (label, start))
+
+        def _windows(labels, starts):
+            lengths = tf.minimum(labels - starts, max_length)
+            positions = tf.range(max_length, dtype=tf.int64)
+            mask = positions[tf.newaxis, :] < lengths[:, tf.newaxis]
+            index = tf.minimum((labels - lengths)[:, tf.newaxis] + positions, labels[:, tf.newaxis])
+
+            label_id = tf.gather(work_ids, labels)[:, tf.newaxis]
+            features = {
+                'context_id': tf.where(mask, tf.gather(work_ids, index), 0),
+                'context_rating': tf.where(mask, tf.cast(tf.gather(ratings, index), tf.float32), 0.),
+                'label_id': label_id
+            }
+            return features, label_id
+
+        d = tf.data.Dataset.from_tensor_slices((starts, begins, ends))
+        d = d.flat_map(_labels)
+        d = d.batch(self.read_size)
+        d = d.map(_windows, num_parallel_calls=tf.data.AUTOTUNE)
+        d = d.unbatch()
+        d = d.apply(tf.data.experimental.assert_cardinality(self._count_windows(starts, begins, ends)))
+        logger.debug(f"Loaded {len(offsets) - 1} user timelines from {self.output_dir}")
+        return d
+
+    def _label_ranges(self,
+                      offsets: np.ndarray,
+                      boundaries: np.ndarray,
+                      split: str | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # The timeline start of each user and the [begin, end) range of their labels in the split.
+        starts = offsets[:-1]
+        edges = np.column_stack([starts, boundaries, offsets[1:]])
+        if split is None:
+            begins, ends = starts, offsets[1:]
+        else:
+            split = SPLITS.index(_split_names(split)[0])
+            begins, ends = edges[:, split], edges[:, split + 1]
+        begins = np.maximum(begins, starts + max(self.min_length, 1))
+        return starts, begins, np.maximum(ends, begins)
+
+    @staticmethod
+    def _count_windows(starts: np.ndarray, begins: np.ndarray, ends: np.ndarray) -> int:
+        return int((ends - begins).sum())
 
 
 if __name__ == "__main__":
@@ -1,14 +1,23 @@
+import contextlib
 import gzip
 import io
 import json
 import logging
+import multiprocessing
+import os
 import pathlib
+import queue
 import shutil
 import sys
-import tempfile
+import threading
+import typing
+from concurrent import futures
 
 import fsspec
+import fsspec.asyn
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 from fsspec.callbacks import TqdmCallback
 from tqdm.auto import tqdm
 
@@ -17,6 +26,10 @@ from wrecksys.data import parse
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BLOCK_SIZE = 64 << 20
+NETWORK_CHUNK_SIZE = 1 << 20
+
+
 class TqdmAutoCallback(TqdmCallback):
     """
     Overrides the constructor for the provided TqdmCallback to use tqdm.auto instead
@@ -30,11 +43,24 @@ class TqdmAutoCallback(TqdmCallback):
 class FileManager(object):
     _class_logger = logging.getLogger(__name__).getChild(__qualname__)
 
-    def __init__(self, url: str, file_name: str, example_file: pathlib.Path, output_file: pathlib.Path, download=False):
+    def __init__(self,
+                 url: str,
+                 file_name: str,
+                 example_file: pathlib.Path,
+                 output_file: pathlib.Path,
+                 download=False,
+                 block_size: int | None = None,
+                 chunk_size: int | None = None,
+                 connections: int = 4,
+                 pipelined: bool = False):
         self._url = url
         self._file = file_name
         self._example_file = example_file
         self._output_file = output_file
+        self._block_size = block_size
+        self._chunk_size = chunk_size
+        self._connections = connections
+        self._pipelined = pipelined
 
         if download:
             self.download()
@@ -43,6 +69,14 @@ class FileManager(object):
     def exists(self) -> bool:
         return self._output_file.exists()
 
+    @property
+    def output_file(self) -> pathlib.Path:
+        return self._output_file
+
+    @property
+    def pipelined(self) -> bool:
+        return self._pipelined
+
     @property
     def example(self) -> dict:
         file = self._example_file
@@ -67,44 +101,365 @@ class FileManager(object):
         self._class_logger.info(f" Reading {self._output_file.name}")
         return pd.read_feather(self._output_file, columns=cols, dtype_backend='pyarrow')
 
+    def table(self, cols=None) -> pa.Table:
+        if not self._output_file.exists():
+            self.download()
+        self._class_logger.info(f" Reading {self._output_file.name}")
+        return feather.read_table(self._output_file, columns=cols, memory_map=True)
+
+    def batches(self, cols=None) -> typing.Iterator[pa.RecordBatch]:
+        """
+        Streams the record batches of the converted file, for files that are too large to read as one table.
+        """
+        if not self._output_file.exists():
+            self.download()
+        self._class_logger.info(f" Streaming {self._output_file.name}")
+        with pa.memory_map(str(self._output_file)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield batch.select(cols) if cols is not None else batch
+
     def download(self) -> None:
         if self._output_file.exists():
             self._class_logger.debug(f" {self._output_file} already downloaded.")
             return
 
+        if self._pipelined:
+            return self.stream()
+
+        file = self.fetch(self._output_file.parent)
+        self.convert(file)
+        file.unlink()
+
+    def stream(self) -> None:
+        """
+        Decompresses and parses the source as it arrives from the network, writing only the Feather file.
+
+        Network reads, decompression and parsing run as separate stages joined by bounded queues, so nothing but
+        the final output touches the disk and memory is capped by the block size and queue depths.
+        """
+        logger.debug(f"{self._output_file} not found.")
+        self._class_logger.info(f" Streaming {self._url}")
+        self._output_file.parent.mkdir(parents=True, exist_ok=True)
+        fs = fsspec.filesystem('http', client_kwargs={'read_timeout': 1200.})
+        block_size = self._block_size or DEFAULT_BLOCK_SIZE
+
+        with fs.open(self._url, 'rb', block_size=0) as remote:
+            chunks = prefetch(iter(lambda: remote.read(NETWORK_CHUNK_SIZE), b''), max_size=16)
+            with gzip.GzipFile(fileobj=IteratorReader(chunks), mode='rb') as fp_in:
+                blocks = prefetch(parse.read_blocks(fp_in, block_size), max_size=2)
+                parse.blocks_to_feather(blocks, self._output_file)
+
+        self._class_logger.info(f" Successfully created {self._output_file}")
+
+    def fetch(self, directory: pathlib.Path) -> pathlib.Path:
+        """
+        Downloads the compressed source into directory.
+
+        With a chunk_size, the file is fetched with parallel HTTP range requests into a .partial file whose
+        completed chunks are tracked in a manifest next to it, so an interrupted download picks up where it stopped.
+        """
         logger.debug(f"{self._output_file} not found.")
         print(f"Fetching {self._url}")
         fs = fsspec.filesystem('http', client_kwargs={'read_timeout': 1200.})
         file_size = fs.info(self._url)['size']
 
-        self._output_file.parent.mkdir(exist_ok=True)
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_file = f"{self._file}.json.gz"
-            file = pathlib.Path(temp_dir) / temp_file
-            free_space = shutil.disk_usage(file.parent)[2]
+        directory.mkdir(parents=True, exist_ok=True)
+        file = directory / f"{self._file}.json.gz"
+        if file.exists() and file.stat().st_size == file_size:
+            self._class_logger.debug(f" {file} already downloaded.")
+            return file
+
+        chunked = ChunkedDownload(fs, self._url, file, file_size, self._chunk_size, self._connections)
+        free_space = shutil.disk_usage(file.parent)[2]
 
-            if free_space < 3 * file_size:
-                available = utils.display_size(free_space)
-                required = utils.display_size(3 * file_size)
-                raise OSError(f"Not enough disk space available. Processing {file.name} requires {required} "
-                              f"but only {available} is free.")
-            else:
-                print(f"Disk space OK: {utils.display_size(free_space)} available.")
+        if free_space < 3 * file_size - chunked.completed_bytes:
+            available = utils.display_size(free_space)
+            required = utils.display_size(3 * file_size - chunked.completed_bytes)
+            raise OSError(f"Not enough disk space available. Processing {file.name} requires {required} "
+                          f"but only {available} is free.")
+        else:
+            print(f"Disk space OK: {utils.display_size(free_space)} available.")
 
+        if self._chunk_size and chunked.supports_ranges():
+            chunked.run()
+        else:
             fs.get_file(self._url,
                         file,
                         callback=TqdmCallback(
                             tqdm_kwargs={'desc': "Downloading: ", 'file': sys.stdout, 'unit': 'B', 'unit_scale': True}))
+        return file
 
-            with gzip.open(file) as fp_in:
-                gz_size = fp_in.seek(0, io.SEEK_END)
-                fp_in.seek(0)
-                parse.json_to_feather(fp_in, gz_size, self._output_file)
+    def convert(self, file: pathlib.Path) -> None:
+        convert_source(file, self._output_file, self._block_size)
 
-            print(f"Successfully created {self._output_file}\n")
+    def conversion_memory(self, file: pathlib.Path | None = None) -> int:
+        """
+        Rough upper bound on the memory needed to convert a downloaded source file.
+        """
+        # Goodreads JSON inflates ~5x when decompressed, and a parsed table plus its converted copy is ~4x that.
+        if self._pipelined:
+            # Two queued blocks plus the one being parsed.
+            return (2 + 4) * (self._block_size or DEFAULT_BLOCK_SIZE)
+        if self._block_size:
+            return 4 * self._block_size
+        return 4 * 5 * file.stat().st_size
 
     def delete(self) -> None:
         if self._example_file.exists():
             pathlib.Path.unlink(self._example_file)
         if self._output_file.exists():
             pathlib.Path.unlink(self._output_file)
+
+
+class ChunkedDownload(object):
+    """
+    Fetches a file in fixed-size chunks over parallel HTTP range requests.
+
+    Chunks are written in place into a preallocated .partial file, and each finished chunk is recorded in a JSON
+    manifest beside it. Running the same download again only requests the chunks the manifest doesn't list.
+    """
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    def __init__(self,
+                 fs: fsspec.AbstractFileSystem,
+                 url: str,
+                 file: pathlib.Path,
+                 file_size: int,
+                 chunk_size: int | None = None,
+                 connections: int = 4):
+        self._fs = fs
+        self._url = url
+        self._file = file
+        self._size = file_size
+        self._chunk_size = chunk_size or file_size or 1
+        self._connections = max(1, connections)
+        self._partial_file = file.with_name(f"{file.name}.partial")
+        self._manifest_file = file.with_name(f"{file.name}.manifest.json")
+        self._lock = threading.Lock()
+        self._completed = self._read_manifest()
+
+    @property
+    def num_chunks(self) -> int:
+        return -(-self._size // self._chunk_size)
+
+    @property
+    def completed_bytes(self) -> int:
+        return sum(self._chunk_length(i) for i in self._completed)
+
+    def supports_ranges(self) -> bool:
+        try:
+            return fsspec.asyn.sync(self._fs.loop, self._probe_range)
+        except (OSError, ValueError, NotImplementedError):
+            return False
+
+    async def _probe_range(self) -> bool:
+        # A server that ignores Range answers with the whole file, so only the status is read, never the body.
+        session = await self._fs.set_session()
+        kwargs = self._fs.kwargs.copy()
+        headers = {**kwargs.pop('headers', {}), 'Range': 'bytes=0-0'}
+        async with session.get(self._fs.encode_url(self._url), headers=headers, **kwargs) as response:
+            return response.status == 206
+
+    def run(self) -> pathlib.Path:
+        pending = [i for i in range(self.num_chunks) if i not in self._completed]
+        if self._completed:
+            self._class_logger.info(f" Resuming {self._file.name}: {len(self._completed)}/{self.num_chunks} chunks done.")
+
+        if not self._partial_file.exists():
+            with self._partial_file.open('wb') as f:
+                f.truncate(self._size)
+
+        with (self._partial_file.open('r+b') as f,
+              tqdm(desc="Downloading: ", file=sys.stdout, unit='B', unit_scale=True,
+                   total=self._size, initial=self.completed_bytes) as progress,
+              futures.ThreadPoolExecutor(self._connections, thread_name_prefix='range') as pool):
+
+            def _fetch_chunk(index: int) -> None:
+                start = index * self._chunk_size
+                data = self._fs.cat_file(self._url, start=start, end=start + self._chunk_length(index))
+                if len(data) != self._chunk_length(index):
+                    raise OSError(f"Chunk {index} of {self._url} returned {len(data)} bytes, "
+                                  f"expected {self._chunk_length(index)}.")
+                with self._lock:
+                    f.seek(start)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._completed.add(index)
+                    self._write_manifest()
+                progress.update(len(data))
+
+            jobs = [pool.submit(_fetch_chunk, i) for i in pending]
+            for job in futures.as_completed(jobs):
+                job.result()
+
+        self._partial_file.replace(self._file)
+        self._manifest_file.unlink()
+        return self._file
+
+    def _chunk_length(self, index: int) -> int:
+        return min(self._chunk_size, self._size - index * self._chunk_size)
+
+    def _read_manifest(self) -> set[int]:
+        if not (self._manifest_file.exists() and self._partial_file.exists()):
+            return set()
+        with self._manifest_file.open('r') as f:
+            manifest = json.load(f)
+        if (manifest['url'], manifest['size'], manifest['chunk_size']) != (self._url, self._size, self._chunk_size):
+            self._class_logger.info(f" {self._manifest_file.name} is out of date, restarting download.")
+            self._partial_file.unlink()
+            return set()
+        return set(manifest['completed'])
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            'url': self._url,
+            'size': self._size,
+            'chunk_size': self._chunk_size,
+            'completed': sorted(self._completed)
+        }
+        temp_file = self._manifest_file.with_name(f"{self._manifest_file.name}.tmp")
+        with temp_file.open('w') as f:
+            json.dump(manifest, f)
+        temp_file.replace(self._manifest_file)
+
+
+class IteratorReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of byte strings.
+    """
+    def __init__(self, chunks: typing.Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b''
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def prefetch(iterator: typing.Iterable, max_size: int = 2) -> typing.Iterator:
+    """
+    Runs iterator on a background thread, holding at most max_size items ahead of the consumer.
+
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+    done = object()
+
+    def _put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+            _put((done, None))
+        except BaseException as e:
+            _put((done, e))
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def convert_source(file: pathlib.Path, output_file: pathlib.Path, block_size: int | None = None) -> None:
+    with gzip.open(file) as fp_in:
+        gz_size = fp_in.seek(0, io.SEEK_END)
+        fp_in.seek(0)
+        parse.json_to_feather(fp_in, gz_size, output_file, block_size)
+
+    print(f"Successfully created {output_file}\n")
+
+
+def available_memory() -> int | None:
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class MemoryBudget(object):
+    """
+    Blocks callers until their estimated memory use fits in the remaining budget.
+
+    A single reservation larger than the whole budget is still admitted once nothing else is running,
+    otherwise it would never make progress.
+    """
+    def __init__(self, limit: int | None):
+        self._limit = limit
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, amount: int):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._limit is None or self._reserved == 0 or self._reserved + amount <= self._limit)
+            self._reserved += amount
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= amount
+                self._condition.notify_all()
+
+
+def download_all(sources: list[FileManager], max_workers: int | None = None, memory_limit: int | None = None) -> None:
+    """
+    Downloads sources concurrently on a thread pool and converts them on a process pool.
+
+    Conversions only start while their estimated memory fits within memory_limit, which defaults to the
+    memory currently available on the machine.
+    """
+    sources = [s for s in sources if not s.exists]
+    if not sources:
+        return
+
+    budget = MemoryBudget(memory_limit or available_memory())
+
+    with (futures.ThreadPoolExecutor(len(sources), thread_name_prefix='fetch') as threads,
+          futures.ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) as processes):
+
+        def _ingest(source: FileManager) -> None:
+            if source.pipelined:
+                with budget.reserve(source.conversion_memory()):
+                    processes.submit(source.stream).result()
+                return
+
+            file = source.fetch(source.output_file.parent)
+            with budget.reserve(source.conversion_memory(file)):
+                processes.submit(source.convert, file).result()
+            file.unlink()
+
+        jobs = [threads.submit(_ingest, s) for s in sources]
+        for job in futures.as_completed(jobs):
+            job.result()
@@ -0,0 +1,187 @@
+"""
+Out-of-core versions of the cleaning stage, for interaction files too large to load as one DataFrame.
+"""
+import contextlib
+import logging
+import math
+import pathlib
+import sys
+import tempfile
+import typing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+from tqdm.auto import tqdm
+
+from wrecksys.data import prepare
+from wrecksys.data.download import FileManager, available_memory
+
+logger = logging.getLogger(__name__)
+
+# A rough upper bound on the memory each rating takes while a partition is deduplicated or sorted.
+ROW_BYTES = 96
+DEFAULT_MEMORY_BUDGET = 4 << 30
+
+
+class RangePartitions(object):
+    """
+    Spills ratings into files that each hold a contiguous range of user_ids.
+
+    Every user's ratings end up in a single partition, in their original order, and reading the partitions in turn
+    visits the users in user_id order. Anything computed per user only needs one partition in memory, and sorting
+    each partition in turn sorts the whole file, so there's no merge step.
+    """
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    def __init__(self, directory: pathlib.Path, num_partitions: int, max_user: int):
+        self.files = [directory / f"part{i:04}.feather" for i in range(num_partitions)]
+        self.max_user = max(max_user, 1)
+
+    def partition(self, user_ids: np.ndarray) -> np.ndarray:
+        # user_ids count up from 1, so this splits them into equal ranges.
+        parts = (user_ids.astype(np.int64) - 1) * len(self.files) // self.max_user
+        return np.clip(parts, 0, len(self.files) - 1)
+
+    def write(self, tables: typing.Iterable[pa.Table]) -> None:
+        with contextlib.ExitStack() as stack:
+            writers = {}
+            for table in tables:
+                parts = self.partition(table.column('user_id').to_numpy())
+                order = np.argsort(parts, kind='stable')
+                bounds = np.searchsorted(parts[order], np.arange(len(self.files) + 1))
+                for i in np.flatnonzero(np.diff(bounds)):
+                    if i not in writers:
+                        writers[i] = stack.enter_context(pa.ipc.new_file(str(self.files[i]), table.schema))
+                    writers[i].write_table(table.take(order[bounds[i]:bounds[i + 1]]))
+
+    def read(self, desc: str) -> typing.Iterator[tuple[pathlib.Path, pa.Table]]:
+        for file in tqdm(self.files, desc=desc, unit='partition', file=sys.stdout):
+            if file.exists():
+                yield file, feather.read_table(file, memory_map=True)
+
+    def rewrite(self, desc: str, transform: typing.Callable[[pa.Table], pa.Table]) -> None:
+        for file, table in self.read(desc):
+            table = transform(table)
+            temp_file = file.with_name(f"{file.name}.partial")
+            feather.write_feather(table, temp_file, compression='uncompressed')
+            del table
+            temp_file.replace(file)
+
+
+def _scan(ratings_source: FileManager) -> tuple[int, int]:
+    # The row count and the largest user_id, which size the partitions.
+    num_rows, max_user = 0, 0
+    for batch in ratings_source.batches(cols=['user_id']):
+        num_rows += batch.num_rows
+        max_user = max(max_user, pc.max(batch.column('user_id')).as_py() or 0)
+    return num_rows, max_user
+
+
+def _spill(ratings_source: FileManager, work_mapping: pa.Table, batch_rows: int) -> typing.Iterator[pa.Table]:
+    # The same rows as format_ratings, with each book_id replaced by the position of its work in the works frame.
+    for batch in ratings_source.batches(cols=['user_id', 'book_id', 'rating', 'date_updated']):
+        for offset in range(0, batch.num_rows, batch_rows):
+            table = pa.Table.from_batches([batch.slice(offset, batch_rows)])
+            table = table.filter(pc.greater_equal(table.column('rating'), 3))
+            work = prepare._lookup(table.column('book_id'), work_mapping, 'book_id', 'work')
+            table = table.select(['user_id', 'rating', 'date_updated']).append_column('work', work)
+            yield table.filter(pc.is_valid(table.column('work')))
+
+
+def _popular(counts: np.ndarray, quantile: float) -> np.ndarray:
+    # The same threshold as prepare._popular, from counts indexed by key, where a zero means the key is absent.
+    threshold = np.quantile(counts[counts > 0], quantile)
+    return counts > threshold
+
+
+def filter_ratings(ratings_source: FileManager,
+                   works: pd.DataFrame,
+                   output_file: pathlib.Path,
+                   books: float = .8,
+                   users: float = .8,
+                   memory_budget: int | None = None) -> pd.DataFrame:
+    """
+    The same filter as prepare.filter_dataframes, writing the ratings straight to output_file.
+
+    The ratings are streamed from the source file into user_id range partitions that each fit in the memory
+    budget. The popularity thresholds are exact: duplicates are dropped per user, the book and user counts are
+    accumulated into arrays indexed by key, and each later pass filters one partition at a time.
+    """
+    budget = memory_budget or available_memory() or DEFAULT_MEMORY_BUDGET
+    logger.info(f'Filtering Datasets out of core, with a budget of {budget >> 20:,}MB')
+    num_rows, max_user = _scan(ratings_source)
+    num_partitions = max(1, math.ceil(num_rows * ROW_BYTES / budget))
+    batch_rows = max(1, budget // ROW_BYTES // 4)
+    work_ids = works['work_id'].to_numpy(dtype=np.int64)
+    work_mapping = pa.Table.from_pandas(works[['book_id', 'work_id']], preserve_index=False)
+    work_mapping = work_mapping.append_column('work', pa.array(np.arange(len(works), dtype=np.int32)))
+
+    with tempfile.TemporaryDirectory(dir=output_file.parent) as temp_dir:
+        partitions = RangePartitions(pathlib.Path(temp_dir), num_partitions, max_user)
+        partitions.write(_spill(ratings_source, work_mapping, batch_rows))
+
+        # Drop repeated (user, work) pairs, and count the ratings of each work.
+        book_counts = np.zeros(len(works), dtype=np.int64)
+
+        def _deduplicate(table: pa.Table) -> pa.Table:
+            table = prepare._drop_duplicates(table, ['user_id', 'work'])
+            book_counts[:] += np.bincount(table.column('work').to_numpy(), minlength=len(works))
+            return table
+        partitions.rewrite('Deduplicating', _deduplicate)
+
+        # Keep the most popular books, and count the books of each user.
+        popular_books = _popular(book_counts, books)
+        user_counts = np.zeros(max_user + 1, dtype=np.int64)
+
+        def _filter_books(table: pa.Table) -> pa.Table:
+            table = table.filter(pa.array(popular_books[table.column('work').to_numpy()]))
+            user_counts[:] += np.bincount(table.column('user_id').to_numpy(), minlength=max_user + 1)
+            return table
+        partitions.rewrite('Filtering books', _filter_books)
+
+        # Keep the most active users, and find which works are still rated.
+        active_users = _popular(user_counts, users)
+        rated = np.zeros(len(works), dtype=bool)
+
+        def _filter_users(table: pa.Table) -> pa.Table:
+            table = table.filter(pa.array(active_users[table.column('user_id').to_numpy()]))
+            rated[table.column('work').to_numpy()] = True
+            return table
+        partitions.rewrite('Filtering users', _filter_users)
+
+        indexed = prepare.index_works(works, work_ids[rated])
+        index_mapping = pa.Table.from_pandas(indexed[['work_id', 'work_index']], preserve_index=False)
+        work_index = prepare._lookup(work_mapping.column('work_id'), index_mapping, 'work_id', 'work_index')
+        work_index = pc.fill_null(work_index, 0).to_numpy()
+
+        temp_file = output_file.with_name(f"{output_file.name}.partial")
+        with contextlib.ExitStack() as stack:
+            writer = None
+            for _, table in partitions.read('Writing ratings'):
+                table = pa.table({
+                    'user_id': table.column('user_id'),
+                    'rating': table.column('rating'),
+                    'timestamp': table.column('date_updated'),
+                    'work_id': pa.array(work_index[table.column('work').to_numpy()])
+                })
+                order = pc.sort_indices(table, sort_keys=[('user_id', 'ascending'), ('timestamp', 'ascending')])
+                if writer is None:
+                    options = pa.ipc.IpcWriteOptions(compression='lz4')
+                    writer = stack.enter_context(pa.ipc.new_file(str(temp_file), table.schema, options=options))
+                writer.write_table(table.take(order))
+        temp_file.replace(output_file)
+
+    return indexed
+
+
+def generate_dataframes(source_files: dict[str, FileManager],
+                        dest_files: dict[str, pathlib.Path],
+                        memory_budget: int | None = None,
+                        full_text: bool = False,
+                        **quantiles) -> int:
+    works = prepare.format_works(source_files['books'], source_files['authors'], source_files['works'])
+    works = filter_ratings(source_files['ratings'], works, dest_files['ratings'], memory_budget=memory_budget, **quantiles)
+    return prepare.save_works(works, dest_files, full_text)
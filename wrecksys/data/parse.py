@@ -1,8 +1,11 @@
+import functools
 import gc
-import gzip
+import io
 import logging
 import pathlib
 import sys
+import tempfile
+import typing
 
 import pyarrow as pa
 import pyarrow.compute as pc
@@ -14,6 +17,29 @@ from wrecksys import utils
 
 logger = logging.getLogger(__name__)
 
+
+class UserIndex(object):
+    """
+    Assigns stable, 1-based integer codes to user ids across record batches, in order of first appearance.
+    """
+    def __init__(self):
+        self.users = pa.array([], pa.string())
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def encode(self, column: pa.ChunkedArray | pa.Array) -> pa.Array:
+        unique = column.unique()
+        unseen = pc.filter(unique, pc.invert(pc.is_in(unique, value_set=self.users)))
+        if len(unseen) > 0:
+            self.users = pa.concat_arrays([self.users, unseen.cast(self.users.type)])
+        return pc.index_in(column, value_set=self.users).combine_chunks()
+
+    def dictionary_encode(self, column: pa.ChunkedArray | pa.Array) -> pa.DictionaryArray:
+        # The dictionary only ever grows at the end, so each batch can be written as a dictionary delta.
+        return pa.DictionaryArray.from_arrays(self.encode(column), self.users)
+
+
 def _convert_dates(table: pa.Table) -> pa.Table:
     date_format = "%a %b %d %H:%M:%S %z %Y"
     timestamp_columns = {'date_added', 'date_updated', 'read_at', 'started_at'}
@@ -67,27 +93,115 @@ def _convert_table(table: pa.Table, columns: dict[str, pa.DataType]) -> pa.Table
     return table
 
 
-def json_to_feather(file_pointer: gzip.GzipFile, file_size: int, output_file: pathlib.Path) -> None:
-    dispatcher = {
-        'goodreads_book_authors': author_parser,
-        'goodreads_book_works': work_parser,
-        'goodreads_books_fantasy_paranormal': book_parser,
-        'goodreads_interactions_fantasy_paranormal': interaction_parser,
-        'goodreads_reviews_fantasy_paranormal': review_parser
-    }
+def json_to_feather(file_pointer: typing.BinaryIO,
+                    file_size: int | None,
+                    output_file: pathlib.Path,
+                    block_size: int | None = None) -> None:
+    """
+    Converts a newline-delimited JSON source into a Feather file.
+
+    With a block_size, the source is parsed and written in blocks of roughly that many (uncompressed) bytes,
+    so peak memory depends on the block size rather than the size of the file.
+    """
+    if block_size:
+        return blocks_to_feather(read_blocks(file_pointer, block_size), output_file, file_size)
+
     file_name = utils.get_file_name(str(output_file))
 
     with tqdm.wrapattr(file_pointer, 'read', desc='Converting: ',
                        file=sys.stdout, unit='B', unit_scale=True, total=file_size) as f:
         table: pa.Table = pj.read_json(f)
         logger.info(f"Table Loaded: {utils.display_size(table.nbytes)}")
-        parse = dispatcher.get(file_name, generic_parser)
+        parse = PARSERS.get(file_name, generic_parser)
         table = parse(table)
         feather.write_feather(table, str(output_file))
         del table
         gc.collect()
 
 
+def read_blocks(file_pointer: typing.BinaryIO, block_size: int) -> typing.Iterator[bytes]:
+    """
+    Yields line-aligned blocks of roughly block_size bytes.
+    """
+    while lines := file_pointer.readlines(block_size):
+        yield b''.join(lines)
+        del lines
+
+
+def blocks_to_feather(blocks: typing.Iterable[bytes], output_file: pathlib.Path, total: int | None = None) -> None:
+    """
+    Parses newline-delimited JSON blocks one at a time and appends each to a Feather file.
+
+    Blocks can infer different types for a column, such as list<null> for a block where a list is always empty
+    and list<string> for the next. Each run of blocks with the same schema is written to a segment of its own, and
+    if there's more than one, the segments are merged into a file with their schemas unified, promoting types
+    where they differ and filling in missing columns with nulls.
+    """
+    file_name = utils.get_file_name(str(output_file))
+    parse = _block_parser(file_name)
+    partial_file = output_file.with_name(f"{output_file.name}.partial")
+    options = pa.ipc.IpcWriteOptions(compression='lz4', emit_dictionary_deltas=True)
+    rows = 0
+
+    with tempfile.TemporaryDirectory(dir=output_file.parent) as temp_dir:
+        segments: list[tuple[pa.Schema, pathlib.Path]] = []
+        writer = None
+        try:
+            with tqdm(desc='Converting: ', file=sys.stdout, unit='B', unit_scale=True, total=total) as progress:
+                for block in blocks:
+                    # Types are inferred from the whole block, not pyarrow's default 1 MiB, so that a later null or
+                    # float in a column doesn't change its type partway through the block.
+                    table = parse(pj.read_json(io.BytesIO(block), read_options=pj.ReadOptions(block_size=len(block))))
+
+                    if writer is None or table.schema != segments[-1][0]:
+                        if writer is not None:
+                            writer.close()
+                        segments.append((table.schema, pathlib.Path(temp_dir) / f'{len(segments)}.arrow'))
+                        writer = pa.ipc.new_file(str(segments[-1][1]), table.schema, options=options)
+
+                    writer.write_table(table)
+                    rows += table.num_rows
+                    progress.update(len(block))
+                    del block, table
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if not segments:
+            raise ValueError(f"{file_name} did not contain any records.")
+
+        if len(segments) == 1:
+            segments[0][1].replace(partial_file)
+        else:
+            schema = pa.unify_schemas([s for s, _ in segments], promote_options='permissive')
+            logger.info(f"Unifying {len(segments)} schemas of {file_name}")
+            with pa.ipc.new_file(str(partial_file), schema, options=options) as merged:
+                for _, segment in segments:
+                    with pa.memory_map(str(segment)) as source:
+                        reader = pa.ipc.open_file(source)
+                        for i in range(reader.num_record_batches):
+                            merged.write_batch(_conform(reader.get_batch(i), schema))
+
+    partial_file.replace(output_file)
+    logger.info(f"Streamed {rows:,} rows to {output_file.name}")
+
+
+def _conform(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    # Puts the columns in the schema's order and types, with nulls for any the batch doesn't have.
+    columns = [batch.column(field.name).cast(field.type) if field.name in batch.schema.names
+               else pa.nulls(batch.num_rows, field.type)
+               for field in schema]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def _block_parser(file_name: str) -> typing.Callable[[pa.Table], pa.Table]:
+    # User ids have to be encoded consistently across blocks, so these parsers carry an index between calls.
+    parse = PARSERS.get(file_name, generic_parser)
+    if parse in (interaction_parser, review_parser):
+        return functools.partial(parse, user_index=UserIndex())
+    return parse
+
+
 def generic_parser(table: pa.Table) -> pa.Table:
     return _convert_table(table, {})
 
@@ -121,10 +235,14 @@ def book_parser(table: pa.Table) -> pa.Table:
     return _convert_table(table, simple_columns)
 
 
-def review_parser(table: pa.Table) -> pa.Table:
+def review_parser(table: pa.Table, user_index: UserIndex | None = None) -> pa.Table:
 
     col = 'user_id'
-    table = table.set_column(table.column_names.index(col), col, table.column(col).dictionary_encode())
+    if user_index is None:
+        user_ids = table.column(col).dictionary_encode()
+    else:
+        user_ids = user_index.dictionary_encode(table.column(col))
+    table = table.set_column(table.column_names.index(col), col, user_ids)
 
     simple_columns = {
         'book_id': pa.int32(),
@@ -136,20 +254,17 @@ def review_parser(table: pa.Table) -> pa.Table:
     return _convert_table(table, simple_columns)
 
 
-def interaction_parser(table: pa.Table) -> pa.Table:
+def interaction_parser(table: pa.Table, user_index: UserIndex | None = None) -> pa.Table:
 
     col = 'user_id'
+    if user_index is None:
+        user_ids = pc.index_in(table.column(col), table.column(col).unique()).dictionary_encode()
+    else:
+        user_ids = user_index.encode(table.column(col))
     table = table.set_column(
         table.column_names.index(col),
         col,
-        pc.add(
-            pc.index_in(
-                table.column('user_id'),
-                table.column('user_id').unique()
-            ).dictionary_encode(),
-            1
-        )
-        .cast(pa.int32())
+        pc.add(user_ids, 1).cast(pa.int32())
     )
     logger.info(f"User IDs Processed: {utils.display_size(table.nbytes)}")
 
@@ -183,20 +298,22 @@ def work_parser(table: pa.Table) -> pa.Table:
     return _convert_table(table, simple_columns)
 
 
+PARSERS = {
+    'goodreads_book_authors': author_parser,
+    'goodreads_book_works': work_parser,
+    'goodreads_books_fantasy_paranormal': book_parser,
+    'goodreads_interactions_fantasy_paranormal': interaction_parser,
+    'goodreads_reviews_fantasy_paranormal': review_parser
+}
+
+
 def _feather_to_feather(file_name) -> None:
     logger.info(f"Logging is working at least.")
-    dispatcher = {
-        'goodreads_book_authors': author_parser,
-        'goodreads_book_works': work_parser,
-        'goodreads_books_fantasy_paranormal': book_parser,
-        'goodreads_interactions_fantasy_paranormal': interaction_parser,
-        'goodreads_reviews_fantasy_paranormal': review_parser
-    }
     output_file = pathlib.Path(__file__).parents[2] / f'data/raw/goodreads_interactions_fantasy_paranormal.feather'
 
     table: pa.Table = feather.read_table(output_file)
     logger.info(f"Table Loaded: {utils.display_size(table.nbytes)}")
-    parse = dispatcher.get(file_name, generic_parser)
+    parse = PARSERS.get(file_name, generic_parser)
     table = parse(table)
     logger.info(f"Table Converted: {utils.display_size(table.nbytes)}")
     feather.write_feather(table, str(output_file))
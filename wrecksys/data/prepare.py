@@ -2,32 +2,42 @@ import logging
 import pathlib
 import sqlite3
 
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 
 from wrecksys.data.download import FileManager
 
 logger = logging.getLogger(__name__)
 
 
+def _first_author(authors: pa.ChunkedArray) -> tuple[pa.Array, pa.Array]:
+    # Returns a mask of the books that list any authors, and the first author_id of each of those books.
+    authors = authors.combine_chunks()
+    has_author = pc.greater(pc.fill_null(pc.list_value_length(authors), 0), 0)
+    first = pc.list_flatten(pc.list_slice(authors, 0, 1))
+    return has_author, first.field('author_id').cast(pa.int32())
+
+
 def format_works(books_source: FileManager,
                  authors_source: FileManager,
                  works_source: FileManager) -> pd.DataFrame:
 
+    # Books run to millions of rows once we go past one genre, so the nested authors column, and both merges, are
+    # handled with Arrow list/struct kernels and index lookups rather than per-row Python.
     logger.info(' Processing book data.')
-    books = books_source.dataframe(cols=['title', 'url', 'image_url', 'link', 'authors', 'book_id', 'work_id'])
-    books['author_id'] = (
-        books.pop('authors')
-        .map(lambda x: x[0] if len(x) > 0 else None, na_action='ignore')
-        .map(lambda x: int(x['author_id']) if isinstance(x, dict) else x, na_action='ignore')
-        .astype(pd.ArrowDtype(pa.int32()))
-    )
-    books = books[~books['author_id'].isna()]
+    books = books_source.table(cols=['title', 'url', 'image_url', 'link', 'authors', 'book_id', 'work_id'])
+    has_author, author_id = _first_author(books.column('authors'))
+    books = books.filter(has_author)
+    books = books.select([c for c in books.column_names if c != 'authors'])
+    books = books.append_column('author_id', author_id)
+    books = books.filter(pc.is_valid(books.column('author_id')))
 
     logger.info(' Processing author data.')
-    authors = authors_source.dataframe(cols=['author_id', 'name']).rename(columns={'name': 'author_name'})
-    authors = authors[~authors['author_name'].isna()]
-    books = books.merge(authors, how='left')
+    authors = authors_source.table(cols=['author_id', 'name']).rename_columns(['author_id', 'author_name'])
+    authors = authors.filter(pc.is_valid(authors.column('author_name')))
+    books = books.append_column('author_name', _lookup(books.column('author_id'), authors, 'author_id', 'author_name'))
     del authors
 
     logger.info('Processing works data.')
@@ -39,12 +49,19 @@ def format_works(books_source: FileManager,
     works['average_rating'] = round(works['ratings_sum'] / works['ratings_count'], 1)
 
     logger.info('Merging Book Files.')
-    works = works[(works['work_id'].isin(books['work_id'].unique()))]
-    works = works.merge(books, how='inner', on=['book_id', 'work_id'])
-    works = works[~works.author_id.isna()]
-    del books
+    # An inner merge on (book_id, work_id): find each work's best book, then keep it if the work_ids agree.
+    works = pa.Table.from_pandas(works, preserve_index=False)
+    if pc.count_distinct(books.column('book_id')).as_py() != books.num_rows:
+        raise ValueError("Can't merge works with books, the books have duplicate book_ids.")
+    best_book = books.take(pc.index_in(works.column('book_id'), value_set=books.column('book_id')))
+    matched = pc.fill_null(pc.equal(works.column('work_id'), best_book.column('work_id')), False)
+    for column in [c for c in best_book.column_names if c not in ('book_id', 'work_id')]:
+        works = works.append_column(column, best_book.column(column))
+    works = works.filter(matched)
+    works = works.filter(pc.is_valid(works.column('author_id')))
+    del books, best_book
 
-    return works
+    return works.to_pandas(types_mapper=pd.ArrowDtype)
 
 
 def format_ratings(ratings_source: FileManager):
@@ -53,60 +70,219 @@ def format_ratings(ratings_source: FileManager):
     return df[(df['rating'] >= 3)]
 
 
-def filter_dataframes(ratings: pd.DataFrame, works: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+def _lookup(keys: pa.ChunkedArray, mapping: pa.Table, key: str, value: str) -> pa.ChunkedArray:
+    # Equivalent to a pandas left merge as long as the mapping keys are unique, without reordering the left side.
+    if pc.count_distinct(mapping.column(key)).as_py() != mapping.num_rows:
+        raise ValueError(f"Can't map {key} to {value}, the mapping has duplicate keys.")
+    return mapping.column(value).take(pc.index_in(keys, value_set=mapping.column(key)))
+
+
+def _drop_duplicates(table: pa.Table, keys: list[str], keep: str = 'first') -> pa.Table:
+    # Keeps the first or last occurrence of each key, like DataFrame.drop_duplicates.
+    aggregate = {'first': 'min', 'last': 'max'}[keep]
+    rows = table.select(keys).append_column('row', pa.array(np.arange(table.num_rows)))
+    kept = rows.group_by(keys).aggregate([('row', aggregate)]).column(f'row_{aggregate}')
+    return table.take(np.sort(kept.to_numpy()))
+
+
+def _popular(column: pa.ChunkedArray, quantile: float) -> pa.Array:
+    # Keys that appear more often than the given quantile of the per-key counts.
+    counts = pa.table({'key': column.drop_null()}).group_by('key').aggregate([('key', 'count')])
+    threshold = np.quantile(counts.column('key_count').to_numpy(), quantile)
+    return counts.filter(pc.greater(counts.column('key_count'), threshold)).column('key')
+
+
+def index_works(works: pd.DataFrame, work_ids: np.ndarray) -> pd.DataFrame:
+    # Keeps the works that are still rated, and numbers them from 1 in order of popularity.
+    logger.info('Reindexing Works')
+    works = works[works.work_id.isin(work_ids)].reset_index(drop=True)
+    works = works.sort_values(by=['ratings_sum', 'ratings_count'], ascending=False).reset_index(drop=True)
+    works['work_index'] = works.index + 1
+    works['work_index'] = works['work_index'].astype(pd.ArrowDtype(pa.int32()))
+    return works
+
+
+def filter_dataframes(ratings: pd.DataFrame,
+                      works: pd.DataFrame,
+                      books: float = .8,
+                      users: float = .8) -> tuple[pd.DataFrame, pd.DataFrame]:
     logger.info('Filtering Datasets')
+    # The ratings frame runs to hundreds of millions of rows, so it's filtered as an Arrow table. Each step is a
+    # multithreaded kernel over the Arrow buffers instead of a pandas merge that copies the whole frame.
+    table = pa.Table.from_pandas(ratings, preserve_index=False)
+    columns = [c for c in table.column_names if c != 'book_id']
+
     # Replace all the book_ids with the corresponding work_id
-    work_id_mapping = works[['book_id', 'work_id']]
-    ratings = ratings.merge(work_id_mapping, how='left').drop(columns='book_id')
-    ratings = ratings[~ratings.work_id.isna()].drop_duplicates(subset=['user_id', 'work_id'])
+    work_id_mapping = pa.Table.from_pandas(works[['book_id', 'work_id']], preserve_index=False)
+    table = table.select(columns).append_column(
+        'work_id', _lookup(table.column('book_id'), work_id_mapping, 'book_id', 'work_id'))
+    table = table.filter(pc.is_valid(table.column('work_id')))
+    table = _drop_duplicates(table, ['user_id', 'work_id'])
 
     # Check the ratings distribution by book, and keep the top 20% most popular.
-    book_view = ratings['work_id'].value_counts().reset_index().sort_values(by='count')
-    top_books = book_view['count'].quantile(.8)
-    book_view = book_view[(book_view['count'] > top_books)]
-    ratings = ratings[ratings['work_id'].isin(book_view['work_id'])]
+    table = table.filter(pc.is_in(table.column('work_id'), value_set=_popular(table.column('work_id'), books)))
 
     # Check the book distribution by user, and keep the most active 20%
-    user_view = ratings['user_id'].value_counts().reset_index().sort_values(by='count')
-    top_users = user_view['count'].quantile(.8)
-    user_view = user_view[(user_view['count'] > top_users)]
-    ratings = ratings[ratings['user_id'].isin(user_view['user_id'])].reset_index(drop=True)
-    del book_view, user_view
+    table = table.filter(pc.is_in(table.column('user_id'), value_set=_popular(table.column('user_id'), users)))
 
     # Create the Work Index
-    logger.info('Reindexing Works')
-    works = works[works.work_id.isin(ratings.work_id)].reset_index(drop=True)
-    works = works.sort_values(by=['ratings_sum', 'ratings_count'], ascending=False).reset_index(drop=True)
-    works['work_index'] = works.index + 1
-    works['work_index'] = works['work_index'].astype(pd.ArrowDtype(pa.int32()))
-    index_mapping = works[['work_id', 'work_index']]
-    ratings = (
-        ratings
-        .merge(index_mapping, how='left')
-        .drop(columns='work_id')
-        .rename(columns={'work_index': 'work_id', 'date_updated': 'timestamp'})
-        .reset_index(drop=True)
-        .sort_values(by=['user_id', 'timestamp'])
+    works = index_works(works, pc.unique(table.column('work_id')).to_numpy())
+    index_mapping = pa.Table.from_pandas(works[['work_id', 'work_index']], preserve_index=False)
+
+    work_index = _lookup(table.column('work_id'), index_mapping, 'work_id', 'work_index')
+    table = (
+        table
+        .select(columns)
+        .append_column('work_id', work_index)
+        .rename_columns([{'date_updated': 'timestamp'}.get(c, c) for c in columns] + ['work_id'])
     )
+    order = pc.sort_indices(table, sort_keys=[('user_id', 'ascending'), ('timestamp', 'ascending')])
+    ratings = table.take(order).to_pandas(types_mapper=pd.ArrowDtype)
+    ratings.index = pd.Index(order.to_numpy(), dtype='int64')
     return ratings, works
 
 
-def prepare_dataframes(fm: dict[str, FileManager])  -> tuple[pd.DataFrame, pd.DataFrame]:
+def _merge_ratings(ratings: pa.Table, delta: pa.Table) -> pa.Table:
+    # A delta rating replaces any earlier rating of the same work by the same user. The sort is stable, so the
+    # result is what sorting all the ratings again would give.
+    table = _drop_duplicates(pa.concat_tables([ratings, delta]), ['user_id', 'work_id'], keep='last')
+    return table.take(pc.sort_indices(table, sort_keys=[('user_id', 'ascending'), ('timestamp', 'ascending')]))
+
+
+def merge_ratings(ratings_file: pathlib.Path, delta: pd.DataFrame, output_file: pathlib.Path | None = None) -> int:
+    """
+    Merges new or changed interactions, in the clean ratings schema, into a ratings file sorted by user and time.
+    The result replaces ratings_file, or goes to output_file if one is given.
+
+    The file is read and written a record batch at a time. Each batch only takes in the delta rows of the users it
+    ends with, so batches the delta doesn't touch are copied across as they are, and memory stays at a batch plus
+    the delta. Returns the number of rows written.
+    """
+    output_file = output_file or ratings_file
+    partial_file = output_file.with_name(f"{output_file.name}.partial")
+    rows = 0
+
+    with pa.memory_map(str(ratings_file)) as source:
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+        delta = pa.Table.from_pandas(delta[schema.names], preserve_index=False).cast(schema)
+        delta = _merge_ratings(schema.empty_table(), delta)
+        delta_users = delta.column('user_id').to_numpy()
+        merged = 0
+
+        options = pa.ipc.IpcWriteOptions(compression='lz4')
+        with pa.ipc.new_file(str(partial_file), schema, options=options) as writer:
+
+            def _write(table: pa.Table, last_user=None) -> None:
+                # Takes in the delta rows up to last_user, or all that are left.
+                nonlocal merged, rows
+                end = len(delta_users) if last_user is None else np.searchsorted(delta_users, last_user, 'right')
+                if end > merged:
+                    table = _merge_ratings(table, delta.slice(merged, end - merged))
+                    merged = end
+                writer.write_table(table)
+                rows += table.num_rows
+
+            carry = schema.empty_table()
+            for i in range(reader.num_record_batches):
+                batch = pa.concat_tables([carry, pa.Table.from_batches([reader.get_batch(i)])])
+                users = batch.column('user_id').to_numpy()
+                if len(users) == 0:
+                    continue
+                # The last user's ratings may go on in the next batch, so they're held back.
+                tail = int(np.searchsorted(users, users[-1], 'left'))
+                carry = batch.slice(tail)
+                if tail > 0:
+                    _write(batch.slice(0, tail), users[tail - 1])
+            _write(carry)
+
+    partial_file.replace(output_file)
+    logger.info(f"Merged {delta.num_rows:,} ratings into {ratings_file.name}")
+    return rows
+
+
+def prepare_dataframes(fm: dict[str, FileManager], **quantiles) -> tuple[pd.DataFrame, pd.DataFrame]:
     work_df = format_works(fm['books'], fm['authors'], fm['works'])
     rate_df = format_ratings(fm['ratings'])
-    rate_df, work_df = filter_dataframes(rate_df, work_df)
+    rate_df, work_df = filter_dataframes(rate_df, work_df, **quantiles)
     return rate_df, work_df
 
 
-def generate_dataframes(source_files: dict[str, FileManager], dest_files: dict[str, pathlib.Path]) -> int:
-    ratings, works = prepare_dataframes(source_files)
+def generate_dataframes(source_files: dict[str, FileManager],
+                        dest_files: dict[str, pathlib.Path],
+                        full_text: bool = False,
+                        **quantiles) -> int:
+    ratings, works = prepare_dataframes(source_files, **quantiles)
     ratings.to_feather(dest_files['ratings'])
-    works.to_feather(dest_files['works'])
+    return save_works(works, dest_files, full_text)
+
 
-    con = sqlite3.connect(dest_files['database'])
-    works.to_sql('books', con, index=False, if_exists='replace')
-    con.close()
+def save_works(works: pd.DataFrame, dest_files: dict[str, pathlib.Path], full_text: bool = False) -> int:
+    works.to_feather(dest_files['works'])
+    export_catalog(pa.Table.from_pandas(works, preserve_index=False), dest_files['database'], full_text)
     return len(works)
 
 
+def _sql_type(data_type: pa.DataType) -> str:
+    if pa.types.is_integer(data_type) or pa.types.is_boolean(data_type):
+        return 'INTEGER'
+    if pa.types.is_floating(data_type):
+        return 'REAL'
+    return 'TEXT'
+
+
+def export_catalog(works: pa.Table,
+                   database: pathlib.Path,
+                   full_text: bool = False,
+                   batch_size: int = 1 << 16) -> None:
+    """
+    Writes the books table the webapp and model_test query, keyed and indexed for their lookups.
+
+    work_index is the INTEGER PRIMARY KEY, so it's the table's rowid, and both the page range scans and the IN (...)
+    lookups are seeks on the table b-tree. The database is built in a temporary file with journaling off and moved
+    into place once it's complete, so a failed export never leaves a half written catalog behind.
+    """
+    logger.info('Exporting Catalog')
+    works = works.sort_by('work_index')
+    columns = ['work_index'] + [c for c in works.column_names if c != 'work_index']
+    definitions = [f"{c} {_sql_type(works.schema.field(c).type)}" for c in columns]
+    definitions[0] += ' PRIMARY KEY'
+
+    temp_file = database.with_name(f"{database.name}.partial")
+    temp_file.unlink(missing_ok=True)
+    con = sqlite3.connect(temp_file)
+    try:
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        con.execute('PRAGMA locking_mode = EXCLUSIVE')
+        con.execute('PRAGMA temp_store = MEMORY')
+        con.execute('PRAGMA cache_size = -262144')
+        with con:
+            con.execute(f"CREATE TABLE books ({', '.join(definitions)})")
+            insert = f"INSERT INTO books ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+            for batch in works.select(columns).to_batches(max_chunksize=batch_size):
+                con.executemany(insert, zip(*(column.to_pylist() for column in batch.columns)))
+
+            con.execute('CREATE UNIQUE INDEX books_work_id ON books (work_id)')
+            con.execute('CREATE INDEX books_book_id ON books (book_id)')
+            con.execute('CREATE INDEX books_author_id ON books (author_id)')
+
+            if full_text:
+                _create_full_text_index(con)
+
+        con.execute('ANALYZE')
+        con.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        con.close()
+    temp_file.replace(database)
+
 
+def _create_full_text_index(con: sqlite3.Connection) -> None:
+    # An external content table, so the titles and author names aren't stored twice.
+    try:
+        con.execute("CREATE VIRTUAL TABLE books_search USING fts5("
+                    "title, author_name, content='books', content_rowid='work_index', tokenize='unicode61')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Skipping the full text index, this SQLite build doesn't support FTS5: {e}")
+        return
+    con.execute("INSERT INTO books_search (books_search) VALUES ('rebuild')")
@@ -1,12 +1,17 @@
+import hashlib
 import logging
 import os
 import pathlib
+import shutil
 
 import gdown
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
 
 from wrecksys import utils
 from wrecksys.config import ConfigFile
-from wrecksys.data import download, datasets, prepare
+from wrecksys.data import cache, download, datasets, external, prepare
 
 # logger = logging.getLogger(__name__).parent
 logger = logging.getLogger(__name__)
@@ -26,11 +31,16 @@ class GoodreadsData(object):
         self.config = config_file.data
         self.cheating = skip_processing
         self.data_dir = pathlib.Path(data_directory)
+        self.cache = cache.ArtifactCache(self.data_dir / 'cache', getattr(self.config, 'cache_budget', None))
+        self.tfrecords = from_tfrecords
+        # self.dataset_type = datasets.ProtobufDataset
+        # self.dataset_type = datasets.NumpyDataset
+        # self.dataset_type = datasets.TimelineDataset
+        self.dataset_type = datasets.MemmapDataset
+        self.keys = self._get_cache_keys()
         self.files = self._get_filepaths()
         self.sources = self._get_source_files()
-        self.tfrecords = from_tfrecords
-        # self.dataset = datasets.ProtobufDataset(**self.dataset_properties)
-        self.dataset = datasets.NumpyDataset(**self.dataset_properties)
+        self.dataset = self.dataset_type(**self.dataset_properties)
 
     @property
     def vocab_size(self) -> int:
@@ -48,6 +58,31 @@ class GoodreadsData(object):
     def max_length(self) -> int:
         return self.config.max_series_length
 
+    @property
+    def filter_quantiles(self) -> dict[str, float]:
+        quantiles = getattr(self.config, 'filter_quantiles', {})
+        return {'books': quantiles['books'] if 'books' in quantiles else .8,
+                'users': quantiles['users'] if 'users' in quantiles else .8}
+
+    @property
+    def clean_params(self) -> dict:
+        return {
+            'sources': dict(self.config['sources']),
+            'filter_quantiles': self.filter_quantiles,
+            'full_text_search': getattr(self.config, 'full_text_search', False)
+        }
+
+    @property
+    def dataset_params(self) -> dict:
+        return {
+            'format': self.dataset_type.__name__,
+            'min_length': self.min_length,
+            'max_length': self.max_length,
+            'num_shards': self.config.num_shards,
+            'split_by': getattr(self.config, 'split_by', 'user'),
+            'split_fraction': getattr(self.config, 'split_fraction', .1)
+        }
+
     @property
     def dataset_properties(self) -> dict:
         return {
@@ -55,22 +90,113 @@ class GoodreadsData(object):
             'output_dir': self.files['dataset'],
             'min_length': self.min_length,
             'max_length': self.max_length,
-            'num_shards': self.config.num_shards
+            'num_shards': self.config.num_shards,
+            'split_by': getattr(self.config, 'split_by', 'user'),
+            'split_fraction': getattr(self.config, 'split_fraction', .1)
         }
 
     def build(self) -> None:
-        if self.dataset.exists():
+        key = self.keys['dataset']
+        if self.cache.exists(key):
+            self._preload_dataframes()
+            self.config.num_records = self.cache.metadata(key)['num_records']
+            config_file.save()
             return
 
         self._preload_source_data()
         self._preload_dataframes()
+        if self.dataset.exists():
+            # Left over from a build that never finished.
+            self.dataset.delete()
         self.config.num_records = self.dataset.build()
+        self.cache.commit(key, self.dataset_params, num_records=self.config.num_records)
+        self.cache.evict(keep=set(self.keys.values()))
         config_file.save()
 
+    @property
+    def deltas(self) -> list[str]:
+        return list(getattr(self.config, 'clean_deltas', []))
+
+    def update(self, delta: pd.DataFrame) -> int:
+        """
+        Merges new or changed interactions (in the clean ratings schema) into a copy of the clean data, then rebuilds
+        only the training examples of the users they touch.
+
+        The updated clean data is cached under a key that folds in a digest of the delta, and the delta is kept so
+        the same artifact can be rebuilt from the sources if it is evicted. The dataset built from the old clean data
+        is moved across to the new key and updated there, so nothing is left cached under a key it no longer matches.
+        """
+        self._preload_dataframes()
+        work_ids = delta['work_id']
+        if ((work_ids < 1) | (work_ids > self.vocab_size)).any():
+            raise ValueError("The delta rates works that aren't in the catalog, rebuild the clean data instead.")
+
+        digest = hashlib.sha256(pd.util.hash_pandas_object(delta[sorted(delta.columns)], index=False)
+                                .to_numpy().tobytes()).hexdigest()[:16]
+        delta_file = self._delta_file(digest)
+        delta_file.parent.mkdir(parents=True, exist_ok=True)
+        delta.reset_index(drop=True).to_feather(delta_file)
+
+        old_keys, old_files = self.keys, self.files
+        self.config.clean_deltas = self.deltas + [digest]
+        self.keys = self._get_cache_keys()
+        self.files = self._get_filepaths()
+
+        # The delta only rates works already in the catalog, so works.feather and app.db carry over as they are.
+        for name in ('works', 'database'):
+            shutil.copy2(old_files[name], self.files[name])
+        prepare.merge_ratings(old_files['ratings'], delta, self.files['ratings'])
+        self.cache.commit(self.keys['clean'], self.clean_params, vocab_size=self.vocab_size, deltas=self.deltas)
+
+        moved = self.cache.exists(old_keys['dataset'])
+        if moved:
+            shutil.rmtree(self.files['dataset'])
+            old_files['dataset'].replace(self.files['dataset'])
+        self.cache.remove(old_keys['dataset'])
+        self.dataset = self.dataset_type(**self.dataset_properties)
+
+        size = None
+        if moved:
+            try:
+                size = self.dataset.update(delta['user_id'].unique())
+            except NotImplementedError:
+                logger.info(f"{type(self.dataset).__name__} can't be updated in place, rebuilding it.")
+        if size is None:
+            self.dataset.delete()
+            size = self.dataset.build()
+        self.config.num_records = self.dataset.size
+        self.cache.commit(self.keys['dataset'], self.dataset_params, num_records=self.config.num_records)
+        self.cache.evict(keep=set(self.keys.values()))
+        config_file.save()
+        return size
+
+    def label_counts(self) -> np.ndarray:
+        """
+        How many times each work_index is rated in the clean data, as an array indexed by work_index.
+        """
+        work_ids = feather.read_table(self.files['ratings'], columns=['work_id'], memory_map=True).column('work_id')
+        return np.bincount(work_ids.to_numpy(), minlength=self.vocab_size + 1)
+
     def _preload_dataframes(self) -> None:
-        if self.files['ratings'].exists() and self.files['works'].exists():
+        key = self.keys['clean']
+        if self.cache.exists(key):
+            self.config.vocab_size = self.cache.metadata(key)['vocab_size']
             return
-        self.config.vocab_size = prepare.generate_dataframes(self.sources, self.files)
+        full_text = getattr(self.config, 'full_text_search', False)
+        if getattr(self.config, 'out_of_core', False):
+            self.config.vocab_size = external.generate_dataframes(self.sources,
+                                                                  self.files,
+                                                                  getattr(self.config, 'memory_budget', None),
+                                                                  full_text,
+                                                                  **self.filter_quantiles)
+        else:
+            self.config.vocab_size = prepare.generate_dataframes(self.sources,
+                                                                 self.files,
+                                                                 full_text,
+                                                                 **self.filter_quantiles)
+        for digest in self.deltas:
+            prepare.merge_ratings(self.files['ratings'], pd.read_feather(self._delta_file(digest)))
+        self.cache.commit(key, self.clean_params, vocab_size=self.config.vocab_size, deltas=self.deltas)
 
 
     def _preload_source_data(self):
@@ -80,15 +206,32 @@ class GoodreadsData(object):
                 output=str(self.data_dir / 'raw'),
                 quiet=False,
                 use_cookies=False)
+        workers = getattr(self.config, 'ingest_workers', 1)
+        if workers > 1:
+            download.download_all(list(self.sources.values()),
+                                  max_workers=workers,
+                                  memory_limit=getattr(self.config, 'ingest_memory_limit', None))
+            return
         for s in self.sources.values():
             s.download()
 
+    def _get_cache_keys(self) -> dict[str, str]:
+        # Each update applied to the clean data is part of its key, so the updated ratings never share a key with
+        # the ones built straight from the sources.
+        clean = self.cache.fingerprint('clean', self.clean_params, self.deltas)
+        dataset = self.cache.fingerprint('dataset', self.dataset_params, [clean])
+        return {'clean': clean, 'dataset': dataset}
+
+    def _delta_file(self, digest: str) -> pathlib.Path:
+        return self.data_dir / f'deltas/{digest}.feather'
+
     def _get_filepaths(self) -> dict[str, pathlib.Path]:
+        clean_dir = self.cache.path(self.keys['clean'])
         paths = {
-            'database': (self.data_dir / 'app.db').resolve(),
-            'dataset': (self.data_dir / 'training').resolve(),
-            'ratings': (self.data_dir / 'clean/ratings.feather').resolve(),
-            'works': (self.data_dir / 'clean/works.feather').resolve()
+            'database': (clean_dir / 'app.db').resolve(),
+            'dataset': self.cache.path(self.keys['dataset']).resolve(),
+            'ratings': (clean_dir / 'ratings.feather').resolve(),
+            'works': (clean_dir / 'works.feather').resolve()
         }
         for f in paths.values():
             f.parent.mkdir(parents=True, exist_ok=True)
@@ -98,13 +241,21 @@ class GoodreadsData(object):
     def _get_source_files(self) -> dict[str, download.FileManager]:
         sources = self.config['sources']
         data_dir = self.data_dir
-        def _parse_url(url: str) -> dict[str, str | pathlib.Path]:
+        block_size = getattr(self.config, 'parse_block_size', None)
+        chunk_size = getattr(self.config, 'download_chunk_size', None)
+        connections = getattr(self.config, 'download_connections', 4)
+        pipelined = getattr(self.config, 'pipelined_ingest', False)
+        def _parse_url(url: str) -> dict[str, str | int | pathlib.Path]:
             file_name = utils.get_file_name(url)
             return {
                 'url': url,
                 'file_name': file_name,
                 'example_file': (data_dir / f'examples/{file_name}_example.json').resolve(),
-                "output_file": (data_dir / f'raw/{file_name}.feather').resolve()
+                "output_file": (data_dir / f'raw/{file_name}.feather').resolve(),
+                'block_size': block_size,
+                'chunk_size': chunk_size,
+                'connections': connections,
+                'pipelined': pipelined
             }
 
         file_data = {label: _parse_url(url) for label, url in sources.items()}
@@ -0,0 +1,101 @@
+"""
+Runs multi-worker training on a cluster of local processes, one TF worker each.
+
+The launcher builds the dataset once, then starts num_workers copies of this module with a TF_CONFIG that puts them
+in the same cluster on consecutive localhost ports. Each one trains FunctionalModel under a
+MultiWorkerMirroredStrategy, reading its own share of every split, and worker 0 saves the model. The same
+FunctionalModel runs unchanged across machines when TF_CONFIG lists their addresses instead.
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+from wrecksys.data.sources import GoodreadsData
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 12345
+
+
+def cluster_config(num_workers: int, worker: int, port: int = DEFAULT_PORT) -> dict:
+    return {
+        'cluster': {'worker': [f'localhost:{port + i}' for i in range(num_workers)]},
+        'task': {'type': 'worker', 'index': worker}
+    }
+
+
+def run_worker(model_name: str,
+               data_directory: pathlib.Path,
+               epochs: int = 1,
+               limit: int | None = None,
+               threads: int | None = None) -> None:
+    # Workers sharing one machine split its cores instead of each starting a thread per core.
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    # The strategy has to exist before anything else touches the TF runtime.
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    from wrecksys.model_maker import FunctionalModel
+    (
+        FunctionalModel(model_name, data_directory, strategy)
+        .load()
+        .train_and_eval(epochs=epochs, limit=limit)
+        .save()
+    )
+
+
+def launch(model_name: str,
+           data_directory: pathlib.Path,
+           num_workers: int,
+           epochs: int = 1,
+           limit: int | None = None,
+           port: int = DEFAULT_PORT) -> float:
+    """
+    Trains on num_workers local processes and returns the wall-clock seconds it took.
+    """
+    GoodreadsData(data_directory).build()
+
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    workers = []
+    start = time.perf_counter()
+    for worker in range(num_workers):
+        command = [sys.executable, '-m', 'wrecksys.distributed', model_name, str(data_directory),
+                   '--worker', str(worker), '--epochs', str(epochs), '--threads', str(threads)]
+        if limit is not None:
+            command += ['--limit', str(limit)]
+        env = dict(os.environ, TF_CONFIG=json.dumps(cluster_config(num_workers, worker, port)))
+        workers.append(subprocess.Popen(command, env=env))
+
+    failed = [i for i, worker in enumerate(workers) if worker.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed.")
+    seconds = time.perf_counter() - start
+    logger.info(f"Trained {model_name} on {num_workers} workers in {seconds:.1f}s.")
+    return seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train a WreckSys model on a cluster of local worker processes.')
+    parser.add_argument('model_name')
+    parser.add_argument('data_directory', type=pathlib.Path)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--worker', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--threads', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.worker is None:
+        launch(args.model_name, args.data_directory, args.workers, args.epochs, args.limit, args.port)
+    else:
+        run_worker(args.model_name, args.data_directory, args.epochs, args.limit, args.threads)
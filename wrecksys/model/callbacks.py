@@ -1,4 +1,5 @@
 import pathlib
+import time
 from datetime import datetime
 
 from wrecksys.utils import import_tensorflow
@@ -6,36 +7,86 @@ tf, keras = import_tensorflow()
 
 
 class SaveCheckpoint(keras.callbacks.Callback):
-    def __init__(self, checkpoint_manager):
+    """
+    Saves a checkpoint every interval training steps, or at the end of every epoch without one, and when training
+    ends. Writes are asynchronous: the training thread only copies the variables, and the files are written in the
+    background while the next steps run.
+    """
+    def __init__(self, checkpoint_manager: tf.train.CheckpointManager, interval: int | None = None):
         super().__init__()
         self.checkpoint_manager = checkpoint_manager
+        self.interval = interval
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        self._step = 0
+        self._saved_step = None
+
+    def on_train_begin(self, logs=None):
+        # Counted from here on instead of read from the step counter, which would wait on the device every step.
+        self._step = int(self.model.optimizer.iterations.numpy())
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step += 1
+        if self.interval and self._step % self.interval == 0:
+            self._save()
 
-    # noinspection PyProtectedMember
     def on_epoch_end(self, epoch, logs=None):
-        step = int(self.checkpoint_manager._step_counter)
-        self.checkpoint_manager.save(checkpoint_number=step)
+        if not self.interval:
+            self._save()
 
+    def on_train_end(self, logs=None):
+        self._save()
+        # The last write has to be on disk before anything reads the checkpoints back or the process exits.
+        self.checkpoint_manager.checkpoint.sync()
 
-def callback_list(model: keras.Model, model_dir: pathlib.Path) -> list:
-    logs_dir = model_dir / 'logs/' / datetime.now().strftime("%Y%m%d-%H%M%S")
-    checkpoint_dir = model_dir / 'checkpoints/'
+    def _save(self):
+        if self._step != self._saved_step:
+            self.checkpoint_manager.save(checkpoint_number=self._step, options=self.options)
+            self._saved_step = self._step
+
+
+class StepTimer(keras.callbacks.Callback):
+    """
+    Records when each training step ends and the loss it reported. The first warmup steps include tracing and
+    compilation, so they're left out of steps_per_second.
+    """
+    def __init__(self, warmup: int = 5):
+        super().__init__()
+        self.warmup = warmup
+        self.losses = []
+        self._times = []
 
+    def on_train_batch_end(self, batch, logs=None):
+        self._times.append(time.perf_counter())
+        self.losses.append(float(logs[self.model.loss.name]))
+
+    @property
+    def steps_per_second(self) -> float:
+        timed = self._times[self.warmup - 1:] if self.warmup > 0 else self._times
+        return (len(timed) - 1) / (timed[-1] - timed[0])
+
+
+def checkpoint_manager(model: keras.Model,
+                       directory: pathlib.Path,
+                       max_to_keep: int,
+                       **trackables) -> tf.train.CheckpointManager:
+    """
+    Checkpoints the model's weights and its optimizer's state, which holds the step counter, along with any other
+    trackables, such as variables recording where the training run started.
+    """
+    checkpoint = tf.train.Checkpoint(model=model, opt=model.optimizer, **trackables)
+    return tf.train.CheckpointManager(checkpoint=checkpoint, directory=str(directory), max_to_keep=max_to_keep)
+
+
+def callback_list(model: keras.Model,
+                  model_dir: pathlib.Path,
+                  checkpoints: tf.train.CheckpointManager | None = None,
+                  checkpoint_interval: int | None = None) -> list:
+    logs_dir = model_dir / 'logs/' / datetime.now().strftime("%Y%m%d-%H%M%S")
     logs_dir.parent.mkdir(exist_ok=True)
-    checkpoint_dir.parent.mkdir(exist_ok=True)
 
     stop_early = keras.callbacks.EarlyStopping(monitor='Global_Softmax_Cross_Entropy', patience=3)
     save_tensorboard = keras.callbacks.TensorBoard(log_dir=logs_dir, histogram_freq=1, profile_batch='10, 15')
 
-    """checkpoint = tf.train.Checkpoint(
-        model=model,
-        opt=model.optimizer)
-    checkpoint_manager = tf.train.CheckpointManager(
-        checkpoint=checkpoint,
-        directory=checkpoint_dir,
-        max_to_keep=1,
-        step_counter=model.optimizer.iterations,
-        checkpoint_interval=0)
-    save_checkpoint = SaveCheckpoint(checkpoint_manager)"""
-
-    #return keras.callbacks.CallbackList([stop_early, save_tensorboard, save_checkpoint])
-    return [stop_early, save_tensorboard] # , save_checkpoint]
+    if checkpoints is None:
+        return [stop_early, save_tensorboard]
+    return [stop_early, save_tensorboard, SaveCheckpoint(checkpoints, checkpoint_interval)]
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+import typing
+from concurrent import futures
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+logger = logging.getLogger(__name__)
+
+
+def label_ranks(contexts: np.ndarray, items: np.ndarray, labels: np.ndarray, block_size: int = 1024) -> np.ndarray:
+    """
+    The exact 0-based rank of each label among every item's score, ties going to the lower index as in
+    metrics._label_ranks. Scores are computed a block of contexts at a time, so memory stays at
+    block_size x num_items no matter how large the chunk is.
+    """
+    ranks = np.empty(len(labels), dtype=np.int64)
+    columns = np.arange(items.shape[0])
+    for start in range(0, len(labels), block_size):
+        block = slice(start, start + block_size)
+        scores = contexts[block] @ items.T
+        label_scores = np.take_along_axis(scores, labels[block, None], axis=1)
+        ranks[block] = ((scores > label_scores) | ((scores == label_scores) & (columns < labels[block, None]))).sum(1)
+    return ranks
+
+
+def summarize(ranks: np.ndarray, top_k: typing.Iterable[int]) -> dict:
+    # With one relevant item per example, its DCG@K is 1 / log2(rank + 2) inside the top K, and the ideal DCG is 1.
+    report = {
+        'examples': int(len(ranks)),
+        'mrr': float(np.mean(1.0 / (ranks + 1))),
+        'mean_rank': float(np.mean(ranks)),
+        'median_rank': float(np.median(ranks)),
+        'recall': {},
+        'ndcg': {}
+    }
+    gains = 1.0 / np.log2(ranks + 2)
+    for k in top_k:
+        report['recall'][str(k)] = float(np.mean(ranks < k))
+        report['ndcg'][str(k)] = float(np.mean(np.where(ranks < k, gains, 0.0)))
+    return report
+
+
+def evaluate(encode: typing.Callable[[dict[str, tf.Tensor]], tf.Tensor],
+             items: np.ndarray,
+             dataset: tf.data.Dataset,
+             top_k: typing.Iterable[int] = (1, 5, 10, 100),
+             workers: int | None = None,
+             report_file: pathlib.Path | None = None) -> dict:
+    """
+    Ranks every example of a batched (features, label) dataset against a fixed item matrix.
+
+    Labels with no row in the item matrix can't be ranked. They're counted in skipped_labels and scored as ranked
+    below every item, so they count as misses rather than being left out of the metrics.
+
+    The contexts are encoded with TF on this thread, while a thread pool scores the previous chunks with NumPy,
+    whose matrix products release the GIL. Nothing here touches the model's metrics or training state, so it can
+    run against a copy of the item matrix while training carries on.
+    """
+    workers = workers or os.cpu_count()
+    items = np.ascontiguousarray(items, dtype=np.float32)
+    ranks, skipped = [], 0
+    start = time.perf_counter()
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for x, y in tqdm(dataset, desc='Evaluating', unit='batch', file=sys.stdout):
+            # Row i of items is label_id i + 1, as in the model's scores.
+            labels = np.reshape(y.numpy(), [-1]).astype(np.int64) - 1
+            valid = (labels >= 0) & (labels < len(items))
+            invalid = int((~valid).sum())
+            if invalid:
+                skipped += invalid
+                ranks.append(np.full(invalid, len(items), dtype=np.int64))
+            contexts = encode(x).numpy()
+            pending.append(pool.submit(label_ranks, contexts[valid], items, labels[valid]))
+            # Bounds the chunks held in memory while the pool catches up.
+            while len(pending) > 2 * workers:
+                ranks.append(pending.pop(0).result())
+        ranks.extend(f.result() for f in pending)
+
+    report = summarize(np.concatenate(ranks) if ranks else np.empty(0, dtype=np.int64), top_k)
+    report['num_items'] = int(len(items))
+    report['skipped_labels'] = skipped
+    if skipped:
+        logger.warning(f"{skipped:,} of {report['examples']:,} labels have no item embedding and count as misses.")
+    report['seconds'] = round(time.perf_counter() - start, 2)
+    logger.info(f"Evaluated {report['examples']:,} examples in {report['seconds']}s: MRR {report['mrr']:.4f}, "
+                + ', '.join(f"Recall@{k} {v:.4f}" for k, v in report['recall'].items()))
+
+    if report_file is not None:
+        report_file = pathlib.Path(report_file)
+        report_file.parent.mkdir(parents=True, exist_ok=True)
+        with report_file.open('w') as f:
+            json.dump(report, f, indent=4)
+    return report
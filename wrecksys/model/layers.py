@@ -16,8 +16,17 @@ class BookEncoder(keras.layers.Layer):
                 mean=0.0,
                 stddev=1.0 / self._embedding_dim ** 0.5),
             mask_zero=True,
+            # The tables and lookups stay float32 under a mixed precision policy.
+            dtype='float32',
             name=f"{name}_embedding_layer")
 
+    @property
+    def embeddings(self) -> tf.Variable:
+        # The sampled loss reads the table directly, which can happen before the layer has been called.
+        if not self._embedding_layer.built:
+            self._embedding_layer.build(None)
+        return self._embedding_layer.embeddings
+
     def call(self, inputs, *args, **kwargs) -> tf.Tensor:
         label = inputs['label_id']
 
@@ -45,6 +54,8 @@ class RatingEncoder(BookEncoder):
     def __init__(self, vocab_size, embedding_dim, rnn_dim):
         super().__init__(vocab_size, embedding_dim, 'context')
         self._rnn_dim = rnn_dim
+        # The context embedding table is float32 like the label one, while the GRU runs in the compute dtype and
+        # casts the embedded contexts to it.
         self._rnn_layer = keras.layers.GRU(rnn_dim)
 
     def call(self, inputs: dict[str, tf.Tensor], *args, **kwargs) -> tf.Tensor:
@@ -59,7 +70,7 @@ class RatingEncoder(BookEncoder):
         rating = inputs['context_rating']
         if isinstance(rating, tf.SparseTensor):
             rating = tf.sparse.to_dense(rating)
-        rating_embed = tf.expand_dims(rating, -1)
+        rating_embed = tf.expand_dims(tf.cast(rating, context_embed.dtype), -1)
 
         embedding = tf.concat([context_embed, rating_embed], -1)
 
@@ -16,7 +16,7 @@
 #
 #   From: https://github.com/tensorflow/examples/tree/master/lite/examples/recommendation/ml
 #   Included without modification under the assumption that they know something I don't
-#   about the built-in Keras loss layers.
+#   about the built-in Keras loss layers. GlobalSoftmax has since switched to sparse labels.
 #
 
 from wrecksys.utils import import_tensorflow
@@ -39,7 +39,8 @@ class GlobalSoftmax(keras.losses.Loss):
         """Compute softmax loss with full vocab labels as negatives.
 
     Args:
-      y_true: the true labels with shape [batch_size, 1].
+      y_true: the column of each example's label in y_pred, with shape
+        [batch_size, 1].
       y_pred: the pre-calculated similarities matrix with shape [batch_size,
         label_embedding_vocab_size]
 
@@ -47,12 +48,75 @@ class GlobalSoftmax(keras.losses.Loss):
       The softmax loss with full vocab labels as negatives.
     """
         logits = keras.backend.cast(y_pred, 'float32')
-        # Compose a metric to tell which column represents the similarity between
-        # the example and the label. For each row, only the item at index of the
-        # label of that example will be set as 1.
-        full_labels = tf.one_hot(
-            tf.transpose(y_true)[0], tf.shape(logits)[1], dtype=tf.dtypes.float32)
-        batch_loss = tf.nn.softmax_cross_entropy_with_logits(
-            labels=full_labels, logits=logits)
+        # The label of each example is the column holding its similarity, so the
+        # sparse op picks it out without building a [batch_size, vocab_size]
+        # one-hot label matrix.
+        labels = tf.cast(tf.transpose(y_true)[0], tf.int32)
+        batch_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=labels, logits=logits)
         loss = tf.reduce_mean(batch_loss)
         return loss
+
+
+#
+#   Sampled alternatives to GlobalSoftmax, for catalogs too large to score in full on every training step.
+#   Both take the context embeddings [batch_size, dims] and integer labels [batch_size], and correct each
+#   negative's logit by the log of its sampling probability (logQ), so the sampled softmax stays an unbiased
+#   estimate of the full one.
+#
+
+def in_batch_softmax(context_embeddings: tf.Tensor,
+                     label_embeddings: tf.Tensor,
+                     labels: tf.Tensor,
+                     label_log_q: tf.Tensor | None = None) -> tf.Tensor:
+    """Softmax over the other labels in the batch as negatives.
+
+    Popular items show up as negatives in proportion to how often they are labels, so label_log_q, the log of
+    each label's share of the training labels, is subtracted from their logits. Rows that share a label aren't
+    negatives for each other and are masked out.
+    """
+    logits = tf.cast(tf.matmul(context_embeddings, label_embeddings, transpose_b=True), 'float32')
+    if label_log_q is not None:
+        logits -= tf.expand_dims(tf.gather(label_log_q, labels), 0)
+
+    batch_size = tf.shape(labels)[0]
+    duplicates = tf.logical_and(tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(labels, 0)),
+                                tf.logical_not(tf.eye(batch_size, dtype=tf.bool)))
+    logits = tf.where(duplicates, tf.fill(tf.shape(logits), logits.dtype.min), logits)
+    batch_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.range(batch_size), logits=logits)
+    return tf.reduce_mean(batch_loss)
+
+
+def sampled_softmax(context_embeddings: tf.Tensor,
+                    embedding_table: tf.Tensor,
+                    labels: tf.Tensor,
+                    num_sampled: int,
+                    unigrams: list[float] | None = None) -> tf.Tensor:
+    """Softmax over num_sampled negatives drawn from the rows of the embedding table after the padding row 0.
+
+    Work ids don't follow popularity, so negatives are drawn in proportion to unigrams, how often each label_id
+    from 1 to len(unigrams) occurs in the training data, or uniformly from the whole table without them. The samplers count from 0, so labels are
+    shifted down for them and the candidates back up. tf.nn.sampled_softmax_loss subtracts the log of each
+    candidate's expected count, which is the logQ correction, and removes negatives that happen to be the label.
+    """
+    num_classes = embedding_table.shape[0]
+    true_classes = tf.expand_dims(tf.cast(labels, tf.int64), -1)
+    options = {'true_classes': true_classes - 1,
+               'num_true': 1,
+               'num_sampled': num_sampled,
+               'unique': True,
+               'range_max': num_classes - 1 if unigrams is None else len(unigrams)}
+    if unigrams is None:
+        candidates, true_expected, sampled_expected = tf.random.uniform_candidate_sampler(**options)
+    else:
+        candidates, true_expected, sampled_expected = tf.random.fixed_unigram_candidate_sampler(unigrams=unigrams,
+                                                                                                **options)
+    batch_loss = tf.nn.sampled_softmax_loss(weights=embedding_table,
+                                            biases=tf.zeros([num_classes], dtype=embedding_table.dtype),
+                                            labels=true_classes,
+                                            inputs=context_embeddings,
+                                            num_sampled=num_sampled,
+                                            num_classes=num_classes,
+                                            sampled_values=(candidates + 1, true_expected, sampled_expected),
+                                            remove_accidental_hits=True)
+    return tf.reduce_mean(batch_loss)
@@ -16,6 +16,8 @@
 #
 #   Original version from: https://github.com/tensorflow/examples/tree/master/lite/examples/recommendation/ml
 #   Added metric_list() for use in model.model_builder
+#   Recall and rank are computed from the label's rank, found by counting comparisons, so no
+#   [batch_size, vocab_size] one-hot, softmax or argsort is needed.
 #
 
 from __future__ import absolute_import
@@ -41,46 +43,78 @@ def _get_batch_similarities(batch_label, full_vocab_similarities):
         full_vocab_similarities, tf.transpose(batch_label)[0], axis=1)
 
 
-class BatchRecall(keras.metrics.Recall):
+def _label_ranks(similarities, label_indices):
+    """0-based rank of each row's label column, by counting the columns ahead of it.
+
+    Ties go to the lower column index, the same order tf.math.top_k and
+    tf.argsort produce, so the ranks match sorting the row.
+
+    Args:
+      similarities: a [batch_size, num_columns] similarity matrix.
+      label_indices: the column of each row's label, with shape [batch_size].
+    """
+    label_indices = tf.cast(label_indices, tf.int32)
+    label_scores = tf.expand_dims(
+        tf.gather(similarities, label_indices, batch_dims=1), -1)
+    columns = tf.expand_dims(tf.range(tf.shape(similarities)[1]), 0)
+    ahead = tf.logical_or(
+        tf.greater(similarities, label_scores),
+        tf.logical_and(tf.equal(similarities, label_scores),
+                       tf.less(columns, tf.expand_dims(label_indices, -1))))
+    return tf.math.count_nonzero(ahead, axis=-1, dtype=tf.int32)
+
+
+class _RankRecall(keras.metrics.Recall):
+    """Recall for top_k, from the rank of each example's single label."""
+
+    def _update_from_ranks(self, ranks, sample_weight=None):
+        hits = tf.cast(tf.less(ranks, self.top_k), self.dtype)
+        weights = tf.ones_like(hits)
+        if sample_weight is not None:
+            weights = tf.broadcast_to(
+                tf.reshape(tf.cast(sample_weight, self.dtype), [-1]), tf.shape(hits))
+        true_positives = tf.reduce_sum(hits * weights)
+        false_negatives = tf.reduce_sum((1.0 - hits) * weights)
+        self.true_positives.assign_add(
+            true_positives * tf.ones_like(self.true_positives))
+        self.false_negatives.assign_add(
+            false_negatives * tf.ones_like(self.false_negatives))
+
+
+class BatchRecall(_RankRecall):
     """Compute batch recall for top_k."""
 
     def update_state(self, y_true, y_pred, sample_weight=None):
         """Update state of the metric.
 
         Args:
-          y_true: the true labels with shape [batch_size, 1].
+          y_true: the column of each label in y_pred, with shape [batch_size, 1].
           y_pred: model output, which is the similarity matrix with shape
             [batch_size, label_embedding_vocab_size] between context and full vocab
             label embeddings.
           sample_weight: Optional weighting of each example. Defaults to 1.
         """
-        label_indices = tf.eye(
-            tf.shape(y_pred)[0], tf.shape(y_pred)[0], dtype=tf.dtypes.float32)
-        # Since tf.keras default recall metric only accept predicted values in
-        # range [0, 1], so use tf.nn.softmax to preprocess.
-        normalized_logits = tf.nn.softmax(_get_batch_similarities(y_true, y_pred))
-        super().update_state(label_indices, normalized_logits, sample_weight)
+        # Each context's own label sits on the diagonal of the batch similarities.
+        similarities = _get_batch_similarities(y_true, y_pred)
+        ranks = _label_ranks(similarities, tf.range(tf.shape(similarities)[0]))
+        self._update_from_ranks(ranks, sample_weight)
 
 
-class GlobalRecall(keras.metrics.Recall):
+class GlobalRecall(_RankRecall):
     """Compute global recall for top_k."""
 
     def update_state(self, y_true, y_pred, sample_weight=None):
         """Update state of the metric.
 
         Args:
-          y_true: the true labels with shape [batch_size, 1].
+          y_true: the column of each label in y_pred, with shape [batch_size, 1].
           y_pred: model output, which is the similarity matrix with shape
             [batch_size, label_embedding_vocab_size] between context and full vocab
             label embeddings.
           sample_weight: Optional weighting of each example. Defaults to 1.
         """
-        label_indices = tf.one_hot(
-            tf.transpose(y_true)[0], tf.shape(y_pred)[1], dtype=tf.dtypes.float32)
-        # Since tf.keras default recall metric only accept predicted values in
-        # range [0, 1], so use tf.nn.softmax to preprocess.
-        normalized_logits = tf.nn.softmax(y_pred)
-        super().update_state(label_indices, normalized_logits, sample_weight)
+        ranks = _label_ranks(y_pred, tf.transpose(y_true)[0])
+        self._update_from_ranks(ranks, sample_weight)
 
 
 class BatchMeanRank(keras.metrics.Mean):
@@ -92,7 +126,7 @@ class BatchMeanRank(keras.metrics.Mean):
         """Update state of the metric.
 
         Args:
-          y_true: the true labels with shape [batch_size, 1].
+          y_true: the column of each label in y_pred, with shape [batch_size, 1].
           y_pred: model output, which is the similarity matrix with shape
             [batch_size, label_embedding_vocab_size] between context and full vocab
             label embeddings. Hence, to compute batch mean rank, the default global
@@ -101,15 +135,7 @@ class BatchMeanRank(keras.metrics.Mean):
           sample_weight: Optional weighting of each example. Defaults to 1.
         """
         similarities = _get_batch_similarities(y_true, y_pred)
-        # Get the ranks of the correct label for each context.
-        batch_size = tf.shape(similarities)[0]
-        label_indices = tf.expand_dims(tf.range(batch_size), -1)
-
-        # Get the indices of similar labels in sorted order for each context.
-        sorted_similarities = tf.argsort(
-            similarities, axis=-1, direction='DESCENDING')
-
-        ranks = tf.where(tf.equal(sorted_similarities, label_indices))[:, -1]
+        ranks = _label_ranks(similarities, tf.range(tf.shape(similarities)[0]))
         ranks = keras.backend.cast(ranks, 'float32')
         super().update_state(ranks, sample_weight=sample_weight)
 
@@ -123,20 +149,12 @@ class GlobalMeanRank(keras.metrics.Mean):
         """Update state of the metric.
 
         Args:
-          y_true: the true labels with shape [batch_size, 1].
+          y_true: the column of each label in y_pred, with shape [batch_size, 1].
           y_pred: model output, which is the similarity matrix with shape
             [batch_size, label_embedding_vocab_size] between context and full vocab
             label embeddings.
           sample_weight: Optional weighting of each example. Defaults to 1.
         """
-
-        similarities = y_pred
-        label_indices = tf.expand_dims(tf.cast(y_true, dtype=tf.int32), -1)
-
-        # Get the indices of similar labels in sorted order for each context.
-        sorted_similarities = tf.argsort(
-            similarities, axis=-1, direction='DESCENDING')
-
-        ranks = tf.where(tf.equal(sorted_similarities, label_indices))[:, -1]
+        ranks = _label_ranks(y_pred, tf.transpose(y_true)[0])
         ranks = keras.backend.cast(ranks, 'float32')
         super().update_state(ranks, sample_weight=sample_weight)
@@ -1,11 +1,13 @@
 import logging
 
-from wrecksys.model import layers, metrics
+from wrecksys.model import layers, losses, metrics, retrieval
 from wrecksys.utils import import_tensorflow
 tf, keras = import_tensorflow()
 
 logger = logging.getLogger(__name__)
 
+TRAINING_LOSSES = ('global', 'in_batch', 'sampled')
+
 
 @keras.saving.register_keras_serializable(package="GRU4Books")
 class WreckSys(keras.Model):
@@ -24,51 +26,193 @@ class WreckSys(keras.Model):
         self._metrics = metrics.metrics_list([1, 5, 10, 100])
 
         self._vocabulary = {'label_id': tf.range(1, self._vocab_size)}
-
-    @tf.function
+        self._training_loss = self._config.get('training_loss', 'global')
+        if self._training_loss not in TRAINING_LOSSES:
+            raise ValueError(f"Unknown training loss {self._training_loss}, expected one of {TRAINING_LOSSES}")
+        self._label_log_q = None
+        self._label_unigrams = None
+        self._item_embeddings = None
+        self._retrieval_index = None
+        # Compiles the full-vocabulary logits and loss with XLA in train_step and test_step. Set before fit().
+        self.xla_scoring = False
+        # train_step and test_step already aggregate their outputs across replicas, which Keras would sum again.
+        self.distribute_reduction_method = 'first'
+
+    # Keras compiles train_step and test_step itself. Wrapping them in another tf.function breaks the cross-replica
+    # gradient and metric aggregation under a distribution strategy.
     def train_step(self, data):
         x, y_true = data
         with tf.GradientTape() as tape:
-            y_pred = self(x, training=True)
-            loss = self.compute_loss(y=y_true, y_pred=y_pred)
-
-        gradients = tape.gradient(loss, self.trainable_variables)
+            if self._training_loss == 'global' and self.xla_scoring:
+                _, loss = self._compiled_scores(self._context_encoder(x, training=True),
+                                                self._label_matrix(),
+                                                self._label_columns(y_true))
+            elif self._training_loss == 'global':
+                loss = self.loss.call(self._label_columns(y_true), self(x, training=True))
+            else:
+                loss = self._sampled_loss(x, y_true)
+            # Gradients are summed across replicas, so each replica's mean loss only counts for its share.
+            scaled_loss = loss / self.distribute_strategy.num_replicas_in_sync
+
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
         self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
-        return {self.loss.name: loss}
+        return {self.loss.name: self._replica_mean(loss)}
+
+    @property
+    def training_loss(self) -> str:
+        return self._training_loss
+
+    def _sampled_loss(self, x, y_true) -> tf.Tensor:
+        # Scores each context against a sample of labels instead of the whole vocabulary. The embedding table and
+        # the label frequencies are both indexed by label_id, so the labels are used as they are.
+        labels = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+        context_embeddings = tf.cast(self._context_encoder(x, training=True), 'float32')
+        if self._training_loss == 'in_batch':
+            label_embeddings = self._label_encoder({'label_id': labels}, training=True)
+            return losses.in_batch_softmax(context_embeddings, label_embeddings, labels, self._label_log_q)
+        return losses.sampled_softmax(context_embeddings,
+                                      self._label_encoder.embeddings,
+                                      labels,
+                                      self._config.get('num_negatives', 4096),
+                                      self._label_unigrams)
+
+    @staticmethod
+    def _label_columns(y_true: tf.Tensor) -> tf.Tensor:
+        # label_id 0 is padding and has no column in the scores, so column i holds label_id i + 1.
+        return tf.cast(y_true, tf.int32) - 1
+
+    def set_label_frequencies(self, counts) -> None:
+        """
+        Sets how often each label occurs in the training data, indexed by label_id: for the in_batch loss' logQ
+        correction, and for the sampled loss to draw its negatives by.
+        """
+        counts = tf.cast(counts, 'float32') + 1.0
+        object.__setattr__(self, '_label_log_q', tf.math.log(counts / tf.reduce_sum(counts)))
+        # The sampler takes its distribution as a list, and leaves out the padding label_id 0.
+        object.__setattr__(self, '_label_unigrams', counts.numpy()[1:].tolist())
 
-    @tf.function
     def test_step(self, data):
         x, y_true = data
-        y_pred = self(x, training=False)
-        loss = self.compute_loss(y=y_true, y_pred=y_pred)
+        y_true = self._label_columns(y_true)
+        # Evaluation runs between weight updates, so it always scores against the live label embeddings.
+        if self.xla_scoring:
+            y_pred, loss = self._compiled_scores(self._context_encoder(x), self._label_matrix(), y_true)
+        else:
+            y_pred = self._score(x, self._label_matrix())
+            loss = self.loss.call(y_true, y_pred)
 
         for metric in self._metrics:
             metric.update_state(y_true, y_pred)
 
+        # Metric results are already aggregated across replicas.
         metric = {metric.name: metric.result() for metric in self.metrics}
-        metric[self.loss.name] = loss
+        metric[self.loss.name] = self._replica_mean(loss)
         return metric
 
+    @staticmethod
+    def _replica_mean(value: tf.Tensor) -> tf.Tensor:
+        # Step losses are averaged over every replica's batch, so the first replica's outputs stand for all of them.
+        return tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.MEAN, value)
+
     @property
     def metrics(self):
         return [m for m in self._metrics]
 
-    def call(self, inputs: dict[str, tf.Tensor], training=None, mask=None) -> tf.Tensor:
-        context_embeddings = self._context_encoder(inputs)
+    def fit(self, *args, **kwargs):
+        history = super().fit(*args, **kwargs)
+        # The weights are final until the next fit, so inference can read the label embeddings from the cache.
+        self.cache_item_embeddings()
+        if self._retrieval_index is not None:
+            self.build_retrieval_index(self._retrieval_index.num_lists, self._retrieval_index.num_probes)
+        return history
+
+    def build_retrieval_index(self, num_lists: int, num_probes: int) -> retrieval.IVFIndex:
+        """
+        Clusters the cached label embeddings into an IVF index, which serve() then searches instead of scoring the
+        whole vocabulary. More probes give better recall for more latency.
+        """
+        items = self.cache_item_embeddings().numpy()
+        index = retrieval.IVFIndex.build(items, num_lists, num_probes, self._config['num_predictions'])
+        object.__setattr__(self, '_retrieval_index', index)
+        return index
+
+    def cache_item_embeddings(self) -> tf.Variable:
+        """
+        Computes the label embedding matrix once, so inference doesn't rebuild it for every request.
+
+        The cache is only read outside of training, and fit() fills it afterward. Call this again after changing the
+        weights any other way.
+        """
+        label_embeddings = self._label_matrix()
+        if self._item_embeddings is None:
+            # Set around Keras' tracking, so the cache never becomes one of the model's saved weights.
+            object.__setattr__(self,
+                               '_item_embeddings',
+                               tf.Variable(label_embeddings, trainable=False, name='item_embeddings'))
+        else:
+            self._item_embeddings.assign(label_embeddings)
+        return self._item_embeddings
+
+    def _label_matrix(self) -> tf.Tensor:
         label_embeddings = self._label_encoder(self._vocabulary)
         if keras.backend.ndim(label_embeddings) == 3:
             label_embeddings = tf.squeeze(label_embeddings, 1)
-        return tf.matmul(context_embeddings, label_embeddings, transpose_b=True)
+        return label_embeddings
+
+    def _score(self, inputs: dict[str, tf.Tensor], label_embeddings: tf.Tensor) -> tf.Tensor:
+        return self._logits(self._context_encoder(inputs), label_embeddings)
+
+    @staticmethod
+    def _logits(context_embeddings: tf.Tensor, label_embeddings: tf.Tensor) -> tf.Tensor:
+        # The vocab matmul runs in float32 whatever the compute dtype: a bfloat16 product over the whole vocabulary
+        # loses enough precision to reorder close scores and skew the softmax.
+        return tf.matmul(tf.cast(context_embeddings, 'float32'), tf.cast(label_embeddings, 'float32'),
+                         transpose_b=True)
+
+    @tf.function(jit_compile=True)
+    def _compiled_scores(self, context_embeddings, label_embeddings, y_true):
+        # Only the scoring is compiled. Compiling the whole step makes XLA on CPU copy the variables the GRU reads
+        # on every update, which costs far more than the fused softmax saves.
+        logits = self._logits(context_embeddings, label_embeddings)
+        return logits, self.loss.call(y_true, logits)
+
+    def encode_contexts(self, inputs: dict[str, tf.Tensor]) -> tf.Tensor:
+        """
+        The float32 context embeddings of a batch of inputs, whatever the compute dtype.
+        """
+        return tf.cast(self._context_encoder(inputs, training=False), 'float32')
+
+    def call(self, inputs: dict[str, tf.Tensor], training=None, mask=None) -> tf.Tensor:
+        if training or self._item_embeddings is None:
+            return self._score(inputs, self._label_matrix())
+        return self._score(inputs, self._item_embeddings)
+
+    def _top_k(self, inputs: dict[str, tf.Tensor]) -> tuple[tf.Tensor, tf.Tensor]:
+        # The top columns, shifted back to the label_ids (work_index) they score.
+        if self._retrieval_index is None:
+            values, columns = tf.math.top_k(self(inputs), self._config['num_predictions'], sorted=True)
+        else:
+            values, columns = self._retrieval_index.search(self.encode_contexts(inputs),
+                                                           self._config['num_predictions'])
+        return values, columns + 1
 
     @tf.function
     def serve(self, **kwargs):
         query = kwargs
-        dotproduct = self(query)
-        values, indices = tf.math.top_k(tf.squeeze(dotproduct), self._config['num_predictions'], sorted=True)
+        values, indices = self._top_k(query)
+        values, indices = tf.squeeze(values), tf.squeeze(indices)
         ids = tf.identity(indices, name='top_recommendation_ids')
         scores = tf.identity(tf.math.sigmoid(values), name='top_recommendation_scores')
         return {'recommendation_ids': ids, 'recommendation_scores': scores}
 
+    @tf.function
+    def serve_batch(self, context_id, context_rating):
+        """
+        serve() over a batch of contexts, so a server can answer many requests with one forward pass.
+        """
+        values, indices = self._top_k({'context_id': context_id, 'context_rating': context_rating})
+        return {'recommendation_ids': indices, 'recommendation_scores': tf.math.sigmoid(values)}
+
     def get_config(self):
         base_config = super().get_config()
         config = {"model_config": self._config}
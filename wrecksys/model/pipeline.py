@@ -1,6 +1,9 @@
+import functools
 import logging
 import os
 
+import numpy as np
+
 from wrecksys.data.datasets import WrecksysDataset
 from wrecksys.utils import import_tensorflow
 tf, keras = import_tensorflow()
@@ -12,33 +15,117 @@ def sample_record(dataset: tf.data.Dataset) -> dict:
     sample = next(iter(dataset))
     return {k: v[0] for k, v in sample[0].items()}
 
+def split_dataset(data: WrecksysDataset,
+                  split: str,
+                  batch_size: int,
+                  input_context: tf.distribute.InputContext | None = None,
+                  repeat: bool = False,
+                  seed: int | None = None) -> tf.data.Dataset:
+    """
+    One split of the dataset, batched, shuffled if it's the training split. With an input context from
+    Strategy.distribute_datasets_from_function, batch_size is the global batch size, and the dataset is this
+    worker's share of the split in per-replica batches.
+    """
+    d, batch_size = _load(data, split, batch_size, input_context)
+    if split == 'train':
+        d = d.shuffle(buffer_size=1000 * batch_size, seed=seed)
+    if repeat:
+        d = d.repeat()
+    d = d.batch(batch_size=batch_size, drop_remainder=True)
+    return d.prefetch(buffer_size=tf.data.AUTOTUNE)
+
+
+def epoch_stream(data: WrecksysDataset,
+                 batch_size: int,
+                 steps: int,
+                 seed: int,
+                 epochs: range,
+                 offset: int = 0,
+                 input_context: tf.distribute.InputContext | None = None) -> tf.data.Dataset:
+    """
+    The train split as the given epochs of steps batches each, one after another, starting offset batches in.
+
+    Each epoch is shuffled with seed plus its number, so the stream can start at any epoch without reading through
+    the ones before it, and a resumed run sees the batches the interrupted run would have, as long as the dataset
+    reads its examples in a fixed order. Epochs repeat the split if a worker's share of it is short of steps batches.
+    """
+    d, batch_size = _load(data, 'train', batch_size, input_context)
+    # Each step takes a per-replica batch from this pipeline for every replica it feeds.
+    per_step = 1 if input_context is None else input_context.num_replicas_in_sync // input_context.num_input_pipelines
+
+    # Concatenated datasets are read one after another, so only the current epoch holds a shuffle buffer. Each epoch
+    # keeps its order however often Keras iterates over the stream.
+    stream = functools.reduce(tf.data.Dataset.concatenate,
+                              [d.shuffle(buffer_size=1000 * batch_size,
+                                         seed=seed + epoch,
+                                         reshuffle_each_iteration=False)
+                               .repeat()
+                               .batch(batch_size=batch_size, drop_remainder=True)
+                               .take(steps * per_step)
+                               for epoch in epochs])
+    return stream.skip(offset * per_step).prefetch(buffer_size=tf.data.AUTOTUNE)
+
+
+def _load(data: WrecksysDataset,
+          split: str,
+          batch_size: int,
+          input_context: tf.distribute.InputContext | None) -> tuple[tf.data.Dataset, int]:
+    if input_context is None:
+        return data.load(split), batch_size
+    return (data.load(split, input_context.num_input_pipelines, input_context.input_pipeline_id),
+            input_context.get_per_replica_batch_size(batch_size))
+
+
 def create_training_data(
         data: WrecksysDataset,
-        data_size: int,
         batch_size: int,
-        test_percent: float) -> tuple[tf.data.Dataset, tf.data.Dataset, tf.data.Dataset]:
-
-    d = data.load()
-    #d = d.apply(tf.data.experimental.assert_cardinality(data_size))
-
-    test_size = int(data_size * test_percent)
-    test = (d
-            .take(test_size)
-            .batch(batch_size=batch_size, drop_remainder=True)
-            .prefetch(buffer_size=tf.data.AUTOTUNE)
-            )
-    val = (d
-           .skip(test_size)
-           .take(test_size)
-           .batch(batch_size=batch_size, drop_remainder=True)
-           .prefetch(buffer_size=tf.data.AUTOTUNE)
-           )
-    train = (d
-             .skip(2*test_size)
-             .shuffle(buffer_size=1000 * batch_size)
-             .batch(batch_size=batch_size, drop_remainder=True)
-             .prefetch(buffer_size=tf.data.AUTOTUNE)
-             )
+        steps: int | None = None,
+        seed: int | None = None,
+        epochs: range = range(1),
+        offset: int = 0) -> tuple[tf.data.Dataset, tf.data.Dataset, tf.data.Dataset]:
+    """
+    Loads the train, test and validation splits the dataset assigned when it was built. Each split only reads its
+    own shards, so nothing is skipped over to reach the later ones and no example can appear in two of them.
 
+    With steps, the train split is the epoch_stream of those epochs, each that many steps long.
+    """
+    train, test, val = (split_dataset(data, split, batch_size) for split in ('train', 'test', 'validation'))
+    if steps is not None:
+        train = epoch_stream(data, batch_size, steps, seed or 0, epochs, offset)
     return train, test, val
 
+
+def create_distributed_data(
+        data: WrecksysDataset,
+        batch_size: int,
+        strategy: tf.distribute.Strategy,
+        steps: int | None = None,
+        seed: int | None = None,
+        epochs: range = range(1),
+        offset: int = 0) -> tuple[tf.distribute.DistributedDataset, ...]:
+    """
+    create_training_data for a distribution strategy, with batch_size examples per replica. Workers can hold
+    different numbers of examples, so the splits repeat and the steps of each epoch come from steps_per_epoch.
+    """
+    global_batch_size = batch_size * strategy.num_replicas_in_sync
+    if steps is None:
+        make_train = functools.partial(split_dataset, data, 'train', global_batch_size, repeat=True, seed=seed)
+    else:
+        make_train = functools.partial(epoch_stream, data, global_batch_size, steps, seed or 0, epochs, offset)
+    train, test, val = (
+        strategy.distribute_datasets_from_function(make_split)
+        for make_split in (make_train,
+                           functools.partial(split_dataset, data, 'test', global_batch_size, repeat=True),
+                           functools.partial(split_dataset, data, 'validation', global_batch_size, repeat=True))
+    )
+    return train, test, val
+
+
+def steps_per_epoch(data: WrecksysDataset, split: str, global_batch_size: int) -> int:
+    d = data.load(split)
+    size = int(d.cardinality())
+    if size < 0:
+        # Only datasets built before their sizes were recorded get here.
+        logger.info(f"Counting the {split} examples, since {type(data).__name__} doesn't know how many there are.")
+        size = int(d.reduce(np.int64(0), lambda count, _: count + 1))
+    return max(size // global_batch_size, 1)
@@ -0,0 +1,155 @@
+import logging
+import time
+
+import numpy as np
+
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+logger = logging.getLogger(__name__)
+
+
+def kmeans(vectors: np.ndarray,
+           num_clusters: int,
+           iterations: int = 20,
+           seed: int = 0,
+           batch_size: int = 1 << 14) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Lloyd's k-means, returning the centroids and each vector's cluster. Empty clusters are restarted on a random
+    vector, so every cluster ends up with at least one member.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = vectors.astype(np.float32)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int64)
+
+    for _ in range(iterations):
+        # argmin ||x - c||^2 is argmax 2x.c - ||c||^2, computed in batches to bound the distance matrix.
+        norms = (centroids ** 2).sum(axis=1)
+        for start in range(0, len(vectors), batch_size):
+            scores = 2 * vectors[start:start + batch_size] @ centroids.T - norms
+            assignments[start:start + batch_size] = scores.argmax(axis=1)
+
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+
+    return centroids, assignments
+
+
+class IVFIndex(tf.Module):
+    """
+    An inverted file index for maximum inner product search over the label embeddings.
+
+    The items are clustered with k-means, and each query only scores the items in the num_probes lists whose
+    centroids score highest against it. Per-query cost is num_lists + num_probes * list_size dot products instead of
+    vocab_size, and num_probes trades latency for recall. The lists are stored back to back, CSR style, as one array of
+    item ids and vectors sorted by list plus the offset each list starts at, so memory stays at one row per item
+    however uneven the clusters are. The search only gathers the ranges of the probed lists, and exports as part of
+    serve().
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, ids: np.ndarray, vectors: np.ndarray,
+                 num_probes: int):
+        super().__init__(name='retrieval_index')
+        self.num_lists = len(centroids)
+        self.num_probes = num_probes
+        self.centroids = tf.Variable(centroids, trainable=False, name='centroids')
+        self.offsets = tf.Variable(offsets, trainable=False, name='offsets')
+        self.ids = tf.Variable(ids, trainable=False, name='ids')
+        self.vectors = tf.Variable(vectors, trainable=False, name='vectors')
+
+    @classmethod
+    def build(cls, items: np.ndarray, num_lists: int, num_probes: int, k: int, seed: int = 0) -> 'IVFIndex':
+        centroids, assignments = kmeans(items, num_lists, seed=seed)
+        sizes = np.bincount(assignments, minlength=num_lists)
+        if np.sort(sizes)[:num_probes].sum() < k:
+            raise ValueError(f"{num_probes} of {num_lists} lists can hold fewer than {k} items, use fewer lists "
+                             f"or more probes.")
+
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+        logger.info(f"Built an IVF index with {num_lists} lists of {sizes.min()} to {sizes.max()} items, "
+                    f"probing {num_probes}.")
+        return cls(centroids, offsets, order.astype(np.int32), items[order].astype(np.float32), num_probes)
+
+    def search(self, queries: tf.Tensor, k: int) -> tuple[tf.Tensor, tf.Tensor]:
+        """
+        The approximate top k items for a [batch, dimensions] tensor of queries, as (scores, item indices).
+        """
+        _, probes = tf.math.top_k(tf.matmul(queries, self.centroids, transpose_b=True), self.num_probes)
+        starts = tf.gather(self.offsets, probes)
+        lengths = tf.gather(self.offsets, probes + 1) - starts
+
+        # The rows of every probed list, one ragged row of candidates per query.
+        rows = tf.ragged.range(tf.reshape(starts, [-1]), tf.reshape(starts + lengths, [-1])).flat_values
+        candidates = tf.reduce_sum(lengths, axis=1)
+        scores = tf.reduce_sum(tf.repeat(queries, candidates, axis=0) * tf.gather(self.vectors, rows), axis=1)
+        scores = tf.RaggedTensor.from_row_lengths(scores, candidates).to_tensor(-np.inf)
+        ids = tf.RaggedTensor.from_row_lengths(tf.gather(self.ids, rows), candidates).to_tensor(-1)
+
+        # Padding only reaches the most candidates any query in the batch has, and build() made sure every query
+        # has at least k.
+        values, positions = tf.math.top_k(scores, k, sorted=True)
+        return values, tf.gather(ids, positions, batch_dims=1)
+
+
+def recall_at_k(approximate: np.ndarray, exact: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approximate, exact))
+    return hits / exact.size
+
+
+def benchmark(items: np.ndarray,
+              queries: np.ndarray,
+              k: int,
+              num_lists: int,
+              probes: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+              batch_size: int = 64,
+              repeats: int = 5) -> list[dict]:
+    """
+    Recall@k of the IVF index against the exact top k, and the search time per query, for each number of probes.
+    Queries are searched in batches the size of a serving batch. Probe counts whose lists can't hold k items get a
+    row with the reason instead of a recall.
+    """
+    items_t = tf.constant(items, dtype=tf.float32)
+    batches = [tf.constant(queries[i:i + batch_size], dtype=tf.float32) for i in range(0, len(queries), batch_size)]
+
+    @tf.function
+    def _exact(q):
+        return tf.math.top_k(tf.matmul(q, items_t, transpose_b=True), k, sorted=True)
+
+    def _time(fn) -> tuple[float, np.ndarray]:
+        indices = np.concatenate([fn(batch)[1].numpy() for batch in batches])
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for batch in batches:
+                fn(batch)[1].numpy()
+        return (time.perf_counter() - start) / repeats / len(queries) * 1e6, indices
+
+    exact_time, exact = _time(_exact)
+    results = [{'num_probes': None, 'recall': 1.0, 'us_per_query': exact_time}]
+    for num_probes in probes:
+        if num_probes > num_lists:
+            break
+        try:
+            index = IVFIndex.build(items, num_lists, num_probes, k)
+        except ValueError as e:
+            results.append({'num_probes': num_probes, 'recall': None, 'us_per_query': None, 'error': str(e)})
+            continue
+        search = tf.function(lambda q: index.search(q, k))
+        search_time, approximate = _time(search)
+        results.append({'num_probes': num_probes,
+                        'recall': recall_at_k(approximate, exact),
+                        'us_per_query': search_time})
+
+    for result in results:
+        probes_label = 'exact' if result['num_probes'] is None else f"{result['num_probes']} probes"
+        if result['recall'] is None:
+            logger.info(f"{probes_label:>10}: skipped, {result['error']}")
+            continue
+        logger.info(f"{probes_label:>10}: recall@{k} {result['recall']:.3f}, {result['us_per_query']:.1f}us/query")
+    return results
@@ -1,13 +1,16 @@
+import json
 import logging
-import math
 import os
 import pathlib
+import shutil
 import tarfile
+import tempfile
 from typing_extensions import Self
 
 from wrecksys.config import ConfigFile
+from wrecksys.data.datasets import SPLITS
 from wrecksys.data.sources import GoodreadsData
-from wrecksys.model import callbacks, losses, models, pipeline
+from wrecksys.model import callbacks, evaluation, losses, models, pipeline, retrieval
 from wrecksys.utils import import_tensorflow
 tf, keras = import_tensorflow()
 
@@ -20,7 +23,7 @@ ENV_ROOT = 'WRECKSYS_DIR'
 
 class FunctionalModel(object):
 
-    def __init__(self, model_name: str, data_directory=None):
+    def __init__(self, model_name: str, data_directory=None, strategy: tf.distribute.Strategy | None = None):
         if not data_directory:
             if ENV_DATA not in os.environ:
                 raise ValueError("Please provide a data directory.")
@@ -33,6 +36,11 @@ class FunctionalModel(object):
         self.name = model_name
         self.model: keras.Model = None
         self.config = CONFIG_FILE.data
+        self.strategy = strategy or self._create_strategy(getattr(self.config, 'distribution', None))
+        self.checkpoints: tf.train.CheckpointManager | None = None
+        self._run_start: tf.Variable | None = None
+        self._resumed = False
+        self._worker_checkpoints = None
 
         self.data = GoodreadsData(data_directory)
         self.dataset = self.data.dataset
@@ -42,6 +50,7 @@ class FunctionalModel(object):
         self.directory.mkdir(parents=True, exist_ok=True)
 
         self.file = pathlib.Path(self.directory / f"{model_name}.keras")
+        self.checkpoint_dir = self.directory / 'checkpoints'
         self.export_dir = self.directory / 'saved_model'
         self.build_file = self.root_dir / 'build.tar.gz'
 
@@ -53,20 +62,63 @@ class FunctionalModel(object):
             'vocab_size': self.config.vocab_size,
             'embedding_dimensions': self.config.embedding_dimensions,
             'rnn_dimensions': self.config.rnn_dimensions,
-            'num_predictions': self.config.num_predictions
+            'num_predictions': self.config.num_predictions,
+            'training_loss': getattr(self.config, 'training_loss', 'global'),
+            'num_negatives': getattr(self.config, 'num_negatives', 4096)
         }
 
 
-    def new(self) -> Self:
-        self.model = models.WreckSys(self._model_config, name=self.name)
-        return self._compile()
+    @property
+    def fast_training(self) -> bool:
+        return getattr(self.config, 'fast_training', False)
+
+    @property
+    def precision_policy(self) -> str:
+        return getattr(self.config, 'fast_training_policy', 'mixed_bfloat16') if self.fast_training else 'float32'
+
+    @property
+    def checkpoint_interval(self) -> int | None:
+        return getattr(self.config, 'checkpoint_interval', None)
+
+    @property
+    def distributed(self) -> bool:
+        return self.strategy.num_replicas_in_sync > 1
+
+    @property
+    def is_chief(self) -> bool:
+        resolver = getattr(self.strategy, 'cluster_resolver', None)
+        if resolver is None or not resolver.task_type:
+            return True
+        if resolver.task_type == 'chief':
+            return True
+        return resolver.task_type == 'worker' and resolver.task_id == 0 and 'chief' not in resolver.cluster_spec().jobs
+
+    def new(self, resume: bool = False) -> Self:
+        """
+        Creates a fresh model. Checkpoints an earlier run left behind are deleted, unless resume is set, in which
+        case the model carries on from the latest of them.
+        """
+        self._set_precision(self.precision_policy)
+        if not resume and self.is_chief and self.checkpoint_dir.exists():
+            shutil.rmtree(self.checkpoint_dir)
+        # Variables, including the optimizer's and the metrics', have to be created in the strategy's scope.
+        with self.strategy.scope():
+            self.model = models.WreckSys(self._model_config, name=self.name)
+            self._compile()
+            return self._track_checkpoints(resume)
 
     def load(self) -> Self:
         if self.file.exists():
-            self.model = keras.models.load_model(self.file, compile=True)
+            self._set_precision(self.precision_policy)
+            with self.strategy.scope():
+                self.model = keras.models.load_model(self.file, compile=True)
+                self.model.xla_scoring = self.fast_training
+                self._track_checkpoints()
+                self.model.cache_item_embeddings()
             return self
+        # A run that stopped before save() only left its checkpoints.
         logger.info(f"{self.name} not found, creating new model.")
-        return self.new()
+        return self.new(resume=True)
 
     def _compile(self) -> Self:
         if self.model:
@@ -74,30 +126,173 @@ class FunctionalModel(object):
                 optimizer=keras.optimizers.experimental.Adagrad(learning_rate=0.065, epsilon=1e-06),
                 loss=losses.GlobalSoftmax()
             )
+            self.model.xla_scoring = self.fast_training
             logger.debug("New model compiled.")
             return self
 
+    def _track_checkpoints(self, resume: bool = True) -> Self:
+        """
+        Sets up the checkpoints train_and_eval writes every checkpoint_interval steps, and with resume, restores the
+        latest one if it's further along than the model, as it is when a run stopped before save(). Restoring brings
+        back the weights, the optimizer's state and step counter, and the step the run started at, from which
+        train_and_eval works out the epoch and the batch within it to carry on from.
+        """
+        if not self.checkpoint_interval:
+            return self
+        self._run_start = tf.Variable(0, dtype=tf.int64, trainable=False, name='run_start')
+        directory = self.checkpoint_dir
+        if not self.is_chief:
+            # Every worker has to take part in writing a checkpoint, but only the chief's are kept.
+            self._worker_checkpoints = tempfile.TemporaryDirectory()
+            directory = self._worker_checkpoints.name
+        self.checkpoints = callbacks.checkpoint_manager(self.model,
+                                                        directory,
+                                                        getattr(self.config, 'checkpoint_max_to_keep', 3),
+                                                        run_start=self._run_start)
+
+        latest = tf.train.latest_checkpoint(self.checkpoint_dir) if resume else None
+        step = int(latest.rsplit('-', 1)[-1]) if latest else 0
+        if step > int(self.model.optimizer.iterations.numpy()):
+            self.checkpoints.checkpoint.restore(latest)
+            self._resumed = True
+            logger.info(f"Resuming {self.name} from step {step}.")
+        return self
+
+    @staticmethod
+    def _create_strategy(distribution: str | None) -> tf.distribute.Strategy:
+        if distribution is None:
+            return tf.distribute.get_strategy()
+        if distribution == 'mirrored':
+            return tf.distribute.MirroredStrategy()
+        if distribution == 'multi_worker':
+            # The cluster and this worker's place in it come from the TF_CONFIG environment variable.
+            return tf.distribute.MultiWorkerMirroredStrategy()
+        raise ValueError(f"Unknown distribution {distribution}, expected 'mirrored' or 'multi_worker'.")
+
+    @staticmethod
+    def _set_precision(policy: str) -> None:
+        # Layers pick up the global policy when they're built, so this has to run before the model is created.
+        keras.mixed_precision.set_global_policy(policy)
+
     def train_and_eval(self, rounds=1, epochs=1, limit=None) -> Self:
+        """
+        Trains on the train split and evaluates on the test split. Under a distribution strategy, config.batch_size
+        is the batch of each replica, so every worker takes the same steps as a single process would with a
+        batch_size batch, and an epoch takes 1 / num_replicas as many of them.
+
+        With checkpoint_interval set, a run that load() resumed skips what it had already trained on and carries on
+        from the step it stopped at, so calling this again with the same arguments finishes the interrupted run.
+        """
         logger.debug("Entering the training loop")
-        train, test, val = pipeline.create_training_data(self.data.dataset,
-                                                         self.config.num_records,
-                                                         self.config.batch_size,
-                                                         test_percent=0.1)
-        val_steps = math.ceil(len(val) // self.config.batch_size)
-        for _ in range(rounds):
-            use_callbacks = callbacks.callback_list(self.model, self.directory)
+        global_batch_size = self.config.batch_size * self.strategy.num_replicas_in_sync
+        steps = {'train': limit, 'validation': None, 'test': limit}
+        if self.distributed:
+            steps = {split: limit or pipeline.steps_per_epoch(self.data.dataset, split, global_batch_size)
+                     for split in SPLITS}
+            logger.info(f"Training on {self.strategy.num_replicas_in_sync} replicas, "
+                        f"{steps['train']} steps of {global_batch_size} examples per epoch.")
+        elif self.checkpoints is not None:
+            # The resumable train split repeats, so it can't mark where an epoch ends.
+            steps['train'] = limit or pipeline.steps_per_epoch(self.data.dataset, 'train', global_batch_size)
+
+        if self.model.training_loss != 'global':
+            self.model.set_label_frequencies(self.data.label_counts())
+        if self.checkpoints is not None and not self._resumed:
+            self._run_start.assign(self.model.optimizer.iterations)
+        self._resumed = False
+
+        verbose = 1 if self.is_chief else 0
+        for round_ in range(rounds):
+            use_callbacks = callbacks.callback_list(self.model,
+                                                    self.directory,
+                                                    self.checkpoints,
+                                                    self.checkpoint_interval)
+            if self.checkpoints is None:
+                train, test, val = self._training_data()
+                self.model.fit(train,
+                               validation_data=val,
+                               validation_steps=steps['validation'],
+                               epochs=epochs,
+                               steps_per_epoch=steps['train'],
+                               callbacks=use_callbacks,
+                               verbose=verbose)
+            else:
+                test = self._fit_resumable(round_ * epochs, epochs, steps, use_callbacks, verbose)
+                if test is None:
+                    # The interrupted run had already finished this round.
+                    continue
+            self.model.evaluate(test, steps=steps['test'], callbacks=use_callbacks, verbose=verbose)
+        return self
+
+    def _training_data(self, steps=None, seed=None, epochs=range(1), offset=0) -> tuple:
+        if self.distributed:
+            return pipeline.create_distributed_data(self.data.dataset,
+                                                    self.config.batch_size,
+                                                    self.strategy,
+                                                    steps,
+                                                    seed,
+                                                    epochs,
+                                                    offset)
+        return pipeline.create_training_data(self.data.dataset, self.config.batch_size, steps, seed, epochs, offset)
+
+    def _fit_resumable(self, first_epoch, epochs, steps, use_callbacks, verbose):
+        """
+        Fits epochs of the run from first_epoch on, starting from the step counter rather than the beginning, and
+        returns the test split, or None if the run was already past them.
+        """
+        # Every step takes one batch, so the steps since the run started give the epoch and the batch within it.
+        position = int(self.model.optimizer.iterations.numpy()) - int(self._run_start.numpy())
+        done = position - first_epoch * steps['train']
+        if done >= epochs * steps['train']:
+            return None
+        epoch, offset = divmod(done, steps['train'])
+        # The train stream seeds each epoch's shuffle with its number, so it can start partway through the run.
+        seed = int(self._run_start.numpy())
+
+        def _fit(initial_epoch, skip):
+            last_epoch = initial_epoch + 1 if skip else epochs
+            train, test, val = self._training_data(steps['train'],
+                                                   seed,
+                                                   range(first_epoch + initial_epoch, first_epoch + last_epoch),
+                                                   skip)
             self.model.fit(train,
                            validation_data=val,
-                           validation_steps=val_steps,
-                           epochs=epochs,
-                           steps_per_epoch=limit,
+                           validation_steps=steps['validation'],
+                           initial_epoch=initial_epoch,
+                           epochs=last_epoch,
+                           steps_per_epoch=steps['train'] - skip,
                            callbacks=use_callbacks,
-                           verbose=1)
-            self.model.evaluate(test, steps=limit, callbacks=use_callbacks)
+                           verbose=verbose)
+            return test
+
+        if offset:
+            # Keras gives every epoch of a fit the same number of steps, so the rest of the epoch a run stopped in
+            # is fitted on its own, and the epochs after it in one more fit.
+            test = _fit(epoch, offset)
+            epoch += 1
+            if self.model.stop_training or epoch == epochs:
+                return test
+        return _fit(epoch, 0)
+
+    def evaluate_offline(self, top_k=(1, 5, 10, 100), chunk_size=4096, workers=None) -> Self:
+        # Read straight from the test split, so the remainder that training batches drop is still evaluated.
+        test = self.data.dataset.load('test')
+        items = self.model.cache_item_embeddings().numpy()
+        evaluation.evaluate(self.model.encode_contexts,
+                            items,
+                            test.batch(chunk_size),
+                            top_k,
+                            workers,
+                            self.directory / 'evaluation.json')
         return self
 
     def save(self) -> Self:
-        self.model.save(self.file)
+        if self.is_chief:
+            self.model.save(self.file)
+            return self
+        # Every worker has to take part in saving a distributed model, but only the chief's copy is kept.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.model.save(pathlib.Path(temp_dir) / self.file.name)
         return self
 
     def export_as_saved_model(self) -> Self:
@@ -108,15 +303,78 @@ class FunctionalModel(object):
         }
 
         export_archive.track(self.model)
+        export_archive.track(self.model.cache_item_embeddings())
+        if getattr(self.config, 'ann_num_lists', None):
+            export_archive.track(self.model.build_retrieval_index(self.config.ann_num_lists,
+                                                                  getattr(self.config, 'ann_num_probes', 16)))
         self.model.serve(**dummy_input)
         export_archive.add_endpoint(
             name='serve',
             fn=self.model.serve,
         )
+        export_archive.add_endpoint(
+            name='serve_batch',
+            fn=self.model.serve_batch,
+            input_signature=[
+                tf.TensorSpec(shape=(None, 10), dtype=tf.int32, name='context_id'),
+                tf.TensorSpec(shape=(None, 10), dtype=tf.float32, name='context_rating')
+            ]
+        )
 
         export_archive.write_out(str(self.export_dir))
         return self
 
+    def benchmark_retrieval(self, num_queries=1024, num_lists=None, probes=(1, 2, 4, 8, 16, 32)) -> Self:
+        contexts = self.data.dataset.load().take(num_queries).batch(num_queries)
+        queries = self.model.encode_contexts(next(iter(contexts))[0]).numpy()
+        items = self.model.cache_item_embeddings().numpy()
+        retrieval.benchmark(items,
+                            queries,
+                            self.config.num_predictions,
+                            num_lists or getattr(self.config, 'ann_num_lists', None) or int(4 * len(items) ** .5),
+                            probes)
+        return self
+
+    def benchmark_training(self, steps=100, warmup=5) -> Self:
+        """
+        Trains a fresh model for the same batches in the float32 path, with XLA-compiled scoring alone, and in the
+        fast_training path (XLA and the fast_training_policy), and reports the steps per second and final loss of
+        each. Whether bfloat16 pays off depends on the CPU's support for it.
+        """
+        train, _, _ = pipeline.create_training_data(self.data.dataset, self.config.batch_size)
+        # Materialized up front, so both runs see the same batches and the input pipeline isn't part of the timing.
+        batches = list(train.take(steps + warmup))
+        data = tf.data.Dataset.from_tensor_slices(tf.nest.map_structure(lambda *t: tf.stack(t), *batches))
+        label_counts = self.data.label_counts() if self._model_config['training_loss'] != 'global' else None
+
+        policy = getattr(self.config, 'fast_training_policy', 'mixed_bfloat16')
+        results = {}
+        for mode, precision, fast in (('float32', 'float32', False),
+                                      ('float32_xla', 'float32', True),
+                                      (f'{policy}_xla', policy, True)):
+            self._set_precision(precision)
+            keras.utils.set_random_seed(0)
+            model = models.WreckSys(self._model_config, name=f'{self.name}_{mode}')
+            model.compile(optimizer=keras.optimizers.experimental.Adagrad(learning_rate=0.065, epsilon=1e-06),
+                          loss=losses.GlobalSoftmax())
+            model.xla_scoring = fast
+            if label_counts is not None:
+                model.set_label_frequencies(label_counts)
+            timer = callbacks.StepTimer(warmup)
+            model.fit(data, epochs=1, callbacks=[timer], verbose=0)
+            results[mode] = {
+                'steps_per_second': timer.steps_per_second,
+                # The mean of the last few steps, since single-step losses are noisy.
+                'final_loss': sum(timer.losses[-10:]) / len(timer.losses[-10:])
+            }
+            logger.info(f"{mode}: {results[mode]['steps_per_second']:.2f} steps/s, "
+                        f"final loss {results[mode]['final_loss']:.4f}")
+        self._set_precision(self.precision_policy)
+
+        with (self.directory / 'training_benchmark.json').open('w') as f:
+            json.dump(results, f, indent=4)
+        return self
+
     def export_to_tflite(self) -> Self:
         tflite_file = str(self.directory / f'{self.name}.tflite')
         converter = tf.lite.TFLiteConverter.from_saved_model(str(self.export_dir))
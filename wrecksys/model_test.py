@@ -53,6 +53,14 @@ def get_results(conn, predictions, limit=10):
     return results.fetchall()
 
 
+def search(conn, text, limit=10):
+    cols = "b.work_index, b.title, b.author_name, b.average_rating, b.link, b.image_url"
+    query = (f"SELECT {cols} FROM books_search s JOIN books b ON b.work_index = s.rowid "
+             f"WHERE books_search MATCH ? ORDER BY s.rank LIMIT ?")
+    results = conn.execute(query, (text, limit))
+    return results.fetchall()
+
+
 """con = sqlite3.connect("../data/app.db")
 con.row_factory = _row_to_json
 
@@ -0,0 +1,194 @@
+"""
+Serves an exported WreckSys model over the same REST API as TF Serving's predict endpoint.
+
+Concurrent requests are queued and answered together. The batcher waits up to max_wait for up to max_batch_size
+instances, then runs them through the model's serve_batch endpoint in one forward pass, so throughput under load
+comes from the batch size rather than the number of requests.
+"""
+import argparse
+import asyncio
+import logging
+import pathlib
+import typing
+from concurrent import futures
+
+import numpy as np
+from aiohttp import web
+
+from wrecksys.config import ConfigFile
+from wrecksys.utils import import_tensorflow
+tf, keras = import_tensorflow()
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = ConfigFile()
+DEFAULT_PORT = 8501
+INPUT_DTYPES = {'context_id': np.int32, 'context_rating': np.float32}
+
+Predictor = typing.Callable[[dict[str, np.ndarray]], dict[str, np.ndarray]]
+
+
+def load_predictor(export_dir: pathlib.Path) -> Predictor:
+    model = tf.saved_model.load(str(export_dir))
+    if hasattr(model, 'serve_batch'):
+        def _predict(inputs: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+            return {k: v.numpy() for k, v in model.serve_batch(**inputs).items()}
+        return _predict
+
+    logger.warning(f"{export_dir} has no serve_batch endpoint, requests will run one at a time.")
+
+    def _predict_each(inputs: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        size = len(next(iter(inputs.values())))
+        outputs = [model.serve(**{k: v[i] for k, v in inputs.items()}) for i in range(size)]
+        return {k: np.stack([output[k].numpy() for output in outputs]) for k in outputs[0]}
+    return _predict_each
+
+
+class MicroBatcher(object):
+    """
+    Coalesces concurrent predictions into batches.
+
+    The model runs on a single worker thread. Requests that arrive while it's busy wait in the queue, so the next
+    batch picks all of them up at once, and the batch size grows with the load without waiting any longer.
+    """
+    _class_logger = logging.getLogger(__name__).getChild(__qualname__)
+
+    def __init__(self, predict: Predictor, max_batch_size: int = 64, max_wait: float = .005):
+        self._predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='predict')
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, instance: dict[str, np.ndarray]) -> dict[str, list]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((instance, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[dict[str, np.ndarray], asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Instances can only be stacked with others of the same shape, so they're grouped before each pass.
+            groups = {}
+            for instance, future in batch:
+                key = tuple((k, v.shape) for k, v in sorted(instance.items()))
+                groups.setdefault(key, []).append((instance, future))
+
+            for group in groups.values():
+                inputs = {k: np.stack([instance[k] for instance, _ in group]) for k in group[0][0]}
+                try:
+                    outputs = await loop.run_in_executor(self._executor, self._predict, inputs)
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for i, (_, future) in enumerate(group):
+                    if not future.done():
+                        future.set_result({k: v[i].tolist() for k, v in outputs.items()})
+            self._class_logger.debug(f" Served a batch of {len(batch)}")
+
+
+def _parse_request(body: dict) -> tuple[list[dict[str, np.ndarray]], bool, bool]:
+    # Returns the instances, whether the request used the columnar "inputs" format, and whether it was unbatched.
+    if 'instances' in body:
+        instances = [{k: np.asarray(instance[k], dtype=dtype) for k, dtype in INPUT_DTYPES.items()}
+                     for instance in body['instances']]
+        return instances, False, False
+    if 'inputs' in body:
+        inputs = {k: np.asarray(body['inputs'][k], dtype=dtype) for k, dtype in INPUT_DTYPES.items()}
+        if inputs['context_id'].ndim == 1:
+            return [inputs], True, True
+        return [{k: v[i] for k, v in inputs.items()} for i in range(len(inputs['context_id']))], True, False
+    raise ValueError('Missing "instances" or "inputs" key')
+
+
+def create_app(export_dir: pathlib.Path,
+               model_name: str = 'wrecksys',
+               max_batch_size: int = 64,
+               max_wait: float = .005) -> web.Application:
+    batcher = MicroBatcher(load_predictor(export_dir), max_batch_size, max_wait)
+    routes = web.RouteTableDef()
+
+    def _not_found(name: str) -> web.Response:
+        return web.json_response({'error': f"Servable not found for request: Latest({name})"}, status=404)
+
+    @routes.get('/v1/models/{model}')
+    async def status(request: web.Request) -> web.Response:
+        if request.match_info['model'] != model_name:
+            return _not_found(request.match_info['model'])
+        return web.json_response({'model_version_status': [
+            {'version': '1', 'state': 'AVAILABLE', 'status': {'error_code': 'OK', 'error_message': ''}}
+        ]})
+
+    @routes.post('/v1/models/{model}:predict')
+    async def predict(request: web.Request) -> web.Response:
+        if request.match_info['model'] != model_name:
+            return _not_found(request.match_info['model'])
+        try:
+            instances, columnar, single = _parse_request(await request.json())
+            results = await asyncio.gather(*(batcher.submit(instance) for instance in instances))
+        except KeyError as e:
+            return web.json_response({'error': f"Missing input: {e.args[0]}"}, status=400)
+        except (ValueError, TypeError, tf.errors.InvalidArgumentError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+
+        if not columnar:
+            return web.json_response({'predictions': results})
+        if single:
+            return web.json_response({'outputs': results[0]})
+        return web.json_response({'outputs': {k: [result[k] for result in results] for k in results[0]}})
+
+    async def _start(_: web.Application) -> None:
+        await batcher.start()
+
+    async def _stop(_: web.Application) -> None:
+        await batcher.stop()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
+    return app
+
+
+if __name__ == "__main__":
+    config = CONFIG_FILE.data
+    parser = argparse.ArgumentParser(description='Serve an exported WreckSys model over the TF Serving REST API.')
+    parser.add_argument('export_dir', type=pathlib.Path)
+    parser.add_argument('--model-name', default='wrecksys')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-batch-size', type=int, default=getattr(config, 'serving_max_batch_size', 64))
+    parser.add_argument('--max-wait-ms', type=float, default=getattr(config, 'serving_max_wait_ms', 5))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(args.export_dir, args.model_name, args.max_batch_size, args.max_wait_ms / 1000),
+                port=args.port)